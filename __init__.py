@@ -7,15 +7,69 @@ from .transaction import PaymentTransaction, TransactionLog, PaymentGateway, \
 from .dummy import PaymentGatewayDummy, AddPaymentProfileViewDummy, \
     AddPaymentProfileDummy, DummyTransaction
 from .manual import PaymentGatewaySelf, ManualSelfTransaction
+from .profile_import import PaymentProfileImport
+from .http_client import PaymentGatewayHTTPClient
+from .rate_limit import PaymentGatewayRateLimit, \
+    PaymentTransactionRateLimit
+from .async_provider import PaymentGatewayAsync, PaymentTransactionAsync
+from .batch_provider import PaymentGatewayBatch, PaymentTransactionBatch
+from .circuit_breaker import PaymentGatewayCircuitBreaker, \
+    PaymentTransactionCircuitBreaker
+from .claim import PaymentTransactionClaim
+from .polling import PaymentTransactionPolling
+from .sweeper import PaymentGatewaySweeper, PaymentTransactionSweeper
+from .retry import PaymentGatewayRetry, PaymentTransactionRetry
+from .payout import Payout, PaymentTransactionPayout
+from .reconcile import PaymentTransactionReconcile
+from .posting import PaymentGatewayPosting, PaymentTransactionPosting
+from .webhook import WebhookEvent, PaymentGatewayWebhook
+from .idempotency import IdempotencyKey, PaymentTransactionIdempotency
+from .support import PaymentTransactionSupport
+from .archive import PaymentTransactionArchive, TransactionLogArchive, \
+    TransactionSummaryArchive
+from .summary import TransactionSummary, PaymentTransactionSummary, \
+    RebuildTransactionSummaryStart, RebuildTransactionSummary
 
 
 def register():
     Pool.register(
         Party,
         PaymentGateway,
+        PaymentGatewayRetry,
+        PaymentGatewaySweeper,
+        PaymentGatewayHTTPClient,
+        PaymentGatewayRateLimit,
+        PaymentGatewayCircuitBreaker,
+        PaymentGatewayAsync,
+        PaymentGatewayBatch,
+        PaymentGatewayWebhook,
+        PaymentGatewayPosting,
         PaymentProfile,
+        PaymentProfileImport,
         PaymentTransaction,
+        PaymentTransactionClaim,
+        PaymentTransactionPolling,
+        PaymentTransactionRetry,
+        PaymentTransactionSweeper,
+        PaymentTransactionCircuitBreaker,
+        PaymentTransactionRateLimit,
+        PaymentTransactionIdempotency,
+        PaymentTransactionAsync,
+        PaymentTransactionBatch,
+        PaymentTransactionPosting,
+        PaymentTransactionReconcile,
+        PaymentTransactionPayout,
+        PaymentTransactionSummary,
+        PaymentTransactionSupport,
+        PaymentTransactionArchive,
         TransactionLog,
+        TransactionLogArchive,
+        IdempotencyKey,
+        WebhookEvent,
+        Payout,
+        TransactionSummary,
+        TransactionSummaryArchive,
+        RebuildTransactionSummaryStart,
         AddPaymentProfileView,
         TransactionUseCardView,
         # Dummy provider related classes
@@ -35,5 +89,6 @@ def register():
         AddPaymentProfileDummy,
         TransactionUseCard,
         CreateRefund,
+        RebuildTransactionSummary,
         module='payment_gateway', type_='wizard'
     )
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Archive of the old transactions
+
+    The posted and cancelled transactions older than some months are moved,
+    with their logs, to archive tables of the same columns
+    (`payment_gateway_transaction_archive` and
+    `payment_gateway_transaction_log_archive`), so the views, searches and
+    aggregates on the transactions only read the recent history.
+
+    The transactions still referenced by a payout or a webhook event are
+    kept in the table, so the payouts and the events keep their
+    transactions.
+
+    The archive is read only when it is asked for with the context::
+
+        with Transaction().set_context(archived_transactions=True):
+            transactions = PaymentTransaction.search([...])
+
+    The transactions and logs are then read from the union of both tables.
+    The union is only read: the creations, modifications and deletions go
+    to the table, so the archived records can not be modified.
+
+    :meth:`archive_transactions` moves the transactions by chunks, each of
+    them committed, so the rows are never locked for long. The age is set
+    in the configuration of the server::
+
+        [payment_gateway]
+        archive_months = 24
+
+    The daily summary keeps the totals of the archived transactions.
+'''
+from dateutil.relativedelta import relativedelta
+from sql import Column, Null, Table, Union
+from sql.operators import Not
+
+from trytond import backend
+from trytond.config import config
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+from .claim import skip_locked
+
+__all__ = [
+    'PaymentTransactionArchive', 'TransactionLogArchive',
+    'TransactionSummaryArchive',
+]
+__metaclass__ = PoolMeta
+
+ARCHIVE_STATES = ['posted', 'cancel']
+
+
+class ArchiveTable(object):
+    "Archive of the records of a model, for the table handler"
+
+    def __init__(self, Model):
+        self.__name__ = Model.__name__
+        self._table = Model._table + '_archive'
+
+
+def _get_columns(Model):
+    return sorted(
+        name for name, field in Model._fields.iteritems()
+        if not hasattr(field, 'set')
+    )
+
+
+def register_archive(Model, module_name, indexes):
+    """
+    Create or update the archive table of the model with the columns of
+    its table
+    """
+    TableHandler = backend.get('TableHandler')
+
+    table = TableHandler(ArchiveTable(Model), module_name)
+    for name in _get_columns(Model):
+        if name == 'id':
+            continue
+        field = Model._fields[name]
+        size = getattr(field, 'size', None)
+        table.add_raw_column(
+            name, field.sql_type(), field.sql_format,
+            field_size=size if isinstance(size, int) else None,
+            string=field.string
+        )
+    for index in indexes:
+        table.index_action(index, 'add')
+
+
+def archive_table_query(Model):
+    """
+    Return the union of the table and the archive of the model if the
+    context asks for the archive
+    """
+    if not Transaction().context.get('archived_transactions'):
+        return None
+    table = Table(Model._table)
+    archive = Table(ArchiveTable(Model)._table)
+    columns = _get_columns(Model)
+    return Union(
+        table.select(*[Column(table, c).as_(c) for c in columns]),
+        archive.select(*[Column(archive, c).as_(c) for c in columns]),
+        all_=True
+    )
+
+
+def live_rows():
+    """
+    Return the context in which the model stores its records in its table
+    only, the union with the archive being read only
+    """
+    return Transaction().set_context(archived_transactions=False)
+
+
+def move_to_archive(Model, where):
+    """
+    Move the rows of the model matching the condition on its table to the
+    archive
+    """
+    table = Table(Model._table)
+    archive = Table(ArchiveTable(Model)._table)
+    columns = _get_columns(Model)
+    cursor = Transaction().connection.cursor()
+
+    cursor.execute(*archive.insert(
+        [Column(archive, c) for c in columns],
+        table.select(*[Column(table, c) for c in columns], where=where(table))
+    ))
+    cursor.execute(*table.delete(where=where(table)))
+
+
+class PaymentTransactionArchive:
+    "Archive the old transactions"
+    __name__ = 'payment_gateway.transaction'
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(PaymentTransactionArchive, cls).__register__(module_name)
+
+        register_archive(cls, module_name, [
+            'date', 'party', 'gateway', 'uuid', 'provider_reference',
+        ])
+
+    @classmethod
+    def table_query(cls):
+        return (
+            archive_table_query(cls) or
+            super(PaymentTransactionArchive, cls).table_query()
+        )
+
+    @classmethod
+    def create(cls, vlist):
+        with live_rows():
+            records = super(PaymentTransactionArchive, cls).create(vlist)
+        return cls.browse(records)
+
+    @classmethod
+    def write(cls, *args):
+        with live_rows():
+            super(PaymentTransactionArchive, cls).write(*args)
+
+    @classmethod
+    def delete(cls, records):
+        with live_rows():
+            super(PaymentTransactionArchive, cls).delete(records)
+
+    @classmethod
+    def archive_transactions(cls, date=None, chunk_size=1000, limit=None,
+                             commit=True):
+        """
+        Cron entry point which moves the posted and cancelled transactions
+        older than the date to the archive, with their logs, except the
+        ones of a payout or a webhook event
+
+        :param date: Archive the transactions before this date, by default
+                     `archive_months` of the configuration before today
+                     (nothing is archived if it is not set)
+        :param chunk_size: Number of transactions moved per batch
+        :param limit: Maximum number of transactions moved per run
+        :param commit: Commit the transaction after each batch
+        :return: The number of transactions archived
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+        TransactionLog = pool.get('payment_gateway.transaction.log')
+        WebhookEvent = pool.get('payment_gateway.webhook_event')
+        table = Table(cls._table)
+        event = WebhookEvent.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if date is None:
+            months = config.getint(
+                'payment_gateway', 'archive_months', default=0)
+            if not months:
+                return 0
+            date = Date.today() - relativedelta(months=months)
+
+        archived = 0
+        while limit is None or archived < limit:
+            size = chunk_size if limit is None else min(
+                chunk_size, limit - archived)
+            query = table.select(
+                table.id, where=table.state.in_(ARCHIVE_STATES) &
+                (table.date < date) & (table.payout == Null) &
+                Not(table.id.in_(event.select(
+                    event.transaction, where=event.transaction != Null
+                ))),
+                order_by=[table.id], limit=size
+            )
+            cursor.execute(*skip_locked(query))
+            ids = [id_ for id_, in cursor.fetchall()]
+            if not ids:
+                break
+
+            move_to_archive(TransactionLog, lambda t: t.transaction.in_(ids))
+            move_to_archive(cls, lambda t: t.id.in_(ids))
+            archived += len(ids)
+            if commit:
+                Transaction().commit()
+        return archived
+
+
+class TransactionLogArchive:
+    "Archive the logs of the old transactions"
+    __name__ = 'payment_gateway.transaction.log'
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(TransactionLogArchive, cls).__register__(module_name)
+
+        register_archive(cls, module_name, ['transaction'])
+
+    @classmethod
+    def table_query(cls):
+        return (
+            archive_table_query(cls) or
+            super(TransactionLogArchive, cls).table_query()
+        )
+
+    @classmethod
+    def create(cls, vlist):
+        with live_rows():
+            records = super(TransactionLogArchive, cls).create(vlist)
+        return cls.browse(records)
+
+    @classmethod
+    def write(cls, *args):
+        with live_rows():
+            super(TransactionLogArchive, cls).write(*args)
+
+    @classmethod
+    def delete(cls, records):
+        with live_rows():
+            super(TransactionLogArchive, cls).delete(records)
+
+
+class TransactionSummaryArchive:
+    "Keep the archived transactions in the summary"
+    __name__ = 'payment_gateway.transaction.summary'
+
+    @classmethod
+    def rebuild(cls, start_date=None, end_date=None):
+        with Transaction().set_context(archived_transactions=True):
+            super(TransactionSummaryArchive, cls).rebuild(
+                start_date=start_date, end_date=end_date
+            )
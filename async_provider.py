@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Concurrent provider calls
+
+    The provider methods (`capture_<provider>`, ...) are called one after
+    the other, so a batch of transactions takes the sum of the latencies of
+    the provider. A provider can also implement the I/O-only contract
+
+    .. code-block:: python
+
+        @classmethod
+        def capture_<provider>_async(cls, request):
+            ...
+            return {'state': 'completed', 'provider_reference': '...'}
+
+    for `authorize` and `capture`. The `request` is the dictionary returned
+    by :meth:`get_provider_request`, with the `idempotency_key` of the call
+    (see `idempotency.py`), and the method must not use the ORM or
+    the Tryton transaction: it is run in a worker thread, several requests
+    at once. It returns the result of the transaction, like the
+    `<verb>_<provider>_many` methods (see
+    :meth:`PaymentTransaction.call_provider_many`), or raises an exception
+    which fails the transaction.
+
+    When a gateway sets a `concurrency`, the `authorize` and `capture`
+    batches of its transactions run the requests through a bounded pool of
+    worker threads and the results are written back in the thread of the
+    Tryton transaction, in one write and one log creation per batch.
+
+    Python 2 has no `asyncio`, so the calls run on a bounded thread pool
+    instead of an event loop; the contract keeps the provider code free of
+    any ORM access so it can move to an event loop unchanged.
+'''
+import sys
+import time
+import threading
+from Queue import Queue, Empty
+
+from trytond import backend
+from trytond.model import ModelView, fields
+from trytond.pool import PoolMeta
+
+from .circuit_breaker import CircuitOpen
+from .rate_limit import RateLimitTimeout
+
+__all__ = [
+    'run_concurrently', 'PaymentGatewayAsync', 'PaymentTransactionAsync',
+]
+__metaclass__ = PoolMeta
+
+
+def run_concurrently(function, items, max_workers=32):
+    """
+    Call `function` on every item with at most `max_workers` calls at once
+
+    :return: A list of (result, exception) tuples in the order of the items.
+             The exception is None if the call succeeded.
+    """
+    results = [None] * len(items)
+    queue = Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[index] = (function(item), None)
+            except Exception:
+                results[index] = (None, sys.exc_info()[1])
+
+    threads = [
+        threading.Thread(target=worker)
+        for _ in xrange(min(max_workers, len(items)))
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def guarded_call(method, breaker=None, wait=None):
+    """
+    Return a function calling `method` under the rate limit and the circuit
+    breaker of the gateway, which are both thread-safe
+
+    :param wait: A function of the request which waits for its turn under
+                 the rate limit. It is called before the breaker is asked,
+                 so a call timing out while waiting never holds the trial
+                 call of a half-open breaker.
+    """
+    def call(request):
+        if wait is not None:
+            wait(request)
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpen('The circuit breaker of the gateway is open')
+        start = time.time()
+        try:
+            result = method(request)
+        except Exception:
+            if breaker is not None:
+                breaker.record(False, time.time() - start)
+            raise
+        if breaker is not None:
+            breaker.record(True, time.time() - start)
+        return result
+    return call
+
+
+class PaymentGatewayAsync:
+    "Concurrency of the calls to the provider of the gateway"
+    __name__ = 'payment_gateway.gateway'
+
+    concurrency = fields.Integer(
+        'Concurrency',
+        help='Number of calls made at once to the provider when a batch of '
+        'transactions is authorized or captured. Leave empty to make them '
+        'one after the other.'
+    )
+
+
+class PaymentTransactionAsync:
+    "Run the concurrent provider calls of the batches"
+    __name__ = 'payment_gateway.transaction'
+
+    @classmethod
+    @ModelView.button
+    def authorize(cls, transactions):
+        transactions = cls.call_provider_async('authorize', transactions)
+        super(PaymentTransactionAsync, cls).authorize(transactions)
+
+    @classmethod
+    @ModelView.button
+    def capture(cls, transactions):
+        transactions = cls.call_provider_async('capture', transactions)
+        super(PaymentTransactionAsync, cls).capture(transactions)
+
+    def get_provider_request(self):
+        """
+        Return the dictionary given to the `<verb>_<provider>_async`
+        methods. Providers extend it with what they need from the ORM, like
+        the credentials of the gateway.
+        """
+        return {
+            'id': self.id,
+            'uuid': self.uuid,
+            'description': self.description,
+            'amount': self.amount,
+            'currency': self.currency.code,
+            'provider_reference': self.provider_reference,
+            'payment_profile': (
+                self.payment_profile.provider_reference
+                if self.payment_profile else None
+            ),
+        }
+
+    @classmethod
+    def call_provider_async(cls, verb, transactions):
+        """
+        Call the provider of the gateways which set a concurrency through
+        their `<verb>_<provider>_async` method
+
+        :return: The transactions which remain to process synchronously
+        """
+        by_gateway = {}
+        remaining = []
+        for transaction in transactions:
+            gateway = transaction.gateway
+            if (transaction.state == 'draft' and gateway.concurrency and
+                    hasattr(cls, '%s_%s_async' % (verb, gateway.provider))):
+                by_gateway.setdefault(gateway, []).append(transaction)
+            else:
+                remaining.append(transaction)
+
+        for gateway, gateway_transactions in by_gateway.iteritems():
+            keys, replayed = cls.get_idempotency_keys(
+                verb, gateway_transactions)
+            to_call = [t for t in gateway_transactions if t.id not in replayed]
+            requests = []
+            for transaction in to_call:
+                request = transaction.get_provider_request()
+                request['idempotency_key'] = keys[transaction.id]
+                requests.append(request)
+            call = guarded_call(
+                getattr(cls, '%s_%s_async' % (verb, gateway.provider)),
+                breaker=gateway.get_circuit_breaker(),
+                wait=cls._get_rate_limit_wait(gateway, requests),
+            )
+            results = zip(
+                to_call,
+                run_concurrently(call, requests, gateway.concurrency)
+            )
+            cls.store_idempotency_results(keys, results)
+            cls.apply_provider_results(verb, results + [
+                (t, (replayed[t.id], None)) for t in gateway_transactions
+                if t.id in replayed
+            ])
+        return remaining
+
+    @classmethod
+    def _get_rate_limit_wait(cls, gateway, requests):
+        """
+        Return the function waiting in the workers for the turn of the
+        requests under the rate limit of the gateway or None
+
+        The tokens of a shared bucket are stored in the database, so they
+        are reserved here, one per request, and the workers wait until the
+        time of their token.
+        """
+        bucket = gateway.get_token_bucket()
+        if bucket is None:
+            return None
+        timeout = gateway.rate_limit_timeout
+        if not (gateway.rate_limit_shared and
+                backend.name() == 'postgresql'):
+            return lambda request: bucket.take(timeout)
+
+        start_at = {}
+        for request in requests:
+            try:
+                start_at[request['id']] = (
+                    time.time() + gateway._reserve_shared_token())
+            except RateLimitTimeout, exception:
+                start_at[request['id']] = exception
+
+        def wait(request):
+            value = start_at[request['id']]
+            if isinstance(value, RateLimitTimeout):
+                raise value
+            delay = max(value - time.time(), 0)
+            if delay:
+                bucket.sleep(delay)
+            bucket.record(delay)
+        return wait
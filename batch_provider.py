@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Batch provider calls
+
+    Many acquirers accept hundreds of authorizations or captures in one
+    request. A provider can implement for `authorize` and `capture` the
+    classmethod
+
+    .. code-block:: python
+
+        @classmethod
+        def capture_<provider>_many(cls, transactions):
+            ...
+            return [{'state': 'completed'}, {'state': 'failed', ...}, ...]
+
+    which returns one result per transaction, in the same order, as
+    described in :meth:`PaymentTransaction.call_provider_many`. An error of
+    the provider or of the network fails all the transactions of the call.
+    A call refused by the circuit breaker of the gateway follows its mode
+    like the synchronous calls: the batch fails or the charges are queued.
+
+    When a gateway sets a `batch_size`, the `authorize` and `capture`
+    batches of its transactions are sent in chunks of at most that size.
+    Providers override :meth:`PaymentGateway.get_batch_size` to apply the
+    limits of their API. The gateways which do not set it or whose
+    provider has no batch method are called one transaction at a time.
+'''
+import socket
+import httplib
+
+from trytond.exceptions import UserError
+from trytond.model import ModelView, fields
+from trytond.pool import PoolMeta
+
+__all__ = ['PaymentGatewayBatch', 'PaymentTransactionBatch']
+__metaclass__ = PoolMeta
+
+# The errors which fail the transactions of a call, the other ones are bugs
+# and abort the batch
+PROVIDER_ERRORS = (UserError, socket.error, httplib.HTTPException)
+
+
+class PaymentGatewayBatch:
+    "Batch size of the calls to the provider of the gateway"
+    __name__ = 'payment_gateway.gateway'
+
+    batch_size = fields.Integer(
+        'Batch Size',
+        help='Maximum number of transactions sent in one call to the '
+        'provider. Leave empty to send them one by one.'
+    )
+
+    def get_batch_size(self, verb):
+        """
+        Return the maximum number of transactions sent in one `verb` call
+        to the provider or None if they are sent one by one
+        """
+        return self.batch_size or None
+
+
+class PaymentTransactionBatch:
+    "Send the batches to the provider in chunks"
+    __name__ = 'payment_gateway.transaction'
+
+    @classmethod
+    @ModelView.button
+    def authorize(cls, transactions):
+        transactions = cls.call_provider_batch('authorize', transactions)
+        super(PaymentTransactionBatch, cls).authorize(transactions)
+
+    @classmethod
+    @ModelView.button
+    def capture(cls, transactions):
+        transactions = cls.call_provider_batch('capture', transactions)
+        super(PaymentTransactionBatch, cls).capture(transactions)
+
+    @classmethod
+    def call_provider_batch(cls, verb, transactions):
+        """
+        Call the `<verb>_<provider>_many` method of the gateways which set
+        a batch size on chunks of the draft transactions
+
+        :return: The transactions which remain to process one by one
+        """
+        by_gateway = {}
+        remaining = []
+        for transaction in transactions:
+            gateway = transaction.gateway
+            method_name = '%s_%s_many' % (verb, gateway.provider)
+            if (transaction.state == 'draft' and
+                    gateway.get_batch_size(verb) and
+                    hasattr(cls, method_name)):
+                by_gateway.setdefault(gateway, []).append(transaction)
+            else:
+                remaining.append(transaction)
+
+        for gateway, gateway_transactions in by_gateway.iteritems():
+            method_name = '%s_%s_many' % (verb, gateway.provider)
+            size = gateway.get_batch_size(verb)
+            for i in xrange(0, len(gateway_transactions), size):
+                chunk = gateway_transactions[i:i + size]
+                cls.apply_provider_results(
+                    verb, zip(chunk, cls._call_batch(method_name, chunk))
+                )
+        return remaining
+
+    @classmethod
+    def _call_batch(cls, method_name, transactions):
+        """
+        Return the list of (result, exception) of the transactions
+        """
+        try:
+            results = cls.call_provider_many(method_name, transactions)
+        except PROVIDER_ERRORS, exception:
+            return [(None, exception)] * len(transactions)
+        return [(result, None) for result in results]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput of the provider calls made one after the other, like the
+`capture_<provider>` methods, against the concurrent calls of the
+`capture_<provider>_async` contract, using the local stand-in server of
+the dummy provider
+
+Usage::
+
+    python benchmarks/bench_async_provider.py [calls] [latency in ms] \\
+        [concurrency]
+"""
+import sys
+import time
+
+from trytond.modules.payment_gateway.async_provider import run_concurrently
+from trytond.modules.payment_gateway.dummy_server import DummyProviderServer
+from trytond.modules.payment_gateway.http_client import ProviderClient
+
+
+def main(count=200, latency=20, concurrency=32):
+    server = DummyProviderServer(latency=latency / 1000.0)
+    server.start()
+    client = ProviderClient(server.url, timeout=5, maxsize=concurrency)
+
+    def capture(index):
+        return client.request('POST', '/capture', '{"id": %d}' % index)
+
+    try:
+        start = time.time()
+        for index in xrange(count):
+            capture(index)
+        sync_duration = time.time() - start
+
+        start = time.time()
+        run_concurrently(capture, range(count), concurrency)
+        async_duration = time.time() - start
+    finally:
+        client.close()
+        server.stop()
+
+    for name, duration in (
+            ('sync', sync_duration),
+            ('concurrent (%d)' % concurrency, async_duration)):
+        print '%-18s %8.0f calls/s %8.3f s' % (name, count / duration, duration)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:4]))
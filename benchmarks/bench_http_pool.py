@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the pooled provider HTTP client against a new connection per
+call, using the local stand-in server of the dummy provider
+
+Usage::
+
+    python benchmarks/bench_http_pool.py [number of calls] [latency in ms]
+"""
+import os
+import sys
+import time
+import httplib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from dummy_server import DummyProviderServer  # noqa
+from http_client import ProviderClient  # noqa
+
+
+def new_connection_calls(server, count):
+    host, port = server.server_address
+    for _ in xrange(count):
+        connection = httplib.HTTPConnection(host, port, timeout=5)
+        connection.request(
+            'POST', '/capture', '{}', {'Connection': 'close'}
+        )
+        connection.getresponse().read()
+        connection.close()
+
+
+def pooled_calls(server, count):
+    client = ProviderClient(server.url, timeout=5)
+    for _ in xrange(count):
+        client.request('POST', '/capture', '{}')
+    client.close()
+
+
+def main(count=2000, latency=0):
+    server = DummyProviderServer(latency=latency / 1000.0)
+    server.start()
+    try:
+        for name, function in (
+                ('new connection per call', new_connection_calls),
+                ('pooled client', pooled_calls)):
+            connections = server.counters['connections']
+            start = time.time()
+            function(server, count)
+            duration = time.time() - start
+            print '%-24s %8.0f calls/s %8.3f ms/call %6d connections' % (
+                name, count / duration, duration * 1000 / count,
+                server.counters['connections'] - connections
+            )
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:3]))
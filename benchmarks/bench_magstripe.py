@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the magnetic stripe parser
+
+The legacy regular expression only matches Track 1, without checking the
+LRC, the Luhn digit or Track 2 like the parser does, so it remains the
+lower bound.
+
+Usage::
+
+    python benchmarks/bench_magstripe.py [number of swipes]
+"""
+import os
+import re
+import sys
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import magstripe  # noqa
+
+# The Track 1 only regular expression used before the parser existed
+LEGACY_TRACK1_RE = re.compile(
+    r'^%(?P<FC>\w)(?P<PAN>\d+)\^(?P<NAME>.{2,26})\^(?P<YY>\d{2})'
+    r'(?P<MM>\d{2})(?P<SC>\d{0,3}|\^)(?P<DD>.*)\?$'
+)
+
+
+def legacy_parse(data):
+    try:
+        track1, track2 = data.split(';')
+    except ValueError:
+        return None
+    return LEGACY_TRACK1_RE.match(track1)
+
+
+def luhn_number(prefix, length=16):
+    digits = prefix + ''.join(
+        random.choice('0123456789') for _ in range(length - len(prefix) - 1)
+    )
+    for check in '0123456789':
+        if magstripe.luhn_valid(digits + check):
+            return digits + check
+
+
+def make_swipes(count):
+    swipes = []
+    for index in range(count):
+        pan = luhn_number(random.choice(['4', '51', '37', '6011']))
+        yymm = '%02d%02d' % (random.randint(18, 30), random.randint(1, 12))
+        track1 = '%%B%s^DOE/JOHN %d^%s101000000000?' % (pan, index, yymm)
+        track2 = ';%s=%s1010000000000?' % (pan, yymm)
+        swipes.append(
+            track1 + magstripe.lrc(track1, 1) +
+            track2 + magstripe.lrc(track2, 2)
+        )
+    return swipes
+
+
+def main(count=100000):
+    swipes = make_swipes(count)
+    legacy = [s.replace('?' + s[s.index('?') + 1], '?', 1) for s in swipes]
+
+    for label, func, data in (
+            ('legacy track1 regex', lambda: map(legacy_parse, legacy), legacy),
+            ('magstripe.parse_many', lambda: magstripe.parse_many(swipes),
+             swipes)):
+        seconds = min(timeit.repeat(func, number=1, repeat=3))
+        print('%-22s %8d swipes %8.3fs %10.0f swipes/s' % (
+            label, len(data), seconds, len(data) / seconds
+        ))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
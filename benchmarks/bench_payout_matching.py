@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Time of the search of the transactions covered by a payout: the runs of
+consecutive days on a month of transactions, and the subset sum on the
+transactions of a day
+
+Usage::
+
+    python benchmarks/bench_payout_matching.py [transactions per day] \\
+        [days]
+"""
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from payout import find_day_run, find_subset_sum  # noqa
+
+
+def main(per_day=2000, days=30):
+    generator = random.Random(42)
+    amounts = [
+        [generator.randint(100, 50000) for _ in xrange(per_day)]
+        for _ in xrange(days)
+    ]
+    totals = [
+        (day, sum(day_amounts)) for day, day_amounts in enumerate(amounts)
+    ]
+
+    # A payout of a week, less 2% of fees
+    week = sum(total for _, total in totals[10:17])
+    start = time.time()
+    run = find_day_run(totals, week * 98 / 100, week)
+    run_duration = time.time() - start
+    assert run is not None
+
+    # A payout of some transactions of a day
+    candidates = amounts[0][:500]
+    chosen = generator.sample(xrange(len(candidates)), 40)
+    target = sum(candidates[i] for i in chosen)
+    start = time.time()
+    subset = find_subset_sum(candidates, target, target)
+    subset_duration = time.time() - start
+    assert subset is not None
+
+    print '%-32s %8.3f s' % (
+        'day runs (%d transactions)' % (per_day * days), run_duration)
+    print '%-32s %8.3f s' % (
+        'subset sum (%d transactions)' % len(candidates), subset_duration)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:3]))
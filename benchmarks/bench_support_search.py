@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Time of the searches of the customer support on a large table of
+transactions
+
+The `--generate` option first inserts synthetic transactions (PostgreSQL
+only) copied from a transaction of the database, spread over the parties
+and the two last years, with varied last four digits, amounts and
+descriptions (the daily summary is not updated, rebuild it afterwards if
+needed). Then the criteria of random transactions are searched with
+`search_support` and the median, 95th percentile and maximum times are
+printed for each kind of search.
+
+The changes are rolled back unless `--commit` is given, so generate and
+commit once, then run the searches.
+
+Usage::
+
+    python benchmarks/bench_support_search.py [-c trytond.conf] database \\
+        --generate 10000000 --commit
+    python benchmarks/bench_support_search.py [-c trytond.conf] database \\
+        [--lookups 200]
+"""
+import time
+import random
+import argparse
+from datetime import timedelta
+
+GENERATE = '''
+INSERT INTO payment_gateway_transaction (
+    uuid, type, date, company, amount, currency, gateway, party, address,
+    credit_account, state, last_four_digits, description, create_uid,
+    create_date)
+SELECT
+    md5(t.uuid || s.i::text), t.type,
+    CURRENT_DATE - (s.i %% 730), t.company, 1 + (s.i * 7919) %% 100000 / 100.0,
+    t.currency, t.gateway, p.ids[1 + s.i %% array_length(p.ids, 1)],
+    t.address, t.credit_account, 'posted',
+    lpad(((s.i * 104729) %% 10000)::text, 4, '0'),
+    'Order SO-' || s.i::text, t.create_uid, CURRENT_TIMESTAMP
+FROM generate_series(1, %s) AS s(i),
+    (SELECT * FROM payment_gateway_transaction WHERE id = %s) AS t,
+    (SELECT array_agg(id) AS ids FROM party_party) AS p
+'''
+
+
+def generate(pool, count):
+    PaymentTransaction = pool.get('payment_gateway.transaction')
+
+    from trytond import backend
+    from trytond.transaction import Transaction
+
+    assert backend.name() == 'postgresql', 'PostgreSQL only'
+    template, = PaymentTransaction.search([], limit=1, order=[('id', 'ASC')])
+    cursor = Transaction().connection.cursor()
+    start = time.time()
+    cursor.execute(GENERATE, (count, template.id))
+    cursor.execute('ANALYZE payment_gateway_transaction')
+    print '%d transactions generated in %.0f s' % (
+        count, time.time() - start)
+
+
+def get_samples(pool, lookups):
+    """
+    Return random transactions, picked by id
+    """
+    PaymentTransaction = pool.get('payment_gateway.transaction')
+
+    from trytond.transaction import Transaction
+
+    cursor = Transaction().connection.cursor()
+    cursor.execute(
+        'SELECT MIN(id), MAX(id) FROM "%s"' % PaymentTransaction._table
+    )
+    low, high = cursor.fetchone()
+    ids = random.sample(xrange(low, high + 1), min(lookups, high - low + 1))
+    return PaymentTransaction.search([('id', 'in', ids)])
+
+
+def get_searches(transaction):
+    week = timedelta(days=7)
+    return [
+        ('card and dates', {
+            'last_four_digits': transaction.last_four_digits,
+            'start_date': transaction.date - week,
+            'end_date': transaction.date + week,
+        }),
+        ('amount and dates', {
+            'amount': transaction.amount,
+            'start_date': transaction.date - week,
+            'end_date': transaction.date + week,
+        }),
+        ('party name', {
+            'party_name': transaction.party.name,
+        }),
+        ('description', {
+            'description': (transaction.description or '')[-6:],
+        }),
+    ]
+
+
+def run(pool, lookups):
+    PaymentTransaction = pool.get('payment_gateway.transaction')
+
+    durations = {}
+    for transaction in get_samples(pool, lookups):
+        for name, criteria in get_searches(transaction):
+            start = time.time()
+            PaymentTransaction.search_support(**criteria)
+            durations.setdefault(name, []).append(
+                (time.time() - start) * 1000
+            )
+    print '%-18s %8s %8s %8s %8s' % (
+        'search', 'count', 'p50 ms', 'p95 ms', 'max ms')
+    for name, values in sorted(durations.iteritems()):
+        values.sort()
+        print '%-18s %8d %8.1f %8.1f %8.1f' % (
+            name, len(values), values[len(values) // 2],
+            values[int(len(values) * 0.95)], values[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', dest='config')
+    parser.add_argument('database')
+    parser.add_argument('--generate', type=int, default=0)
+    parser.add_argument('--lookups', type=int, default=200)
+    parser.add_argument('--commit', action='store_true')
+    options = parser.parse_args()
+
+    from trytond.config import config
+    config.update_etc(options.config)
+
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    pool = Pool(options.database)
+    pool.init()
+    with Transaction().start(options.database, 0) as transaction:
+        user, = pool.get('res.user').search([('login', '=', 'admin')])
+        with transaction.set_user(user.id), transaction.set_context(
+                company=user.company and user.company.id):
+            if options.generate:
+                generate(pool, options.generate)
+            else:
+                run(pool, options.lookups)
+        if not options.commit:
+            transaction.rollback()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Insert throughput and size of the index of the uuid of the transactions
+with random (uuid4) and time ordered (uuid7) uuids
+
+Each mode fills its own table, with an index on the uuid like
+`payment_gateway_transaction`, by batches of one commit. The rate of the
+last batches shows the cost of inserting in a large index. The database is
+a temporary SQLite file, or PostgreSQL with `--dsn` (psycopg2 required).
+
+Usage::
+
+    python benchmarks/bench_uuid_index.py [--rows 1000000] \\
+        [--batch 10000] [--dsn 'dbname=bench']
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from uuids import generate_uuid  # noqa
+
+
+class SQLiteDatabase(object):
+    param = '?'
+
+    def __init__(self):
+        import sqlite3
+        self.directory = tempfile.mkdtemp()
+        self.connection = sqlite3.connect(
+            os.path.join(self.directory, 'bench.db')
+        )
+
+    def index_size(self, name):
+        cursor = self.connection.cursor()
+        cursor.execute(
+            'SELECT SUM(pgsize) FROM dbstat WHERE name = ?', (name,)
+        )
+        return cursor.fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+        shutil.rmtree(self.directory)
+
+
+class PostgreSQLDatabase(object):
+    param = '%s'
+
+    def __init__(self, dsn):
+        import psycopg2
+        self.connection = psycopg2.connect(dsn)
+
+    def index_size(self, name):
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT pg_relation_size(%s)', (name,))
+        return cursor.fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+def fill(database, kind, rows, batch):
+    """
+    Insert `rows` transactions with the `kind` of uuid and return the
+    rates of insertion of all the rows and of the last tenth
+    """
+    table = 'bench_%s' % kind
+    cursor = database.connection.cursor()
+    cursor.execute('DROP TABLE IF EXISTS %s' % table)
+    cursor.execute(
+        'CREATE TABLE %s (id INTEGER PRIMARY KEY, uuid VARCHAR NOT NULL, '
+        'amount NUMERIC)' % table
+    )
+    cursor.execute('CREATE INDEX %s_uuid_index ON %s (uuid)' % (table, table))
+    database.connection.commit()
+
+    query = 'INSERT INTO %s (id, uuid, amount) VALUES (%s, %s, %s)' % (
+        (table,) + (database.param,) * 3)
+    tail_offset = rows - max(rows // 10, 1)
+    start = tail_start = time.time()
+    for offset in xrange(0, rows, batch):
+        if offset <= tail_offset:
+            tail_start, tail_rows = time.time(), rows - offset
+        cursor.executemany(query, [
+            (i, generate_uuid(kind), i % 1000)
+            for i in xrange(offset, min(offset + batch, rows))
+        ])
+        database.connection.commit()
+    end = time.time()
+    return (
+        rows / (end - start),
+        tail_rows / (end - tail_start),
+        database.index_size('%s_uuid_index' % table),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--batch', type=int, default=10000)
+    parser.add_argument('--dsn')
+    options = parser.parse_args()
+
+    if options.dsn:
+        database = PostgreSQLDatabase(options.dsn)
+    else:
+        database = SQLiteDatabase()
+    try:
+        print '%-6s %14s %16s %12s' % (
+            'uuid', 'rows/s', 'last 10% rows/s', 'index MB')
+        for kind in ('uuid4', 'uuid7'):
+            rate, tail_rate, size = fill(
+                database, kind, options.rows, options.batch
+            )
+            print '%-6s %14.0f %16.0f %12.1f' % (
+                kind, rate, tail_rate, size / 1024.0 / 1024)
+    finally:
+        database.close()
+
+
+if __name__ == '__main__':
+    main()
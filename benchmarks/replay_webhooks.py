@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Replay recorded webhook events of a gateway and measure the throughput of
+their ingestion and processing
+
+The file has one event per line, as a JSON object with the keys of
+`WebhookEvent.ingest` (`occurred` in any ISO 8601 format). The `generate`
+command writes a file of `settled` events for the authorized transactions
+of the gateway which have a provider reference.
+
+The changes are rolled back unless `--commit` is given.
+
+Usage::
+
+    python benchmarks/replay_webhooks.py [-c trytond.conf] database \\
+        gateway_id events.jsonl [--batch 500] [--commit]
+    python benchmarks/replay_webhooks.py [-c trytond.conf] database \\
+        gateway_id events.jsonl --generate
+"""
+import json
+import time
+import argparse
+from datetime import datetime
+from itertools import islice
+
+
+def read_events(gateway, path):
+    # Parse like the JSON webhooks, `occurred` in any ISO 8601 format
+    with open(path) as events_file:
+        for line in events_file:
+            line = line.strip()
+            if not line:
+                continue
+            event, = gateway.parse_webhook_json('[%s]' % line)
+            event['payload'] = line
+            yield event
+
+
+def generate(pool, gateway, path):
+    PaymentTransaction = pool.get('payment_gateway.transaction')
+
+    transactions = PaymentTransaction.search([
+        ('gateway', '=', gateway.id),
+        ('state', '=', 'authorized'),
+        ('provider_reference', '!=', None),
+    ])
+    with open(path, 'w') as events_file:
+        for transaction in transactions:
+            events_file.write(json.dumps({
+                'id': 'evt_%s' % transaction.uuid,
+                'type': 'settled',
+                'provider_reference': transaction.provider_reference,
+                'occurred': datetime.utcnow().strftime(
+                    '%Y-%m-%dT%H:%M:%S.%f'),
+            }) + '\n')
+    print '%d events written to %s' % (len(transactions), path)
+
+
+def replay(pool, gateway, path, batch):
+    WebhookEvent = pool.get('payment_gateway.webhook_event')
+
+    events = read_events(gateway, path)
+    received = 0
+    start = time.time()
+    while True:
+        chunk = list(islice(events, batch))
+        if not chunk:
+            break
+        received += len(WebhookEvent.ingest(gateway, chunk))
+    ingest_duration = time.time() - start
+
+    start = time.time()
+    processed = WebhookEvent.process(chunk_size=batch, limit=received)
+    process_duration = time.time() - start
+
+    for name, count, duration in (
+            ('ingest', received, ingest_duration),
+            ('process', processed, process_duration)):
+        print '%-8s %8d events %8.0f events/s %8.3f s' % (
+            name, count, count / duration if duration else 0, duration)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', dest='config')
+    parser.add_argument('database')
+    parser.add_argument('gateway', type=int)
+    parser.add_argument('path')
+    parser.add_argument('--batch', type=int, default=500)
+    parser.add_argument('--commit', action='store_true')
+    parser.add_argument('--generate', action='store_true')
+    options = parser.parse_args()
+
+    from trytond.config import config
+    config.update_etc(options.config)
+
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    pool = Pool(options.database)
+    pool.init()
+    with Transaction().start(options.database, 0) as transaction:
+        user, = pool.get('res.user').search([('login', '=', 'admin')])
+        with transaction.set_user(user.id), transaction.set_context(
+                company=user.company and user.company.id):
+            gateway = pool.get('payment_gateway.gateway')(options.gateway)
+            if options.generate:
+                generate(pool, gateway, options.path)
+            else:
+                replay(pool, gateway, options.path, options.batch)
+        if not options.commit:
+            transaction.rollback()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+'''
+
+    In-process credit card data
+
+    Tryton persists the values of every wizard view into the
+    `ir.session.wizard` table between steps. Confidential card information
+    (the card number, security code and raw swipe data) must never end up
+    there, so the wizards of this module move it into a :class:`CardData`
+    holder which lives only in the memory of the server process.
+
+    When a wizard spans several steps the holder is parked in the
+    process wide :data:`card_data_store`, keyed by the database and the
+    wizard session, and is evicted after a short time to live.
+'''
+import time
+import threading
+from collections import OrderedDict
+
+__all__ = ['CardData', 'CardDataStore', 'card_data_store']
+
+CARD_DATA_TTL = 300
+CARD_DATA_MAX_ENTRIES = 10000
+
+
+class CardData(object):
+    """
+    A compact holder for the card information entered in a wizard.
+
+    It exposes the same attributes as the credit card views so that it can
+    be passed to the `authorize_<provider>` and `capture_<provider>` methods
+    in place of the view itself.
+    """
+    __slots__ = (
+        'card_present', 'swipe_data', 'owner', 'number',
+        'expiry_month', 'expiry_year', 'csc',
+    )
+
+    #: Attributes which must never be stored outside of process memory
+    sensitive_fields = ('swipe_data', 'number', 'csc')
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.pop(name, None))
+        if kwargs:
+            raise TypeError(
+                'Unexpected card attributes: %s' % ', '.join(sorted(kwargs))
+            )
+
+    @classmethod
+    def from_view(cls, view):
+        """
+        Build a holder from a view using `BaseCreditCardViewMixin`
+
+        :param view: Instance of the credit card view
+        :return: Instance of CardData
+        """
+        return cls(**dict(
+            (name, getattr(view, name, None)) for name in cls.__slots__
+        ))
+
+    @property
+    def last_4_digits(self):
+        if self.number:
+            return self.number[-4:]
+
+    def clear(self):
+        """
+        Forget the sensitive information held by this instance
+        """
+        for name in self.sensitive_fields:
+            setattr(self, name, None)
+
+    def __repr__(self):
+        # Never leak the card number into logs or tracebacks
+        return '<CardData xxxx%s %s/%s>' % (
+            self.last_4_digits or '', self.expiry_month, self.expiry_year
+        )
+
+
+class CardDataStore(object):
+    """
+    A thread safe store of :class:`CardData` which evicts entries after
+    `ttl` seconds and never holds more than `max_entries` of them.
+    """
+
+    def __init__(self, ttl=CARD_DATA_TTL, max_entries=CARD_DATA_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        """
+        Remove the expired entries. The caller must hold the lock.
+
+        Entries are kept in insertion order and share the same time to live
+        so the scan can stop at the first entry which is still alive.
+        """
+        while self._entries:
+            key, (expire, card) = next(self._entries.iteritems())
+            if expire > now and len(self._entries) <= self.max_entries:
+                break
+            del self._entries[key]
+            card.clear()
+
+    def put(self, key, card):
+        """
+        Store `card` under `key`, replacing and refreshing any existing entry
+        """
+        now = time.time()
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None and old[1] is not card:
+                old[1].clear()
+            self._entries[key] = (now + self.ttl, card)
+            self._evict(now)
+
+    def get(self, key):
+        """
+        Return the card stored under `key` or None if missing or expired
+        """
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry[1]
+
+    def pop(self, key):
+        """
+        Remove and return the card stored under `key`
+        """
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                return entry[1]
+
+    def __len__(self):
+        with self._lock:
+            self._evict(time.time())
+            return len(self._entries)
+
+
+card_data_store = CardDataStore()
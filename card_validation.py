@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Local credit card number validation
+
+    Sending a malformed card number to a payment provider costs a network
+    round trip and often a gateway fee, only to learn that the number is
+    wrong. This module checks the number locally before that:
+
+        * only digits (spaces and dashes are ignored),
+        * the Luhn check digit,
+        * the card scheme, detected from the issuer identification number
+          (BIN) ranges bundled in `data/bin_ranges.csv`, and the lengths
+          allowed for that scheme.
+
+    .. code-block:: python
+
+        validate('4111 1111 1111 1111')     # 'visa'
+        validate_many(numbers)              # [('visa', None), ...]
+'''
+import os
+import threading
+
+from .magstripe import luhn_valid
+
+__all__ = [
+    'ERRORS', 'CardValidationError', 'BinTable', 'get_bin_table',
+    'clean_number', 'check', 'validate', 'validate_many',
+]
+
+BIN_RANGES_FILE = os.path.join(
+    os.path.dirname(__file__), 'data', 'bin_ranges.csv'
+)
+# Lengths accepted for cards whose scheme is not in the table
+DEFAULT_LENGTHS = frozenset(range(12, 20))
+
+ERRORS = {
+    'card_number_not_digits': 'The card number must contain only digits.',
+    'card_number_length': 'The card number has an invalid length.',
+    'card_number_luhn': 'The card number is invalid.',
+}
+
+
+class CardValidationError(ValueError):
+    "Raised when a card number fails the local validation"
+
+
+class BinTable(object):
+    """
+    A prefix index of the BIN ranges.
+
+    Every range is expanded into the prefixes it covers and stored in a
+    dictionary, so a lookup costs at most one dictionary access per digit
+    of the longest prefix, whatever the size of the table.
+    """
+
+    def __init__(self, ranges=()):
+        self.prefixes = {}
+        self.max_prefix = 0
+        for scheme, first, last, lengths in ranges:
+            self.add_range(scheme, first, last, lengths)
+
+    def add_range(self, scheme, first, last, lengths):
+        """
+        Add the prefixes from `first` to `last` (both strings of digits of
+        the same size) for `scheme` which allows card numbers of `lengths`
+        """
+        if len(first) != len(last) or first > last:
+            raise ValueError('Invalid BIN range %s-%s' % (first, last))
+        entry = (scheme, frozenset(lengths))
+        width = len(first)
+        for prefix in xrange(int(first), int(last) + 1):
+            self.prefixes['%0*d' % (width, prefix)] = entry
+        self.max_prefix = max(self.max_prefix, width)
+
+    @classmethod
+    def from_file(cls, path=BIN_RANGES_FILE):
+        """
+        Load the table from a file with lines of the form
+        `scheme,first prefix,last prefix,lengths separated by spaces`.
+        Empty lines and lines starting with `#` are ignored.
+        """
+        ranges = []
+        with open(path) as bin_file:
+            for line in bin_file:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                scheme, first, last, lengths = line.split(',')
+                ranges.append(
+                    (scheme, first, last, map(int, lengths.split()))
+                )
+        return cls(ranges)
+
+    def lookup(self, number):
+        """
+        Return a tuple of (scheme, allowed lengths) for the longest prefix
+        of `number` in the table or None
+        """
+        prefixes = self.prefixes
+        for size in xrange(min(self.max_prefix, len(number)), 0, -1):
+            entry = prefixes.get(number[:size])
+            if entry is not None:
+                return entry
+
+    def lookup_many(self, numbers):
+        """
+        Lookup several numbers at once. Cards of a batch often share their
+        BIN, so the result is memoized on the longest prefix.
+        """
+        memo = {}
+        lookup = self.lookup
+        max_prefix = self.max_prefix
+        result = []
+        append = result.append
+        for number in numbers:
+            key = number[:max_prefix]
+            try:
+                append(memo[key])
+            except KeyError:
+                entry = memo[key] = lookup(key)
+                append(entry)
+        return result
+
+
+_bin_table = None
+_bin_table_lock = threading.Lock()
+
+
+def get_bin_table():
+    """
+    Return the table loaded from the bundled BIN ranges file. It is loaded
+    once per process.
+    """
+    global _bin_table
+    if _bin_table is None:
+        with _bin_table_lock:
+            if _bin_table is None:
+                _bin_table = BinTable.from_file()
+    return _bin_table
+
+
+def clean_number(number):
+    """
+    Return the card number without spaces and dashes
+    """
+    number = (number or '').replace(' ', '').replace('-', '')
+    if isinstance(number, unicode):
+        # Digits of other scripts are not valid in a card number
+        number = number.encode('ascii', 'replace')
+    return number
+
+
+def _check(number, entry):
+    if not number.isdigit():
+        return 'card_number_not_digits'
+    scheme, lengths = entry or (None, DEFAULT_LENGTHS)
+    if len(number) not in lengths:
+        return 'card_number_length'
+    if not luhn_valid(number):
+        return 'card_number_luhn'
+
+
+def check(number, table=None):
+    """
+    Validate a card number without raising an error
+
+    :param number: The card number
+    :param table: The BinTable to use, the bundled one by default
+    :return: A tuple of (scheme, error). The scheme is None if it is unknown
+             and the error, a key of `ERRORS`, is None if the number is
+             valid.
+    """
+    number = clean_number(number)
+    entry = (table or get_bin_table()).lookup(number)
+    return entry and entry[0], _check(number, entry)
+
+
+def validate(number, table=None):
+    """
+    Validate a card number
+
+    :param number: The card number
+    :param table: The BinTable to use, the bundled one by default
+    :return: The scheme of the card or None if it is unknown
+    :raises CardValidationError: If the number is invalid
+    """
+    scheme, error = check(number, table)
+    if error:
+        raise CardValidationError(ERRORS[error])
+    return scheme
+
+
+def validate_many(numbers, table=None):
+    """
+    Validate several card numbers at once
+
+    :param numbers: An iterable of card numbers
+    :param table: The BinTable to use, the bundled one by default
+    :return: A list of (scheme, error) tuples, see :func:`check`
+    """
+    numbers = map(clean_number, numbers)
+    entries = (table or get_bin_table()).lookup_many(numbers)
+    return [
+        (entry and entry[0], _check(number, entry))
+        for number, entry in zip(numbers, entries)
+    ]
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Circuit breaker of the gateways
+
+    When a provider degrades, every call waits for the full network timeout
+    and the worker threads of trytond pile up behind it. Each gateway can
+    enable a circuit breaker which watches the calls made to its provider
+    over a rolling window:
+
+        * `closed`: the calls go through. When the rate of failed or slow
+          calls in the window reaches the threshold, the breaker opens.
+        * `open`: the calls are not made. They fail immediately or, for
+          charges, are queued for the retry worker (see `retry.py`).
+        * `half_open`: once the open duration has elapsed, one trial call
+          goes through. The breaker closes if it succeeds and opens again
+          otherwise.
+
+    The breakers are kept in memory, so they are shared by the threads of a
+    process but each process has its own.
+'''
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from trytond.exceptions import UserError
+from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+
+__all__ = [
+    'CircuitOpen', 'CircuitBreaker', 'PaymentGatewayCircuitBreaker',
+    'PaymentTransactionCircuitBreaker',
+]
+__metaclass__ = PoolMeta
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+BREAKER_STATES = {
+    'invisible': ~Eval('breaker_error_rate', 0),
+}
+BREAKER_DEPENDS = ['breaker_error_rate']
+
+
+class CircuitOpen(UserError):
+    "Raised when the circuit breaker of the gateway refuses a call"
+
+
+class CircuitBreaker(object):
+    """
+    A thread-safe circuit breaker
+
+    :param error_rate: Percentage of failed calls in the window which opens
+                       the breaker
+    :param min_calls: Minimum number of calls in the window before the
+                      error rate is considered
+    :param window: Duration of the rolling window in seconds
+    :param open_duration: Seconds during which the breaker stays open
+    :param slow_call: Optional duration in seconds above which a successful
+                      call is counted as failed
+    """
+
+    def __init__(self, error_rate=50, min_calls=10, window=60,
+                 open_duration=30, slow_call=None, clock=time.time):
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_duration = open_duration
+        self.slow_call = slow_call
+        self.clock = clock
+        self.calls = deque()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self.lock:
+            return self._state()
+
+    def _state(self):
+        if self.opened_at is None:
+            return CLOSED
+        if self.clock() < self.opened_at + self.open_duration:
+            return OPEN
+        return HALF_OPEN
+
+    @property
+    def retry_at(self):
+        """
+        Return the time at which the breaker lets a trial call go through
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return self.clock()
+            return self.opened_at + self.open_duration
+
+    def allow(self):
+        """
+        Return True if a call can be made. In the half-open state only one
+        trial call is allowed at a time.
+        """
+        with self.lock:
+            state = self._state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def record(self, success, duration=0):
+        """
+        Record the result of a call which took `duration` seconds
+        """
+        if self.slow_call and duration > self.slow_call:
+            success = False
+        with self.lock:
+            now = self.clock()
+            if self.opened_at is not None:
+                if self.trial:
+                    # Result of the trial call
+                    self.trial = False
+                    if success:
+                        self._reset()
+                    else:
+                        self.opened_at = now
+                return
+
+            self.calls.append((now, success))
+            if not success:
+                self.failures += 1
+            while self.calls and self.calls[0][0] < now - self.window:
+                _, call_success = self.calls.popleft()
+                if not call_success:
+                    self.failures -= 1
+
+            if len(self.calls) >= self.min_calls and (
+                    self.failures * 100 >= self.error_rate * len(self.calls)):
+                self.opened_at = now
+
+    def reset(self):
+        """
+        Close the breaker and forget the calls
+        """
+        with self.lock:
+            self._reset()
+
+    def _reset(self):
+        self.calls.clear()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class PaymentGatewayCircuitBreaker:
+    "Circuit breaker settings of the gateway"
+    __name__ = 'payment_gateway.gateway'
+
+    breaker_error_rate = fields.Integer(
+        'Breaker Error Rate',
+        help='Percentage of failed or slow calls to the provider which '
+        'opens the circuit breaker. Leave empty to disable it.'
+    )
+    breaker_min_calls = fields.Integer(
+        'Breaker Minimum Calls', states=BREAKER_STATES,
+        depends=BREAKER_DEPENDS,
+        help='Number of calls in the window before the breaker can open'
+    )
+    breaker_window = fields.Integer(
+        'Breaker Window', states=BREAKER_STATES, depends=BREAKER_DEPENDS,
+        help='Duration in seconds of the window of calls considered'
+    )
+    breaker_slow_call = fields.Integer(
+        'Breaker Slow Call', states=BREAKER_STATES, depends=BREAKER_DEPENDS,
+        help='Milliseconds above which a call is counted as failed'
+    )
+    breaker_open_duration = fields.Integer(
+        'Breaker Open Duration', states=BREAKER_STATES,
+        depends=BREAKER_DEPENDS,
+        help='Seconds during which no call is made once the breaker opened'
+    )
+    breaker_mode = fields.Selection([
+        ('fail', 'Fail'),
+        ('queue', 'Queue'),
+    ], 'Breaker Mode', states=BREAKER_STATES, depends=BREAKER_DEPENDS,
+        help='Queue puts the charges made while the breaker is open in the '
+        'retry queue instead of failing them'
+    )
+    breaker_state = fields.Function(
+        fields.Selection([
+            (None, ''),
+            (CLOSED, 'Closed'),
+            (OPEN, 'Open'),
+            (HALF_OPEN, 'Half Open'),
+        ], 'Breaker State', states=BREAKER_STATES, depends=BREAKER_DEPENDS),
+        'get_breaker_state'
+    )
+
+    @staticmethod
+    def default_breaker_min_calls():
+        return 10
+
+    @staticmethod
+    def default_breaker_window():
+        return 60
+
+    @staticmethod
+    def default_breaker_open_duration():
+        return 30
+
+    @staticmethod
+    def default_breaker_mode():
+        return 'fail'
+
+    def get_breaker_state(self, name):
+        breaker = self.get_circuit_breaker()
+        return breaker.state if breaker else None
+
+    def get_circuit_breaker(self):
+        """
+        Return the circuit breaker of the gateway or None if it is disabled
+        """
+        if not self.breaker_error_rate:
+            return None
+        key = (Transaction().database.name, self.id)
+        breaker = _breakers.get(key)
+        if breaker is None:
+            with _breakers_lock:
+                breaker = _breakers.setdefault(key, CircuitBreaker())
+        # Follow the changes of the settings
+        breaker.error_rate = self.breaker_error_rate
+        breaker.min_calls = self.breaker_min_calls or 1
+        breaker.window = self.breaker_window or 60
+        breaker.open_duration = self.breaker_open_duration or 0
+        breaker.slow_call = (
+            self.breaker_slow_call / 1000.0 if self.breaker_slow_call else None
+        )
+        return breaker
+
+
+class PaymentTransactionCircuitBreaker:
+    "Guard the calls to the provider with the circuit breaker"
+    __name__ = 'payment_gateway.transaction'
+
+    @classmethod
+    def __setup__(cls):
+        super(PaymentTransactionCircuitBreaker, cls).__setup__()
+        cls._error_messages.update({
+            'circuit_open': 'The gateway "%s" is unavailable, '
+                            'try again later.',
+        })
+
+    def call_provider(self, method_name, *args, **kwargs):
+        breaker = self.gateway.get_circuit_breaker()
+        if breaker is None:
+            return super(PaymentTransactionCircuitBreaker, self).call_provider(
+                method_name, *args, **kwargs
+            )
+        if not breaker.allow():
+            return self._circuit_open(breaker, method_name)
+
+        start = time.time()
+        try:
+            result = super(
+                PaymentTransactionCircuitBreaker, self
+            ).call_provider(method_name, *args, **kwargs)
+        except Exception:
+            breaker.record(False, time.time() - start)
+            raise
+        breaker.record(True, time.time() - start)
+        return result
+
+    @classmethod
+    def call_provider_many(cls, method_name, transactions, *args, **kwargs):
+        breakers = set(filter(None, [
+            t.gateway.get_circuit_breaker() for t in transactions
+        ]))
+        if not breakers:
+            return super(
+                PaymentTransactionCircuitBreaker, cls
+            ).call_provider_many(method_name, transactions, *args, **kwargs)
+        breaker, = breakers
+        if not breaker.allow():
+            raise CircuitOpen(cls.raise_user_error(
+                'circuit_open', (transactions[0].gateway.rec_name,),
+                raise_exception=False
+            ))
+
+        start = time.time()
+        try:
+            result = super(
+                PaymentTransactionCircuitBreaker, cls
+            ).call_provider_many(method_name, transactions, *args, **kwargs)
+        except Exception:
+            breaker.record(False, time.time() - start)
+            raise
+        breaker.record(True, time.time() - start)
+        return result
+
+    @classmethod
+    def apply_provider_results(cls, verb, results):
+        """
+        Follow the mode of the circuit breaker of the gateway for the batch
+        and concurrent calls it refused, like the synchronous calls: the
+        batch fails or the charges are queued for the retry worker.
+        """
+        refused = [
+            t for t, (_, exception) in results
+            if isinstance(exception, CircuitOpen)
+        ]
+        for transaction in refused:
+            transaction._circuit_open(
+                transaction.gateway.get_circuit_breaker(), verb
+            )
+        super(PaymentTransactionCircuitBreaker, cls).apply_provider_results(
+            verb, [(t, r) for t, r in results if t not in refused]
+        )
+
+    def _circuit_open(self, breaker, method_name):
+        """
+        Queue the charge for a retry once the breaker lets calls through if
+        the gateway is in queue mode or fail immediately
+        """
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+
+        queue = (
+            self.gateway.breaker_mode == 'queue' and
+            self.type == 'charge' and
+            method_name.split('_', 1)[0] in ('capture', 'retry') and
+            hasattr(self, 'retry_%s' % self.gateway.provider)
+        )
+        if not queue:
+            self.raise_user_error('circuit_open', (self.gateway.rec_name,))
+
+        self.__class__.write([self], {'state': 'failed'})
+        self.__class__.write([self], {
+            'next_retry': datetime.utcfromtimestamp(breaker.retry_at),
+        })
+        TransactionLog.create([{
+            'transaction': self.id,
+            'log': 'Queued while the circuit breaker of the gateway is open',
+        }])
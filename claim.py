@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Claiming of transactions by workers
+
+    Batch jobs (polling, retries, posting, ...) may run on several trytond
+    workers at the same time. To split a backlog between them without
+    processing a transaction twice, a job claims the transactions it works
+    on with :meth:`claim`:
+
+        * the rows are selected with `FOR UPDATE SKIP LOCKED` on
+          PostgreSQL (see :func:`skip_locked`), so concurrent workers skip
+          the rows another worker is claiming instead of waiting for it,
+        * the claimed rows get a lease, so they are skipped by the other
+          workers until it expires even after the claiming transaction is
+          committed. The lease of a worker which died expires and the rows
+          are claimed again by another worker.
+
+    .. code-block:: python
+
+        transactions = PaymentTransaction.claim('completed', 100)
+        ...
+        PaymentTransaction.release(transactions)
+'''
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+
+from trytond import backend
+from trytond.model import fields
+from trytond.pool import PoolMeta
+from trytond.transaction import Transaction
+
+__all__ = ['PaymentTransactionClaim', 'skip_locked']
+__metaclass__ = PoolMeta
+
+CLAIM_LEASE = timedelta(minutes=5)
+
+
+def get_worker():
+    """
+    Return the name of the current worker
+    """
+    return '%s:%s:%s' % (
+        socket.gethostname(), os.getpid(), threading.current_thread().ident
+    )
+
+
+def skip_locked(query):
+    """
+    Return the SQL and the parameters of the query, which locks the rows it
+    selects and skips the rows locked by another transaction (PostgreSQL
+    only)
+    """
+    sql, params = tuple(query)
+    if backend.name() == 'postgresql':
+        sql += ' FOR UPDATE SKIP LOCKED'
+    return sql, params
+
+
+class PaymentTransactionClaim:
+    "Claim transactions for a worker"
+    __name__ = 'payment_gateway.transaction'
+
+    claimed_by = fields.Char('Claimed By', readonly=True)
+    claim_expires = fields.DateTime('Claim Expires', readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(PaymentTransactionClaim, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        table.index_action(['state', 'claim_expires'], 'add')
+
+    @classmethod
+    def copy(cls, records, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default.update({
+            'claimed_by': None,
+            'claim_expires': None,
+        })
+        return super(PaymentTransactionClaim, cls).copy(records, default)
+
+    @classmethod
+    def claim(cls, state, limit, lease=CLAIM_LEASE, where=None,
+              order_by=None, worker=None):
+        """
+        Claim up to `limit` transactions in `state` which are not claimed
+        by another worker.
+
+        :param state: The state of the transactions to claim
+        :param limit: The maximum number of transactions to claim
+        :param lease: The timedelta during which the transactions are
+                      reserved to the worker
+        :param where: Optional function which takes the transaction table
+                      and returns an additional SQL condition
+        :param order_by: Optional function which takes the transaction table
+                         and returns the list of SQL order expressions. The
+                         oldest transactions are claimed first by default.
+        :param worker: The name of the worker, the host, process and thread
+                       by default
+        :return: The list of claimed transactions
+        """
+        sql_table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        now = datetime.utcnow()
+
+        condition = (sql_table.state == state) & (
+            (sql_table.claim_expires == None) |  # noqa
+            (sql_table.claim_expires < now)
+        )
+        if where is not None:
+            condition &= where(sql_table)
+        if order_by is not None:
+            order = order_by(sql_table)
+        else:
+            order = [sql_table.date, sql_table.id]
+
+        query = sql_table.select(
+            sql_table.id, where=condition, order_by=order, limit=limit
+        )
+        cursor.execute(*skip_locked(query))
+        transactions = cls.browse([id_ for id_, in cursor.fetchall()])
+        if transactions:
+            cls.write(transactions, {
+                'claimed_by': worker or get_worker(),
+                'claim_expires': now + lease,
+            })
+        return transactions
+
+    @classmethod
+    def release(cls, transactions):
+        """
+        Release the claim on the transactions
+        """
+        if transactions:
+            cls.write(list(transactions), {
+                'claimed_by': None,
+                'claim_expires': None,
+            })
+
+    @classmethod
+    def _post_completed_where(cls, table):
+        """
+        Return the SQL condition of the transactions posted by
+        :meth:`post_completed`
+        """
+        return table.type.in_(['charge', 'refund'])
+
+    @classmethod
+    def post_completed(cls, chunk_size=100, limit=1000):
+        """
+        Cron entry point which posts the completed transactions.
+
+        The transactions which cannot be posted keep their claim, so they
+        are tried again once their lease has expired.
+
+        :param chunk_size: Number of transactions claimed per batch
+        :param limit: Maximum number of transactions processed per run
+        :return: The number of transactions processed
+        """
+        processed = 0
+        while processed < limit:
+            transactions = cls.claim(
+                'completed', min(chunk_size, limit - processed),
+                where=cls._post_completed_where
+            )
+            if not transactions:
+                break
+            for transaction in transactions:
+                transaction.safe_post()
+            cls.release([
+                t for t in cls.browse([t.id for t in transactions])
+                if t.state != 'completed'
+            ])
+            processed += len(transactions)
+        return processed
@@ -20,7 +20,17 @@
                 'provider': 'dummy',
                 'method': 'credit_card',
             }])
+
+    To simulate a degraded provider, set 'dummy_error'=True in the context
+    to make every call raise an error and 'dummy_latency' to the number of
+    seconds every call should take. To go through the network, start a
+    :class:`~dummy_server.DummyProviderServer` and set 'dummy_server_url' to
+    its URL. With 'dummy_keep_state'=True, a successful authorization
+    leaves the new state to the workflow transition like some providers do.
 '''
+import json
+import time
+
 from trytond.pool import PoolMeta
 from trytond.transaction import Transaction
 
@@ -46,6 +56,12 @@ class PaymentGatewayDummy:
             rv.append(self_record)
         return rv
 
+    def parse_webhook_dummy(self, body):
+        """
+        The dummy provider sends a JSON list of events
+        """
+        return self.parse_webhook_json(body)
+
     def get_methods(self):
         if self.provider == 'dummy':
             return [
@@ -60,12 +76,42 @@ class DummyTransaction:
     """
     __name__ = 'payment_gateway.transaction'
 
+    def call_dummy(self, operation):
+        """
+        Simulate the call to the provider. If 'dummy_server_url' is in the
+        context, the call is made to that stand-in server.
+        """
+        context = Transaction().context
+        if context.get('dummy_latency'):
+            time.sleep(context['dummy_latency'])
+        if context.get('dummy_error'):
+            self.raise_user_error('The dummy provider is unavailable')
+        if context.get('dummy_server_url'):
+            client = self.gateway.get_http_client(context['dummy_server_url'])
+            headers = {'Content-Type': 'application/json'}
+            if context.get('idempotency_key'):
+                headers['Idempotency-Key'] = context['idempotency_key']
+            response = client.request(
+                'POST', '/%s' % operation, body=json.dumps({
+                    'uuid': self.uuid,
+                    'amount': str(self.amount),
+                }), headers=headers
+            )
+            if response.status != 200:
+                self.raise_user_error(
+                    'The dummy provider answered %s' % response.status
+                )
+
     def authorize_dummy(self, card_info=None):
         """
         Authorize with a dummy card
         """
-        succeed = Transaction().context.get('dummy_succeed', True)
+        self.call_dummy('authorize')
+        context = Transaction().context
+        succeed = context.get('dummy_succeed', True)
 
+        if succeed and context.get('dummy_keep_state'):
+            return
         if succeed:
             self.state = 'authorized'
         else:
@@ -76,6 +122,7 @@ class DummyTransaction:
         """
         Settle a dummy transaction
         """
+        self.call_dummy('settle')
         succeed = Transaction().context.get('dummy_succeed', True)
 
         if succeed:
@@ -86,10 +133,11 @@ class DummyTransaction:
             self.state = 'failed'
             self.save()
 
-    def capture_dummy(self):
+    def capture_dummy(self, card_info=None):
         """
         Capture a dummy transaction
         """
+        self.call_dummy('capture')
         succeed = Transaction().context.get('dummy_succeed', True)
 
         if succeed:
@@ -100,10 +148,121 @@ class DummyTransaction:
             self.state = 'failed'
             self.save()
 
+    def get_provider_request(self):
+        request = super(DummyTransaction, self).get_provider_request()
+        context = Transaction().context
+        for key in ('dummy_succeed', 'dummy_latency', 'dummy_error'):
+            request[key] = context.get(key)
+        if context.get('dummy_server_url'):
+            request['dummy_client'] = self.gateway.get_http_client(
+                context['dummy_server_url']
+            )
+        return request
+
+    @classmethod
+    def call_dummy_async(cls, operation, request):
+        """
+        Simulate the call to the provider from a worker thread
+        """
+        if request['dummy_latency']:
+            time.sleep(request['dummy_latency'])
+        if request['dummy_error']:
+            raise IOError('The dummy provider is unavailable')
+        if request.get('dummy_client'):
+            response = request['dummy_client'].request(
+                'POST', '/%s' % operation, body=json.dumps({
+                    'uuid': request['uuid'],
+                    'amount': str(request['amount']),
+                }), headers={'Content-Type': 'application/json'}
+            )
+            if response.status != 200:
+                raise IOError(
+                    'The dummy provider answered %s' % response.status
+                )
+        return request['dummy_succeed'] in (None, True)
+
+    @classmethod
+    def authorize_dummy_async(cls, request):
+        """
+        Authorize a dummy transaction without using the ORM
+        """
+        if cls.call_dummy_async('authorize', request):
+            return {'state': 'authorized'}
+        return {'state': 'failed'}
+
+    @classmethod
+    def capture_dummy_async(cls, request):
+        """
+        Capture a dummy transaction without using the ORM
+        """
+        if cls.call_dummy_async('capture', request):
+            return {'state': 'completed'}
+        return {'state': 'failed'}
+
+    @classmethod
+    def authorize_dummy_many(cls, transactions):
+        """
+        Authorize dummy transactions in one call
+        """
+        return [
+            {'state': state}
+            for state in cls.call_dummy_many('authorized', transactions)
+        ]
+
+    @classmethod
+    def capture_dummy_many(cls, transactions):
+        """
+        Capture dummy transactions in one call
+        """
+        return [
+            {'state': state}
+            for state in cls.call_dummy_many('completed', transactions)
+        ]
+
+    @classmethod
+    def call_dummy_many(cls, state, transactions):
+        """
+        Return the states of the transactions for a batch call. With
+        'dummy_fail_every' in the context, one transaction out of that
+        number fails.
+        """
+        context = Transaction().context
+        if context.get('dummy_error'):
+            cls.raise_user_error('The dummy provider is unavailable')
+        succeed = context.get('dummy_succeed', True)
+        fail_every = context.get('dummy_fail_every')
+        return [
+            state if succeed and not (
+                fail_every and index % fail_every == fail_every - 1)
+            else 'failed'
+            for index in xrange(len(transactions))
+        ]
+
+    def retry_dummy(self):
+        """
+        Retry a failed dummy transaction
+        """
+        self.capture_dummy()
+
+    def update_dummy(self):
+        """
+        Update the status of a dummy transaction
+        """
+        self.call_dummy('update')
+        succeed = Transaction().context.get('dummy_succeed', True)
+
+        # Save the state even if it is still in progress, like most
+        # providers
+        self.state = 'completed' if succeed else 'in-progress'
+        self.save()
+        if succeed:
+            self.safe_post()
+
     def cancel_dummy(self):
         """
         Cancel a dummy transaction
         """
+        self.call_dummy('cancel')
         if self.state != 'authorized':
             self.raise_user_error('cancel_only_authorized')
 
@@ -113,6 +272,17 @@ class DummyTransaction:
             self.state = 'cancel'
             self.save()
 
+    @classmethod
+    def cancel_dummy_many(cls, transactions):
+        """
+        Cancel dummy transactions at once
+        """
+        succeed = Transaction().context.get('dummy_succeed', True)
+        return [
+            {'state': 'cancel' if succeed else transaction.state}
+            for transaction in transactions
+        ]
+
 
 class AddPaymentProfileViewDummy:
     __name__ = 'party.payment_profile.add_view'
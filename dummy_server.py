@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Local stand-in server of the dummy provider
+
+    A small HTTP/1.1 server answering like a provider API, so the network
+    path of the providers (connection pooling, timeouts, retries) can be
+    tested and benchmarked without reaching a real provider.
+
+    .. code-block:: python
+
+        server = DummyProviderServer(latency=0.01)
+        server.start()
+        with Transaction().set_context(dummy_server_url=server.url):
+            PaymentTransaction.capture(transactions)
+        server.stop()
+
+    Every request gets a JSON answer `{"status": "succeeded", "path": ...}`.
+    The paths ending with `/declined` answer `"declined"`, the ones
+    ending with `/unavailable` answer with a 503 status and the ones ending
+    with `/dropped` close the connection without answering.
+'''
+import json
+import time
+import socket
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+__all__ = ['DummyProviderServer']
+
+
+class DummyProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send the answer in one packet like a real server
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+        self.server.connections.add(self.connection)
+
+    def finish(self):
+        BaseHTTPRequestHandler.finish(self)
+        self.server.connections.discard(self.connection)
+
+    def do_GET(self):
+        self.answer()
+
+    def do_POST(self):
+        self.answer()
+
+    def answer(self):
+        self.server.count('requests')
+        length = int(self.headers.getheader('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.path.endswith('/dropped'):
+            self.close_connection = 1
+            return
+
+        status, result = 200, 'succeeded'
+        if self.path.endswith('/declined'):
+            result = 'declined'
+        elif self.path.endswith('/unavailable'):
+            status, result = 503, 'unavailable'
+        body = json.dumps({'status': result, 'path': self.path})
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DummyProviderServer(ThreadingMixIn, HTTPServer):
+    """
+    The stand-in server, listening on localhost
+
+    :param port: The port to listen on, a free one by default
+    :param latency: Seconds spent to answer each request
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, port=0, latency=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), DummyProviderHandler)
+        self.latency = latency
+        self.counters = {'connections': 0, 'requests': 0}
+        self.counters_lock = threading.Lock()
+        self.connections = set()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address
+
+    def count(self, name):
+        with self.counters_lock:
+            self.counters[name] += 1
+
+    def start(self):
+        """
+        Serve in a background thread
+        """
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+        # Close the kept alive connections waiting for a request
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
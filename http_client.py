@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Pooled HTTP client for the providers
+
+    Opening a new connection for every call to a provider costs a TCP and
+    often a TLS handshake, which is frequently longer than the call itself.
+    :class:`ProviderClient` keeps the connections to a provider open
+    (HTTP/1.1 keep-alive) in a pool and reuses them for the next calls.
+
+    The pools are process-local: a process created by `fork` does not reuse
+    the connections of its parent, whose sockets are shared with it, but
+    opens its own.
+
+    Providers get the client of their gateway with
+    :meth:`PaymentGateway.get_http_client`, which applies the timeout,
+    retries and pool size set on the gateway:
+
+    .. code-block:: python
+
+        def capture_acme(self, card_info=None):
+            client = self.gateway.get_http_client('https://api.acme.test')
+            response = client.request(
+                'POST', '/charges', body=json.dumps({...}),
+                headers={'Content-Type': 'application/json'}
+            )
+            if response.status != 200:
+                ...
+'''
+import os
+import time
+import errno
+import select
+import socket
+import httplib
+import threading
+from collections import deque
+from urlparse import urlsplit
+
+from trytond.model import fields
+from trytond.pool import PoolMeta
+from trytond.transaction import Transaction
+
+__all__ = [
+    'Response', 'ConnectionPool', 'ProviderClient',
+    'PaymentGatewayHTTPClient',
+]
+__metaclass__ = PoolMeta
+
+# Methods which can be sent again when the server did not answer
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+RETRY_STATUS = frozenset([502, 503, 504])
+
+
+class Response(object):
+    """
+    The response of a provider, read completely so the connection can be
+    reused
+    """
+    __slots__ = ('status', 'reason', 'headers', 'body')
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def __repr__(self):
+        return '<Response %s %s>' % (self.status, self.reason)
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of the connections to a host
+
+    :param scheme: `http` or `https`
+    :param host: The host name
+    :param port: The port, the default one of the scheme if None
+    :param maxsize: The number of idle connections kept open
+    :param timeout: The socket timeout in seconds
+    """
+
+    def __init__(self, scheme, host, port=None, maxsize=10, timeout=30):
+        if scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.idle = deque()
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.created = 0
+
+    def _check_fork(self):
+        # Called with the lock
+        if self.pid != os.getpid():
+            # The sockets belong to the parent process, forget them without
+            # closing them
+            self.idle.clear()
+            self.pid = os.getpid()
+
+    def get(self):
+        """
+        Return an idle connection or a new one
+        """
+        with self.lock:
+            self._check_fork()
+            while self.idle:
+                connection = self.idle.pop()
+                if not self._closed(connection):
+                    return connection
+                connection.close()
+            self.created += 1
+        return self.connection_class(
+            self.host, self.port, timeout=self.timeout
+        )
+
+    @staticmethod
+    def _closed(connection):
+        """
+        Return True if the server closed the idle connection
+
+        An idle connection has nothing to read until a request is sent on
+        it, so a readable socket means the server closed it or sent data
+        which does not belong to any request.
+        """
+        if connection.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([connection.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return True
+        return bool(readable)
+
+    def put(self, connection):
+        """
+        Give back a connection which can be reused
+        """
+        with self.lock:
+            self._check_fork()
+            if len(self.idle) < self.maxsize:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        """
+        Close the idle connections
+        """
+        with self.lock:
+            self._check_fork()
+            while self.idle:
+                self.idle.pop().close()
+
+
+class ProviderClient(object):
+    """
+    An HTTP client for a provider which reuses its connections
+
+    :param base_url: The URL the paths of the requests are relative to
+    :param timeout: The socket timeout in seconds
+    :param retries: The number of times a request is sent again when the
+                    connection failed or the server is unavailable
+    :param backoff: The seconds to wait before the first retry, doubled
+                    after each retry
+    :param maxsize: The number of idle connections kept open
+    :param headers: The headers sent with every request
+    """
+
+    def __init__(self, base_url, timeout=30, retries=2, backoff=0.1,
+                 maxsize=10, headers=None):
+        url = urlsplit(base_url)
+        self.base_path = url.path.rstrip('/')
+        self.retries = retries
+        self.backoff = backoff
+        self.headers = headers or {}
+        self.pool = ConnectionPool(
+            url.scheme, url.hostname, url.port, maxsize=maxsize,
+            timeout=timeout
+        )
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Send a request and return its :class:`Response`
+
+        A request is sent again when it could not be written on the
+        connection, like when a kept alive connection was closed by the
+        server or a new one was refused. Once the request is written, only
+        the idempotent requests are retried when the connection fails or
+        the server answers 502, 503 or 504. Other requests, like the
+        charges, are never sent twice: the server may have received them.
+
+        :raises socket.error: If the connection failed after the retries
+        :raises httplib.HTTPException: If the response is invalid
+        """
+        all_headers = self.headers.copy()
+        all_headers.update(headers or {})
+        url = self.base_path + path
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+
+        attempt = 0
+        while True:
+            connection = self.pool.get()
+            reused = connection.sock is not None
+            sent = False
+            try:
+                self._write(connection, method, url, body, all_headers)
+                sent = True
+                response = self._read(connection)
+            except (socket.error, httplib.HTTPException), exc:
+                connection.close()
+                if sent and not idempotent:
+                    raise
+                if reused and self._closed_by_server(exc):
+                    continue
+                if attempt >= self.retries:
+                    raise
+            else:
+                if (response.status not in RETRY_STATUS or not idempotent or
+                        attempt >= self.retries):
+                    return response
+            self._wait(attempt)
+            attempt += 1
+
+    @staticmethod
+    def _closed_by_server(exc):
+        """
+        Return True if the error means that the server closed an idle kept
+        alive connection, which is then retried at once on a new connection
+        """
+        if isinstance(exc, httplib.BadStatusLine):
+            return not exc.line or exc.line == "''"
+        return getattr(exc, 'errno', None) in (errno.EPIPE, errno.ECONNRESET)
+
+    def _write(self, connection, method, url, body, headers):
+        if connection.sock is None:
+            connection.connect()
+            # httplib sends the headers and the body in separate packets,
+            # do not wait for the acknowledgement of the first one
+            connection.sock.setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
+            )
+        connection.request(method, url, body, headers)
+
+    def _read(self, connection):
+        response = connection.getresponse()
+        data = response.read()
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.put(connection)
+        return Response(
+            response.status, response.reason,
+            dict(response.getheaders()), data
+        )
+
+    def _wait(self, attempt):
+        if self.backoff:
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def close(self):
+        """
+        Close the idle connections
+        """
+        self.pool.clear()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class PaymentGatewayHTTPClient:
+    "HTTP connection settings of the gateway"
+    __name__ = 'payment_gateway.gateway'
+
+    http_timeout = fields.Integer(
+        'HTTP Timeout', help='Seconds before a call to the provider fails'
+    )
+    http_retries = fields.Integer(
+        'HTTP Retries',
+        help='Number of times a call is sent again when the connection '
+        'to the provider fails'
+    )
+    http_pool_size = fields.Integer(
+        'HTTP Pool Size',
+        help='Number of connections to the provider kept open per process'
+    )
+
+    @staticmethod
+    def default_http_timeout():
+        return 30
+
+    @staticmethod
+    def default_http_retries():
+        return 2
+
+    @staticmethod
+    def default_http_pool_size():
+        return 10
+
+    def get_http_client(self, base_url, headers=None):
+        """
+        Return the pooled HTTP client of the gateway for `base_url`
+
+        The client is created once per process and base URL, so the
+        connections are kept open between the calls. Changing the settings
+        of the gateway or the headers replaces the client and closes the
+        connections of the previous one.
+        """
+        key = (os.getpid(), Transaction().database.name, self.id, base_url)
+        settings = (
+            self.http_timeout, self.http_retries, self.http_pool_size,
+            tuple(sorted((headers or {}).iteritems())),
+        )
+        with _clients_lock:
+            old_settings, client = _clients.get(key, (None, None))
+            if client is not None and old_settings != settings:
+                client.close()
+                client = None
+            if client is None:
+                client = ProviderClient(
+                    base_url, timeout=self.http_timeout or None,
+                    retries=self.http_retries or 0,
+                    maxsize=self.http_pool_size or 1, headers=headers
+                )
+                _clients[key] = (settings, client)
+        return client
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Idempotency keys of the provider calls
+
+    A payment cannot be rolled back: if the Tryton transaction which called
+    `capture_<provider>` fails after the call (a serialization failure for
+    example) and is run again, the card would be charged twice.
+
+    Before calling the provider, a key derived from the uuid of the
+    transaction, the verb and the attempt is stored in its own database
+    transaction, so it survives a rollback of the calling one.
+    Once the call returned, its outcome is stored with the key: whether it
+    succeeded, the resulting state and the provider reference. When the
+    same call is made again:
+
+        * if the key has a successful result, it is replayed on the
+          transaction without calling the provider,
+        * if the key has a failed result, like a declined card, a new
+          attempt starts with a new key,
+        * if the key is still pending (the previous call was interrupted),
+          the provider is called again with the same key, which is in the
+          `idempotency_key` of the context. Providers supporting it should
+          send it along (for example as an `Idempotency-Key` HTTP header)
+          so that they do not process the request twice.
+
+    The batch calls (`<verb>_<provider>_many`) get the keys of their
+    transactions by id in the `idempotency_keys` of the context and the
+    concurrent calls (`<verb>_<provider>_async`) in the `idempotency_key`
+    of their request. The results stored are returned for the transactions
+    whose call was already made.
+'''
+import json
+import hashlib
+from contextlib import contextmanager
+
+from sql import Null
+
+from trytond import backend
+from trytond.exceptions import UserError
+from trytond.model import ModelSQL, fields, Unique
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+__all__ = ['IdempotencyKey', 'PaymentTransactionIdempotency']
+__metaclass__ = PoolMeta
+
+# The verbs which change the state of the payment at the provider
+IDEMPOTENT_VERBS = frozenset([
+    'authorize', 'capture', 'settle', 'retry', 'refund', 'cancel',
+])
+REPLAYED_LOG = 'Result of the previous call to the provider replayed'
+
+
+class IdempotencyKey(ModelSQL):
+    "Idempotency Key of a Provider Call"
+    __name__ = 'payment_gateway.idempotency_key'
+
+    key = fields.Char('Key', required=True, readonly=True)
+    transaction_uuid = fields.Char(
+        'Transaction UUID', required=True, readonly=True, select=True
+    )
+    verb = fields.Char('Verb', required=True, readonly=True)
+    attempt = fields.Integer('Attempt', required=True, readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+    ], 'State', required=True, readonly=True)
+    result = fields.Text('Result', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(IdempotencyKey, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('key_uniq', Unique(t, t.key), 'The key must be unique.'),
+        ]
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(IdempotencyKey, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        table.index_action(['transaction_uuid', 'verb', 'attempt'], 'add')
+
+    @staticmethod
+    def compute_key(uuid, verb, attempt):
+        """
+        Return the deterministic key of a call
+        """
+        return hashlib.sha1('%s:%s:%s' % (uuid, verb, attempt)).hexdigest()
+
+    @classmethod
+    def get_last(cls, uuid, verb):
+        """
+        Return the key of the last call of `verb` for the transaction or None
+        """
+        keys = cls.search([
+            ('transaction_uuid', '=', uuid),
+            ('verb', '=', verb),
+        ], order=[('attempt', 'DESC')], limit=1)
+        return keys[0] if keys else None
+
+    @classmethod
+    def reserve(cls, values):
+        """
+        Store a pending key, committed at once on PostgreSQL
+
+        :return: False if the key already exists
+        """
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+        try:
+            with cls._key_transaction():
+                cls.create([values])
+        except (UserError, DatabaseIntegrityError):
+            return False
+        return True
+
+    @classmethod
+    def store_result(cls, key, result):
+        """
+        Store the result of the call of a key, committed at once on
+        PostgreSQL
+        """
+        cls.store_results({key: result})
+
+    @classmethod
+    def store_results(cls, results):
+        """
+        Store the results of the calls by key, committed at once on
+        PostgreSQL
+        """
+        table = cls.__table__()
+
+        with cls._key_transaction() as transaction:
+            cursor = transaction.connection.cursor()
+            for key, result in results.iteritems():
+                cursor.execute(*table.update(
+                    [table.state, table.result],
+                    ['done', json.dumps(result)],
+                    where=(table.key == key) & (table.result == Null)
+                ))
+
+    @staticmethod
+    def _key_transaction():
+        if backend.name() == 'postgresql':
+            return Transaction().new_transaction()
+        # SQLite has a single connection, the keys cannot be committed
+        # without the calling transaction
+        return _current_transaction()
+
+
+@contextmanager
+def _current_transaction():
+    yield Transaction()
+
+
+class PaymentTransactionIdempotency:
+    "Check the idempotency key before calling the provider"
+    __name__ = 'payment_gateway.transaction'
+
+    @classmethod
+    def __setup__(cls):
+        super(PaymentTransactionIdempotency, cls).__setup__()
+        cls._error_messages.update({
+            'call_in_progress': 'A call to the provider is already in '
+                                'progress for the transaction "%s".',
+        })
+
+    def get_idempotency_key(self, verb):
+        """
+        Return a tuple of (key, result) for a call of `verb` to the
+        provider. The result is the one stored for the key or None if the
+        provider must be called.
+
+        A new attempt, and so a new key, starts only when the previous call
+        is recorded as failed.
+        """
+        IdempotencyKey = Pool().get('payment_gateway.idempotency_key')
+
+        last = IdempotencyKey.get_last(self.uuid, verb)
+        if last is not None:
+            if last.state == 'pending':
+                # The previous call was interrupted
+                return last.key, None
+            result = json.loads(last.result)
+            if result['success']:
+                return last.key, result
+        attempt = last.attempt + 1 if last is not None else 0
+        key = IdempotencyKey.compute_key(self.uuid, verb, attempt)
+        reserved = IdempotencyKey.reserve({
+            'key': key,
+            'transaction_uuid': self.uuid,
+            'verb': verb,
+            'attempt': attempt,
+        })
+        if not reserved:
+            # Another process reserved the same attempt
+            self.raise_user_error('call_in_progress', (self.rec_name,))
+        return key, None
+
+    @classmethod
+    def get_idempotency_keys(cls, verb, transactions):
+        """
+        Return a tuple of (keys, results) for the calls of `verb` to the
+        provider on the transactions: the keys of the calls and the results
+        stored for the calls already made, by transaction id
+        """
+        keys, results = {}, {}
+        for transaction in transactions:
+            key, result = transaction.get_idempotency_key(verb)
+            keys[transaction.id] = key
+            if result is not None:
+                results[transaction.id] = {
+                    'state': result['state'] or transaction.state,
+                    'provider_reference': result['provider_reference'],
+                    'log': REPLAYED_LOG,
+                }
+        return keys, results
+
+    @classmethod
+    def store_idempotency_results(cls, keys, results):
+        """
+        Store the results of the provider calls with their key
+
+        :param results: A list of (transaction, (result, exception)), the
+                        calls which raised an exception keep their key
+                        pending. A result which fails the transaction or
+                        keeps its state, like a declined cancellation, is
+                        stored as failed.
+        """
+        IdempotencyKey = Pool().get('payment_gateway.idempotency_key')
+
+        IdempotencyKey.store_results(dict(
+            (keys[transaction.id], {
+                'success': result['state'] not in (
+                    'failed', transaction.state),
+                'state': result['state'],
+                'provider_reference': result.get('provider_reference'),
+            })
+            for transaction, (result, exception) in results
+            if exception is None and transaction.id in keys
+        ))
+
+    def call_provider(self, method_name, *args, **kwargs):
+        IdempotencyKey = Pool().get('payment_gateway.idempotency_key')
+
+        verb = method_name.split('_', 1)[0]
+        if verb not in IDEMPOTENT_VERBS:
+            return super(PaymentTransactionIdempotency, self).call_provider(
+                method_name, *args, **kwargs
+            )
+
+        key, result = self.get_idempotency_key(verb)
+        if result is not None:
+            return self.replay_provider_result(result)
+
+        state = self.state
+        with Transaction().set_context(idempotency_key=key):
+            result = super(PaymentTransactionIdempotency, self).call_provider(
+                method_name, *args, **kwargs
+            )
+        transaction = self.__class__(self.id)
+        # Called from a workflow transition, the provider may leave the new
+        # state to the transition, which writes it once the call returned
+        IdempotencyKey.store_result(key, {
+            'success': transaction.state != 'failed',
+            'state': (
+                transaction.state if transaction.state != state else None),
+            'provider_reference': transaction.provider_reference,
+        })
+        return result
+
+    @classmethod
+    def call_provider_many(cls, method_name, transactions, *args, **kwargs):
+        verb = method_name.split('_', 1)[0]
+        if verb not in IDEMPOTENT_VERBS:
+            return super(
+                PaymentTransactionIdempotency, cls
+            ).call_provider_many(method_name, transactions, *args, **kwargs)
+
+        keys, results = cls.get_idempotency_keys(verb, transactions)
+        to_call = [t for t in transactions if t.id not in results]
+        if to_call:
+            with Transaction().set_context(idempotency_keys=keys):
+                called = super(
+                    PaymentTransactionIdempotency, cls
+                ).call_provider_many(method_name, to_call, *args, **kwargs)
+            cls.store_idempotency_results(
+                keys, [(t, (r, None)) for t, r in zip(to_call, called)]
+            )
+            results.update(zip([t.id for t in to_call], called))
+        return [results[t.id] for t in transactions]
+
+    def replay_provider_result(self, result):
+        """
+        Apply the stored result of a call already made to the provider
+
+        A result without state is the one of a provider which left the new
+        state to the workflow transition calling it.
+        """
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+
+        values = {'provider_reference': result['provider_reference']}
+        if result['state']:
+            values['state'] = result['state']
+        self.write([self], values)
+        TransactionLog.create([{
+            'transaction': self.id,
+            'log': REPLAYED_LOG,
+        }])
+        if result['state'] == 'completed':
+            self.safe_post()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Magnetic stripe parser
+
+    Card readers emulate a keyboard and send the data encoded on the
+    magnetic stripe of a card as a string. Depending on the reader and its
+    configuration the string contains Track 1, Track 2 or both, with or
+    without the start/end sentinels and the longitudinal redundancy check
+    (LRC) character.
+
+    .. code-block:: python
+
+        swipe = parse('%B4111111111111111^DOE/JOHN^1811101000000000?'
+                      ';4111111111111111=18111010000000000000?')
+        swipe.pan, swipe.expiry_month, swipe.expiry_year
+
+    The parser has no dependency on Tryton, so POS lanes can batch swipes
+    through :func:`parse_many` without going through the ORM.
+'''
+import re
+import struct
+from operator import xor
+
+__all__ = [
+    'MagstripeError', 'Swipe', 'parse', 'parse_many', 'luhn_valid', 'lrc',
+]
+
+# Track 1 (IATA): %B<PAN>^<NAME>^<YYMM><SERVICE CODE><DISCRETIONARY>?<LRC>
+TRACK1_RE = re.compile(
+    r'(?P<start>%)?(?P<format_code>[A-Za-z])(?P<pan>\d{12,19})'
+    r'\^(?P<name>[^^?]{2,26})\^(?P<yy>\d{2})(?P<mm>\d{2})'
+    r'(?P<service_code>\d{3})?(?P<discretionary>[^?;]*)'
+    r'(?:(?P<end>\?)(?P<lrc>(?!;\d)[\x20-\x5f])?)?'
+)
+# Track 2 (ABA): ;<PAN>=<YYMM><SERVICE CODE><DISCRETIONARY>?<LRC>
+TRACK2_RE = re.compile(
+    r'\s*(?P<start>;)?(?P<pan>\d{12,19})='
+    r'(?P<yy>\d{2})(?P<mm>\d{2})'
+    r'(?P<service_code>\d{3})?(?P<discretionary>\d*)'
+    r'(?:(?P<end>\?)(?P<lrc>[\x30-\x3f])?)?'
+)
+# Both tracks in one match, with the groups read by position
+SWIPE_RE = re.compile('(?:%s)?(?:%s)?' % tuple(
+    re.sub(r'\(\?P<\w+>', '(', track.pattern)
+    for track in (TRACK1_RE, TRACK2_RE)
+))
+
+# The Luhn sums of the pairs of digits, the first one doubled, and of the
+# single digits, so a card number is checked two digits at a time
+_LUHN_DOUBLED = [0, 2, 4, 6, 8, 1, 3, 5, 7, 9]
+_LUHN_PAIRS = dict(
+    ('%d%d' % (first, second), _LUHN_DOUBLED[first] + second)
+    for first in xrange(10) for second in xrange(10)
+)
+
+# The structures unpacking the tracks as 64 bit words, by number of words
+_WORDS = {}
+_PADDING = '\0' * 7
+
+
+class MagstripeError(ValueError):
+    "Raised when swipe data cannot be parsed or fails validation"
+
+
+class Swipe(object):
+    """
+    The card information read from a swipe
+    """
+    __slots__ = (
+        'format_code', 'pan', 'name', 'expiry_year', 'expiry_month',
+        'service_code', 'discretionary_data', 'tracks',
+    )
+
+    def __init__(self, format_code=None, pan=None, name=None,
+                 expiry_year=None, expiry_month=None, service_code=None,
+                 discretionary_data=None, tracks=()):
+        self.format_code = format_code
+        self.pan = pan
+        self.name = name
+        self.expiry_year = expiry_year
+        self.expiry_month = expiry_month
+        self.service_code = service_code
+        self.discretionary_data = discretionary_data
+        self.tracks = tracks
+
+    def __repr__(self):
+        return '<Swipe xxxx%s %s/%s tracks=%s>' % (
+            self.pan[-4:], self.expiry_month, self.expiry_year,
+            ','.join(map(str, self.tracks))
+        )
+
+
+def luhn_valid(number):
+    """
+    Return True if the string of digits passes the Luhn (mod 10) check
+    """
+    number = str(number)
+    if len(number) & 1:
+        number = '0' + number
+    pairs = _LUHN_PAIRS
+    try:
+        total = sum([
+            pairs[number[i:i + 2]] for i in xrange(0, len(number), 2)
+        ])
+    except KeyError:
+        raise ValueError('%r is not a string of digits' % number)
+    return total % 10 == 0
+
+
+def lrc(data, track=1):
+    """
+    Return the LRC character of the track `data` which includes the start
+    and end sentinels.
+
+    Track 1 characters are 6 bit (offset 0x20) and Track 2 characters are
+    4 bit (offset 0x30) values. Within those character sets subtracting the
+    offset is the same as flipping its bits, so the check is computed with
+    a single XOR over the raw bytes, made 8 bytes at a time.
+    """
+    size = len(data)
+    if size & 7:
+        data += _PADDING[:8 - (size & 7)]
+    count = len(data) >> 3
+    words = _WORDS.get(count)
+    if words is None:
+        words = _WORDS[count] = struct.Struct('<%dQ' % count)
+    value = reduce(xor, words.unpack(data), 0)
+    value ^= value >> 32
+    value ^= value >> 16
+    value ^= value >> 8
+    if track == 1:
+        if size & 1:
+            value ^= 0x20
+        return chr((value & 0x3f) + 0x20)
+    return chr((value & 0x0f) + 0x30)
+
+
+# The groups of the start sentinel, end sentinel and LRC of the tracks in
+# SWIPE_RE
+_LRC_GROUPS = {1: (1, 9, 10), 2: (11, 17, 18)}
+
+
+def _check_lrc(match, track):
+    start, end, check = _LRC_GROUPS[track]
+    check = match.group(check)
+    if check and match.group(start) and match.group(end):
+        data = match.string[match.start(start):match.end(end)]
+        if lrc(data, track) != check:
+            raise MagstripeError('LRC check failed on track %d' % track)
+
+
+def parse(data):
+    """
+    Parse the data of a swipe
+
+    :param data: The string sent by the card reader
+    :return: An instance of :class:`Swipe`
+    :raises MagstripeError: If the data is not a valid swipe
+    """
+    try:
+        data = str(data or '').strip()
+    except UnicodeEncodeError:
+        raise MagstripeError('Swipe data is not ASCII')
+    match = SWIPE_RE.match(data)
+    (_, format_code, pan1, name, yy1, mm1, service_code1, discretionary1,
+        _, _, _, pan, yy, mm, service_code, discretionary, _,
+        _) = match.groups()
+    if pan:
+        _check_lrc(match, 2)
+        tracks = (1, 2) if pan1 else (2,)
+    elif pan1:
+        tracks = (1,)
+    else:
+        raise MagstripeError('No track data found')
+    if pan1:
+        _check_lrc(match, 1)
+        if pan and pan1 != pan:
+            raise MagstripeError('Track 1 and Track 2 card numbers differ')
+        pan, yy, mm = pan1, yy1, mm1
+        service_code, discretionary = service_code1, discretionary1
+        format_code = format_code.upper()
+        if format_code != 'B':
+            raise MagstripeError('Unknown card format code %s' % format_code)
+        name = name.strip()
+
+    if not '01' <= mm <= '12':
+        raise MagstripeError('Invalid expiry month %s' % mm)
+    if not luhn_valid(pan):
+        raise MagstripeError('Card number fails the Luhn check')
+    return Swipe(
+        format_code, pan, name, '20' + yy, mm, service_code, discretionary,
+        tracks
+    )
+
+
+def parse_many(swipes, raise_errors=False):
+    """
+    Parse several swipes at once
+
+    :param swipes: An iterable of swipe data strings
+    :param raise_errors: If False, invalid swipes give None instead of
+                         raising an error
+    :return: A list of :class:`Swipe` instances in the same order
+    """
+    if raise_errors:
+        return [parse(data) for data in swipes]
+
+    result = []
+    append = result.append
+    parse_ = parse
+    for data in swipes:
+        try:
+            append(parse_(data))
+        except MagstripeError:
+            append(None)
+    return result
@@ -56,7 +56,7 @@ class ManualSelfTransaction:
         self.save()
         self.safe_post()
 
-    def capture_self(self):
+    def capture_self(self, card_info=None):
         """
         Capture a manual payment.
         All that needs to be done is post the transaction.
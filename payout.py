@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Payouts of the gateways
+
+    The gateways pay out the money they collected to the bank account of
+    the company in batches, net of their fees. A :class:`Payout` records
+    such a deposit and is matched to the completed or posted transactions
+    it covers: the set of transactions of the gateway, dated in the window
+    of the payout, whose net amount (charges less refunds) minus the
+    deposit is between zero and the fee tolerance.
+
+    The search first tries the runs of consecutive days of the window,
+    which is how most gateways batch their payouts, then falls back to an
+    exact subset sum computed on the amounts in cents with a bitset, as
+    long as it fits in :data:`SUBSET_SUM_MAX_BITS`.
+'''
+import math
+from datetime import timedelta
+from decimal import Decimal
+from itertools import groupby
+
+from sql import Null
+
+from trytond import backend
+from trytond.model import ModelSQL, ModelView, Workflow, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+
+__all__ = ['Payout', 'PaymentTransactionPayout']
+__metaclass__ = PoolMeta
+
+STATES = {
+    'readonly': Eval('state') != 'draft',
+}
+DEPENDS = ['state']
+
+# The largest number of bits (candidates * amount range) kept by the
+# subset sum search
+SUBSET_SUM_MAX_BITS = 2 * 10 ** 8
+
+
+def find_day_run(days, low, high):
+    """
+    Return the run of consecutive days whose total is between `low` and
+    `high` and nearest to `low`, or None
+
+    :param days: A list of (day, total) ordered by day
+    """
+    best = None
+    for start in xrange(len(days)):
+        total = 0
+        for end in xrange(start, len(days)):
+            total += days[end][1]
+            if low <= total <= high and (
+                    best is None or total - low < best[0]):
+                best = (total - low, start, end)
+    if best is None:
+        return None
+    start, end = best[1:]
+    return [day for day, _ in days[start:end + 1]]
+
+
+def _add_amount(reachable, amount, mask):
+    if amount < 0:
+        return reachable | reachable >> -amount
+    return reachable | (reachable << amount) & mask
+
+
+def find_subset_sum(amounts, low, high, max_bits=SUBSET_SUM_MAX_BITS):
+    """
+    Return the indexes of a subset of the integer `amounts` whose sum is
+    between `low` and `high` and nearest to `low`, or None if there is none
+    or if the search would exceed `max_bits`
+
+    The reachable sums are kept as the bits of an integer, so each amount
+    costs one shift and one or of the integer. Only one set of reachable
+    sums out of `block` is kept to find the subset back, the others are
+    computed again block by block.
+    """
+    negative = -sum(a for a in amounts if a < 0)
+    if high + negative < 0 or not amounts:
+        return None
+    size = high + negative + 1
+    block = int(math.sqrt(len(amounts))) + 1
+    if size * (len(amounts) // block + block + 1) > max_bits:
+        return None
+    mask = (1 << size) - 1
+
+    # The negative amounts first, so the sums only grow afterwards and the
+    # ones above `high` can be dropped
+    order = sorted(xrange(len(amounts)), key=lambda i: amounts[i] >= 0)
+    reachable = 1 << negative
+    checkpoints = []
+    for step, index in enumerate(order):
+        if step % block == 0:
+            checkpoints.append(reachable)
+        reachable = _add_amount(reachable, amounts[index], mask)
+
+    target = None
+    for value in xrange(max(low, -negative), high + 1):
+        if reachable >> (value + negative) & 1:
+            target = value + negative
+            break
+    if target is None:
+        return None
+
+    return sorted(_find_subset(
+        amounts, order, checkpoints, block, target, mask
+    ))
+
+
+def _find_subset(amounts, order, checkpoints, block, target, mask):
+    """
+    Return the indexes of the amounts which sum to the reachable `target`
+    """
+    subset = []
+    for start in xrange((len(checkpoints) - 1) * block, -1, -block):
+        end = min(start + block, len(order))
+        steps = [checkpoints[start // block]]
+        for step in xrange(start, end - 1):
+            steps.append(_add_amount(steps[-1], amounts[order[step]], mask))
+        # The sum is reachable after the step but not before: the amount
+        # of the step is part of the subset
+        for step in xrange(end - 1, start - 1, -1):
+            if not steps[step - start] >> target & 1:
+                index = order[step]
+                subset.append(index)
+                target -= amounts[index]
+    return subset
+
+
+class Payout(Workflow, ModelSQL, ModelView):
+    "Payout of a Payment Gateway"
+    __name__ = 'payment_gateway.payout'
+
+    gateway = fields.Many2One(
+        'payment_gateway.gateway', 'Gateway', required=True,
+        ondelete='RESTRICT', states=STATES, depends=DEPENDS
+    )
+    reference = fields.Char('Reference', states=STATES, depends=DEPENDS)
+    date = fields.Date(
+        'Date', required=True, states=STATES, depends=DEPENDS,
+        help='Date of the deposit on the bank account'
+    )
+    amount = fields.Numeric(
+        'Amount', digits=(16, Eval('currency_digits', 2)), required=True,
+        states=STATES, depends=DEPENDS + ['currency_digits']
+    )
+    currency = fields.Many2One(
+        'currency.currency', 'Currency', required=True, states=STATES,
+        depends=DEPENDS
+    )
+    currency_digits = fields.Function(
+        fields.Integer('Currency Digits'), 'on_change_with_currency_digits'
+    )
+    fee_tolerance = fields.Numeric(
+        'Fee Tolerance', digits=(16, Eval('currency_digits', 2)),
+        required=True, states=STATES, depends=DEPENDS + ['currency_digits'],
+        help='Maximum amount kept by the gateway as fees'
+    )
+    start_date = fields.Date(
+        'Start Date', required=True, states=STATES, depends=DEPENDS,
+        help='First date of the transactions covered'
+    )
+    end_date = fields.Date(
+        'End Date', required=True, states=STATES, depends=DEPENDS,
+        help='Last date of the transactions covered'
+    )
+    transactions = fields.One2Many(
+        'payment_gateway.transaction', 'payout', 'Transactions',
+        readonly=True
+    )
+    gross_amount = fields.Function(
+        fields.Numeric(
+            'Gross Amount', digits=(16, Eval('currency_digits', 2)),
+            depends=['currency_digits']
+        ), 'get_amounts'
+    )
+    fee = fields.Function(
+        fields.Numeric(
+            'Fee', digits=(16, Eval('currency_digits', 2)),
+            depends=['currency_digits']
+        ), 'get_amounts'
+    )
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('matched', 'Matched'),
+    ], 'State', required=True, readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(Payout, cls).__setup__()
+        cls._order.insert(0, ('date', 'DESC'))
+        cls._error_messages.update({
+            'no_match': 'No set of transactions of the gateway "%(gateway)s" '
+                        'matches the payout of %(amount)s.',
+        })
+        cls._transitions |= set((
+            ('draft', 'matched'),
+            ('matched', 'draft'),
+        ))
+        cls._buttons.update({
+            'match': {
+                'invisible': Eval('state') != 'draft',
+            },
+            'draft': {
+                'invisible': Eval('state') != 'matched',
+            },
+        })
+
+    @staticmethod
+    def default_state():
+        return 'draft'
+
+    @staticmethod
+    def default_fee_tolerance():
+        return Decimal('0')
+
+    @staticmethod
+    def default_currency():
+        Company = Pool().get('company.company')
+        if Transaction().context.get('company'):
+            company = Company(Transaction().context['company'])
+            return company.currency.id
+
+    @fields.depends('currency')
+    def on_change_with_currency_digits(self, name=None):
+        if self.currency:
+            return self.currency.digits
+        return 2
+
+    @fields.depends('date', 'start_date', 'end_date')
+    def on_change_date(self):
+        if self.date:
+            self.end_date = self.end_date or self.date
+            self.start_date = self.start_date or (
+                self.date - timedelta(days=7))
+
+    @classmethod
+    def get_amounts(cls, payouts, names):
+        result = {'gross_amount': {}, 'fee': {}}
+        for payout in payouts:
+            gross = sum(
+                (-t.amount if t.type == 'refund' else t.amount
+                    for t in payout.transactions),
+                Decimal('0')
+            )
+            result['gross_amount'][payout.id] = gross
+            result['fee'][payout.id] = (
+                gross - payout.amount if payout.transactions else None)
+        return dict((name, result[name]) for name in names)
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('matched')
+    def match(cls, payouts):
+        for payout in payouts:
+            if not payout.link_transactions():
+                cls.raise_user_error('no_match', {
+                    'gateway': payout.gateway.rec_name,
+                    'amount': payout.amount,
+                })
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('draft')
+    def draft(cls, payouts):
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+        transactions = [t for p in payouts for t in p.transactions]
+        if transactions:
+            PaymentTransaction.write(transactions, {'payout': None})
+
+    @classmethod
+    def match_payouts(cls):
+        """
+        Cron entry point which matches the draft payouts, the ones without
+        a match stay draft
+
+        :return: The list of matched payouts
+        """
+        matched = [
+            p for p in cls.search([('state', '=', 'draft')])
+            if p.link_transactions()
+        ]
+        if matched:
+            cls.write(matched, {'state': 'matched'})
+        return matched
+
+    def get_candidates(self):
+        """
+        Return the list of (id, date, signed amount) of the transactions
+        which can be covered by the payout, oldest first
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+        table = PaymentTransaction.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*table.select(
+            table.id, table.date, table.type, table.amount,
+            where=(table.gateway == self.gateway.id) &
+            (table.payout == Null) &
+            (table.date >= self.start_date) &
+            (table.date <= self.end_date) &
+            (table.currency == self.currency.id) &
+            table.state.in_(['completed', 'posted']) &
+            table.type.in_(['charge', 'refund']),
+            order_by=[table.date, table.id]
+        ))
+        return [
+            (id_, date, Decimal(str(amount)) * (-1 if type_ == 'refund' else 1))
+            for id_, date, type_, amount in cursor.fetchall()
+        ]
+
+    def find_transactions(self):
+        """
+        Return the ids of the transactions covered by the payout or None
+        """
+        candidates = self.get_candidates()
+        factor = 10 ** self.currency.digits
+
+        def cents(amount):
+            return int((amount * factor).quantize(Decimal('1')))
+
+        low = cents(self.amount)
+        high = low + cents(self.fee_tolerance)
+
+        days = [
+            (day, sum(cents(a) for _, _, a in group))
+            for day, group in groupby(candidates, key=lambda c: c[1])
+        ]
+        run = find_day_run(days, low, high)
+        if run is not None:
+            run = set(run)
+            return [id_ for id_, date, _ in candidates if date in run]
+
+        subset = find_subset_sum(
+            [cents(a) for _, _, a in candidates], low, high
+        )
+        if subset is not None:
+            return [candidates[i][0] for i in subset]
+
+    def link_transactions(self):
+        """
+        Link the payout to the transactions it covers
+
+        :return: True if the transactions were found
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+        ids = self.find_transactions()
+        if ids is None:
+            return False
+        in_max = Transaction().database.IN_MAX
+        for i in xrange(0, len(ids), in_max):
+            PaymentTransaction.write(
+                PaymentTransaction.browse(ids[i:i + in_max]),
+                {'payout': self.id}
+            )
+        return True
+
+
+class PaymentTransactionPayout:
+    "Link the transactions to the payout which covers them"
+    __name__ = 'payment_gateway.transaction'
+
+    payout = fields.Many2One(
+        'payment_gateway.payout', 'Payout', readonly=True, select=True,
+        ondelete='RESTRICT'
+    )
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(PaymentTransactionPayout, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        table.index_action(['gateway', 'date'], 'add')
+
+    @classmethod
+    def copy(cls, records, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default['payout'] = None
+        return super(PaymentTransactionPayout, cls).copy(records, default)
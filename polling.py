@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Status polling of in-progress transactions
+
+    Some providers process payments asynchronously and the transaction
+    stays `in-progress` until its status is fetched with the
+    `update_<provider>` method. This module adds a cron entry point which
+    polls those transactions in chunks, backing off exponentially on each
+    transaction which is still in progress, so that the number of provider
+    calls stays flat while the backlog grows.
+
+    Providers offering a batch status API can implement the classmethod
+    `update_<provider>_many(transactions)` which is then called once per
+    gateway and chunk instead of `update_<provider>` for each transaction.
+    It returns the results of the transactions (see
+    :meth:`PaymentTransaction.call_provider_many`).
+'''
+from datetime import datetime, timedelta
+from functools import partial
+
+from trytond import backend
+from trytond.exceptions import UserError
+from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+__all__ = ['PaymentTransactionPolling']
+__metaclass__ = PoolMeta
+
+# Delay before the second poll, doubled after every unsuccessful poll
+POLL_INTERVAL = timedelta(minutes=1)
+POLL_MAX_INTERVAL = timedelta(days=1)
+
+
+class PaymentTransactionPolling:
+    "Poll the status of in-progress transactions"
+    __name__ = 'payment_gateway.transaction'
+
+    last_poll = fields.DateTime('Last Poll', readonly=True)
+    next_poll = fields.DateTime('Next Poll', readonly=True)
+    poll_attempts = fields.Integer('Poll Attempts', readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+        sql_table = cls.__table__()
+
+        super(PaymentTransactionPolling, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        table.index_action(['state', 'next_poll'], 'add')
+
+        # Transactions already in progress are due for a poll
+        cursor.execute(*sql_table.update(
+            [sql_table.next_poll], [datetime.utcnow()],
+            where=(sql_table.state == 'in-progress') &
+            (sql_table.next_poll == None)  # noqa
+        ))
+
+    @staticmethod
+    def default_poll_attempts():
+        return 0
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [x.copy() for x in vlist]
+        for values in vlist:
+            if values.get('state') == 'in-progress':
+                values.setdefault('next_poll', datetime.utcnow())
+        return super(PaymentTransactionPolling, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        args = []
+        for transactions, values in zip(actions, actions):
+            if values.get('state') == 'in-progress' and \
+                    'next_poll' not in values:
+                # Poll at the next run once it moves to in-progress, with
+                # the backoff starting again. The providers saving the
+                # state again keep the backoff.
+                in_progress = cls._get_in_progress_ids(transactions)
+                moved = [t for t in transactions if t.id not in in_progress]
+                if moved:
+                    reset = values.copy()
+                    reset['next_poll'] = datetime.utcnow()
+                    reset.setdefault('poll_attempts', 0)
+                    args.extend((moved, reset))
+                transactions = [t for t in transactions if t.id in in_progress]
+                if not transactions:
+                    continue
+            args.extend((transactions, values))
+        if args:
+            super(PaymentTransactionPolling, cls).write(*args)
+
+    @classmethod
+    def _get_in_progress_ids(cls, transactions):
+        """
+        Return the ids of the transactions which are in progress in the
+        database
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        in_max = Transaction().database.IN_MAX
+
+        ids = [t.id for t in transactions]
+        in_progress = set()
+        for i in xrange(0, len(ids), in_max):
+            cursor.execute(*table.select(
+                table.id,
+                where=table.id.in_(ids[i:i + in_max]) &
+                (table.state == 'in-progress')
+            ))
+            in_progress.update(id_ for id_, in cursor.fetchall())
+        return in_progress
+
+    @classmethod
+    def copy(cls, records, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default.update({
+            'last_poll': None,
+            'next_poll': None,
+            'poll_attempts': 0,
+        })
+        return super(PaymentTransactionPolling, cls).copy(records, default)
+
+    @classmethod
+    def poll_backoff(cls, attempts):
+        """
+        Return the delay before polling again a transaction which is still
+        in progress after `attempts` polls
+        """
+        return min(
+            POLL_INTERVAL * 2 ** min(attempts - 1, 20), POLL_MAX_INTERVAL
+        )
+
+    @classmethod
+    def poll_in_progress(cls, chunk_size=100, limit=1000):
+        """
+        Cron entry point which polls the in-progress transactions that are
+        due, the longest waiting first. The transactions are claimed, so
+        several workers can poll at the same time.
+
+        :param chunk_size: Number of transactions polled per chunk
+        :param limit: Maximum number of transactions polled per run
+        :return: The number of transactions polled
+        """
+        polled = 0
+        while polled < limit:
+            transactions = cls.claim(
+                'in-progress', min(chunk_size, limit - polled),
+                where=lambda t: t.next_poll <= datetime.utcnow(),
+                order_by=lambda t: [t.next_poll, t.id]
+            )
+            if not transactions:
+                break
+            cls.poll(transactions)
+            cls.release(transactions)
+            polled += len(transactions)
+        return polled
+
+    @classmethod
+    def poll(cls, transactions):
+        """
+        Update the status of the transactions with their provider, grouped
+        by gateway, and schedule the next poll of the transactions which
+        are still in progress.
+        """
+        by_gateway = {}
+        for transaction in transactions:
+            by_gateway.setdefault(transaction.gateway, []).append(transaction)
+
+        for gateway, gateway_transactions in by_gateway.iteritems():
+            provider = gateway.provider
+            method_name = 'update_%s_many' % provider
+            if hasattr(cls, method_name):
+                results = cls._poll_call(
+                    partial(
+                        cls.call_provider_many, method_name,
+                        gateway_transactions
+                    ),
+                    gateway_transactions
+                )
+                if results is not None:
+                    cls.apply_provider_results('update', [
+                        (t, (r, None))
+                        for t, r in zip(gateway_transactions, results)
+                    ])
+                continue
+            method_name = 'update_%s' % provider
+            for transaction in gateway_transactions:
+                if hasattr(transaction, method_name):
+                    cls._poll_call(
+                        partial(transaction.call_provider, method_name),
+                        [transaction]
+                    )
+        cls._schedule_next_poll(transactions)
+
+    @classmethod
+    def _poll_call(cls, update, transactions):
+        """
+        Return the result of `update` and log the user errors it raises on
+        the transactions instead of failing the whole run
+        """
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+        try:
+            return update()
+        except UserError, exc:
+            TransactionLog.create([{
+                'transaction': transaction.id,
+                'log': 'Status update failed\n%s' % unicode(exc),
+            } for transaction in transactions])
+
+    @classmethod
+    def _schedule_next_poll(cls, transactions):
+        now = datetime.utcnow()
+        to_write = {}
+        for transaction in cls.browse([t.id for t in transactions]):
+            if transaction.state != 'in-progress':
+                continue
+            attempts = (transaction.poll_attempts or 0) + 1
+            to_write.setdefault(attempts, []).append(transaction)
+
+        args = []
+        for attempts, attempts_transactions in to_write.iteritems():
+            args.extend((attempts_transactions, {
+                'last_poll': now,
+                'next_poll': now + cls.poll_backoff(attempts),
+                'poll_attempts': attempts,
+            }))
+        if args:
+            cls.write(*args)
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Aggregated posting of the transactions
+
+    By default a transaction is posted with its own move of two lines. For
+    a gateway with many payments a day this fills the accounting with
+    moves, so a gateway can post its transactions once a day instead: the
+    completed transactions of a (company, date, currency) are posted in one
+    move with a receivable line per party, or per transaction, and one line
+    on the account of the gateway for the total.
+
+    The transactions of such a gateway stay `completed` until
+    :meth:`post_aggregated` posts the days which are over, one move at a
+    time: a day which can not be posted is logged and left for the next run
+    without stopping the other ones. Each transaction is linked to the
+    shared move and to its receivable line.
+'''
+import logging
+from decimal import Decimal
+from itertools import groupby
+
+from sql import For, Null
+
+from trytond import backend
+from trytond.exceptions import UserError
+from trytond.model import ModelView, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+
+__all__ = ['PaymentGatewayPosting', 'PaymentTransactionPosting']
+__metaclass__ = PoolMeta
+
+logger = logging.getLogger(__name__)
+
+
+def _day_key(transaction):
+    return (transaction.company.id, transaction.date, transaction.currency.id)
+
+
+def _party_key(transaction):
+    return (transaction.party.id, transaction.credit_account.id)
+
+
+class PaymentGatewayPosting:
+    "Posting mode of the transactions of the gateway"
+    __name__ = 'payment_gateway.gateway'
+
+    posting_mode = fields.Selection([
+        ('transaction', 'Per Transaction'),
+        ('daily', 'Daily'),
+    ], 'Posting Mode', required=True,
+        help='Post every transaction with its own move or post the '
+        'transactions of a day together in one move.'
+    )
+    posting_group = fields.Selection([
+        ('party', 'Per Party'),
+        ('transaction', 'Per Transaction'),
+    ], 'Posting Group', required=True, states={
+        'invisible': Eval('posting_mode') != 'daily',
+    }, depends=['posting_mode'],
+        help='Receivable lines of the daily moves'
+    )
+
+    @staticmethod
+    def default_posting_mode():
+        return 'transaction'
+
+    @staticmethod
+    def default_posting_group():
+        return 'party'
+
+    def lock_posting(self):
+        """
+        Lock the gateway until the end of the database transaction, so the
+        days of the gateway are posted by one worker at a time (PostgreSQL
+        only)
+        """
+        if backend.name() != 'postgresql':
+            return
+        table = self.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.select(
+            table.id, where=table.id == self.id, for_=For('UPDATE')
+        ))
+
+
+class PaymentTransactionPosting:
+    "Post the transactions of a gateway in daily moves"
+    __name__ = 'payment_gateway.transaction'
+
+    move_line = fields.Many2One(
+        'account.move.line', 'Move Line', readonly=True, ondelete='RESTRICT'
+    )
+
+    @classmethod
+    def copy(cls, records, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default['move_line'] = None
+        return super(PaymentTransactionPosting, cls).copy(records, default)
+
+    @classmethod
+    @ModelView.button
+    def post(cls, transactions):
+        # The transactions of the daily gateways wait for post_aggregated
+        super(PaymentTransactionPosting, cls).post([
+            t for t in transactions
+            if t.move or t.gateway.posting_mode != 'daily'
+        ])
+
+    @classmethod
+    def _post_completed_where(cls, table):
+        pool = Pool()
+        Gateway = pool.get('payment_gateway.gateway')
+        gateway = Gateway.__table__()
+
+        condition = super(
+            PaymentTransactionPosting, cls)._post_completed_where(table)
+        return condition & ~table.gateway.in_(gateway.select(
+            gateway.id, where=gateway.posting_mode == 'daily'
+        ))
+
+    @classmethod
+    def post_aggregated(cls, date=None, commit=True):
+        """
+        Cron entry point which posts the completed transactions of the
+        daily gateways in one move per gateway, company, date and currency
+
+        Each move is created in its own database transaction when `commit`
+        is set. The days which fail are logged on their transactions and
+        skipped.
+
+        :param date: Post the days before this date, today by default
+        :param commit: Commit the transaction after each move
+        :return: The number of moves created
+        """
+        pool = Pool()
+        Gateway = pool.get('payment_gateway.gateway')
+        Date = pool.get('ir.date')
+        TransactionLog = pool.get('payment_gateway.transaction.log')
+
+        date = date or Date.today()
+        count = 0
+        for gateway_id, company, day, currency in cls._get_aggregated_days(
+                date):
+            gateway = Gateway(gateway_id)
+            gateway.lock_posting()
+            # Search again once locked, another worker may have posted it
+            transactions = cls.search([
+                ('gateway', '=', gateway_id),
+                ('company', '=', company),
+                ('date', '=', day),
+                ('currency', '=', currency),
+            ] + cls._get_aggregated_domain(), order=[('id', 'ASC')])
+            if not transactions:
+                continue
+            try:
+                cls.create_aggregated_move(transactions)
+            except UserError, exc:
+                if commit:
+                    Transaction().rollback()
+                logger.warning(
+                    'Could not post the daily move of %s on %s',
+                    gateway.rec_name, day, exc_info=True
+                )
+                TransactionLog.create([{
+                    'transaction': t.id,
+                    'log': 'Could not post the daily move\n%s' % unicode(exc),
+                } for t in transactions])
+            else:
+                count += 1
+            if commit:
+                Transaction().commit()
+        return count
+
+    @classmethod
+    def _get_aggregated_domain(cls):
+        return [
+            ('state', '=', 'completed'),
+            ('type', 'in', ['charge', 'refund']),
+            ('move', '=', None),
+        ]
+
+    @classmethod
+    def _get_aggregated_days(cls, date):
+        """
+        Return the (gateway, company, date, currency) of the transactions
+        to post in daily moves before the date
+        """
+        pool = Pool()
+        Gateway = pool.get('payment_gateway.gateway')
+        table = cls.__table__()
+        gateway = Gateway.__table__()
+        cursor = Transaction().connection.cursor()
+
+        columns = [table.gateway, table.company, table.date, table.currency]
+        query = table.join(
+            gateway, condition=table.gateway == gateway.id
+        ).select(
+            *columns,
+            where=(gateway.posting_mode == 'daily') &
+            (table.state == 'completed') &
+            table.type.in_(['charge', 'refund']) &
+            (table.move == Null) & (table.date < date),
+            group_by=columns,
+            order_by=[
+                table.date, table.gateway, table.company, table.currency,
+            ]
+        )
+        cursor.execute(*query)
+        return cursor.fetchall()
+
+    @classmethod
+    def create_aggregated_move(cls, transactions):
+        """
+        Create and post the move of transactions sharing the gateway,
+        company, date and currency, then post the transactions
+
+        :return: The posted move
+        """
+        pool = Pool()
+        Period = pool.get('account.period')
+        Move = pool.get('account.move')
+        Line = pool.get('account.move.line')
+
+        first = transactions[0]
+        journal = first.gateway.journal
+        if not journal.debit_account:
+            cls.raise_user_error(
+                'missing_debit_account', (journal.rec_name,)
+            )
+
+        # Compute the whole move before creating anything
+        period = Period.find(first.company.id, date=first.date)
+        groups = cls.get_aggregated_groups(transactions)
+        lines, total = [], cls._get_aggregated_amounts([])
+        for group in groups:
+            amount, amount_second_currency = cls._get_aggregated_amounts(
+                group
+            )
+            lines.append(cls._get_aggregated_line(
+                group[0], -amount, -amount_second_currency,
+                account=group[0].credit_account, party=group[0].party,
+                description=(
+                    group[0].rec_name if len(group) == 1 else
+                    first.gateway.rec_name)
+            ))
+            total = (total[0] + amount, total[1] + amount_second_currency)
+        lines.append(cls._get_aggregated_line(
+            first, total[0], total[1], account=journal.debit_account,
+            description=first.gateway.rec_name
+        ))
+
+        move, = Move.create([{
+            'journal': journal.id,
+            'period': period,
+            'date': first.date,
+            'description': '%s %s' % (first.gateway.rec_name, first.date),
+        }])
+        try:
+            for line in lines:
+                line['move'] = move.id
+            lines = Line.create(lines)
+
+            to_write = []
+            for group, line in zip(groups, lines):
+                to_write.extend(
+                    (group, {'move': move.id, 'move_line': line.id})
+                )
+            cls.write(*to_write)
+            cls.post(transactions)
+            # Posted last, as a posted move can not be deleted
+            Move.post([move])
+        except UserError:
+            # Without a rollback, do not leave a partial draft move
+            cls.delete_aggregated_move(move, transactions)
+            raise
+        return move
+
+    @classmethod
+    def delete_aggregated_move(cls, move, transactions):
+        """
+        Unlink the transactions from the draft move and delete it
+        """
+        Move = Pool().get('account.move')
+
+        cls.write(transactions, {
+            'state': 'completed',
+            'move': None,
+            'move_line': None,
+        })
+        Move.delete([move])
+
+    @classmethod
+    def get_aggregated_groups(cls, transactions):
+        """
+        Return the lists of transactions sharing a receivable line
+        """
+        if transactions[0].gateway.posting_group == 'transaction':
+            return [[t] for t in transactions]
+        return [
+            list(group) for _, group in groupby(
+                sorted(transactions, key=_party_key), key=_party_key)
+        ]
+
+    @classmethod
+    def _get_aggregated_amounts(cls, transactions):
+        """
+        Return the signed amount received for the transactions in the
+        currency of the company and in the currency of the transactions
+        """
+        Currency = Pool().get('currency.currency')
+
+        amount = amount_second_currency = Decimal('0.0')
+        for transaction in transactions:
+            sign = -1 if transaction.type == 'refund' else 1
+            amount_second_currency += sign * transaction.amount
+            if transaction.currency != transaction.company.currency:
+                amount += sign * Currency.compute(
+                    transaction.currency, transaction.amount,
+                    transaction.company.currency
+                )
+            else:
+                amount += sign * transaction.amount
+        return amount, amount_second_currency
+
+    @classmethod
+    def _get_aggregated_line(cls, transaction, amount, amount_second_currency,
+                             account, party=None, description=None):
+        """
+        Return the values of a line of an aggregated move
+        """
+        line = {
+            'description': description,
+            'account': account.id,
+            'party': party.id if party else None,
+            'debit': amount if amount > 0 else Decimal('0.0'),
+            'credit': -amount if amount < 0 else Decimal('0.0'),
+        }
+        if party:
+            line['maturity_date'] = transaction.date
+        if transaction.currency != transaction.company.currency:
+            line['second_currency'] = transaction.currency.id
+            line['amount_second_currency'] = amount_second_currency
+        return line
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Bulk import of payment profiles
+
+    When customers are migrated to a new gateway, the provider hands over a
+    mapping of the cards it imported into its vault. This module creates
+    the payment profiles from such a file without going through the
+    `AddPaymentProfile` wizard card by card.
+
+    The file is a CSV file with a header and the columns:
+
+    ==================== =================================================
+    Column               Description
+    ==================== =================================================
+    `party`              Code of the party
+    `address`            Optional id of an address of the party. The first
+                         active address of the party is used if empty.
+    `gateway`            Name of the payment gateway
+    `provider_reference` Reference of the card in the provider's vault
+    `last_4_digits`      Last 4 digits of the card number
+    `expiry`             Expiry of the card as `MM/YY` or `MM/YYYY`
+    ==================== =================================================
+
+    .. code-block:: python
+
+        PaymentProfile.import_tokens(
+            'tokens.csv', checkpoint_path='tokens.checkpoint',
+            errors_path='tokens.errors.csv'
+        )
+'''
+import os
+import csv
+import json
+import logging
+
+from trytond import backend
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+__all__ = ['PaymentProfileImport']
+__metaclass__ = PoolMeta
+
+logger = logging.getLogger(__name__)
+
+IMPORT_COLUMNS = (
+    'party', 'address', 'gateway', 'provider_reference', 'last_4_digits',
+    'expiry',
+)
+
+
+class PaymentProfileImport:
+    "Bulk import of payment profiles from a token mapping file"
+    __name__ = 'party.payment_profile'
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(PaymentProfileImport, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        table.index_action(['gateway', 'provider_reference'], 'add')
+
+    @classmethod
+    def import_tokens(cls, path, checkpoint_path=None, chunk_size=1000,
+                      commit=True, errors_path=None):
+        """
+        Create the payment profiles listed in a token mapping file.
+
+        The file is streamed in chunks of `chunk_size` lines. For each chunk
+        the parties, addresses and already imported tokens are resolved
+        with one query each and the profiles are created at once, so memory
+        use does not grow with the size of the file.
+
+        If a `checkpoint_path` is given, the transaction is committed after
+        every chunk and the position in the file is saved there. Running
+        the import again with the same checkpoint resumes after the last
+        committed chunk. Tokens already stored for the gateway are skipped,
+        so a chunk imported twice does not create duplicates.
+
+        The lines in error are appended to the CSV file `errors_path` as
+        (line number, message), or logged if it is not given. The
+        checkpoint only keeps the counters and the position in the file.
+
+        :param path: Path of the CSV token mapping file
+        :param checkpoint_path: Optional path of the progress checkpoint
+        :param chunk_size: Number of lines imported per chunk
+        :param commit: If False, the checkpoint is saved without committing
+                       and the caller is responsible for the transaction
+        :param errors_path: Optional path of the file of the lines in error
+        :return: A dictionary with the number of lines `created`, `skipped`
+                 and in `errors`
+        """
+        progress = {
+            'offset': 0, 'line': 1, 'created': 0, 'skipped': 0, 'errors': 0,
+        }
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as checkpoint_file:
+                progress.update(json.load(checkpoint_file))
+            # Migration from the checkpoints with the list of errors
+            if isinstance(progress['errors'], list):
+                progress['errors'] = len(progress['errors'])
+
+        gateways = cls._import_gateways()
+        with open(path, 'rb') as token_file:
+            header = next(csv.reader([token_file.readline()]))
+            missing = set(IMPORT_COLUMNS) - set(header)
+            if missing:
+                raise ValueError(
+                    'Missing columns in %s: %s' % (path, ', '.join(missing))
+                )
+            if progress['offset']:
+                token_file.seek(progress['offset'])
+
+            while True:
+                rows = cls._read_import_chunk(
+                    token_file, header, progress, chunk_size
+                )
+                if not rows:
+                    break
+
+                created, skipped, errors = cls._import_token_chunk(
+                    rows, gateways
+                )
+                progress['created'] += created
+                progress['skipped'] += skipped
+                progress['errors'] += len(errors)
+                progress['offset'] = token_file.tell()
+                cls._save_import_errors(errors_path, errors)
+
+                if checkpoint_path:
+                    if commit:
+                        Transaction().commit()
+                    cls._save_import_checkpoint(checkpoint_path, progress)
+
+        return dict(
+            (key, progress[key]) for key in ('created', 'skipped', 'errors')
+        )
+
+    @staticmethod
+    def _read_import_chunk(token_file, header, progress, chunk_size):
+        """
+        Return the next `chunk_size` rows of the file as a list of
+        (line number, row dictionary)
+        """
+        rows = []
+        for line in iter(token_file.readline, ''):
+            progress['line'] += 1
+            if not line.strip():
+                continue
+            row = dict(zip(header, next(csv.reader([line]))))
+            rows.append((progress['line'], row))
+            if len(rows) >= chunk_size:
+                break
+        return rows
+
+    @staticmethod
+    def _save_import_errors(errors_path, errors):
+        if not errors:
+            return
+        if not errors_path:
+            for line, message in errors:
+                logger.warning('Line %s: %s', line, message)
+            return
+        with open(errors_path, 'ab') as errors_file:
+            writer = csv.writer(errors_file)
+            for line, message in errors:
+                if isinstance(message, unicode):
+                    message = message.encode('utf-8')
+                writer.writerow([line, message])
+
+    @staticmethod
+    def _save_import_checkpoint(checkpoint_path, progress):
+        # Write then rename, so a crash never leaves a truncated checkpoint
+        temp_path = checkpoint_path + '.tmp'
+        with open(temp_path, 'w') as checkpoint_file:
+            json.dump(progress, checkpoint_file)
+        os.rename(temp_path, checkpoint_path)
+
+    @classmethod
+    def _import_gateways(cls):
+        """
+        Return a dictionary of the gateways by name
+        """
+        Gateway = Pool().get('payment_gateway.gateway')
+        return dict(
+            (gateway.name, gateway.id) for gateway in Gateway.search([])
+        )
+
+    @classmethod
+    def _import_token_chunk(cls, rows, gateways):
+        """
+        Create the profiles of a chunk of rows
+
+        :param rows: A list of (line number, row dictionary)
+        :param gateways: A dictionary of gateway ids by name
+        :return: A tuple of (created, skipped, errors)
+        """
+        pool = Pool()
+        Party = pool.get('party.party')
+        Address = pool.get('party.address')
+        party = Party.__table__()
+        address = Address.__table__()
+        profile = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        codes = list(set(row['party'] for _, row in rows))
+        cursor.execute(*party.select(
+            party.code, party.id, where=party.code.in_(codes)
+        ))
+        parties = dict(cursor.fetchall())
+
+        # Addresses by party, the first one being the default
+        addresses = {}
+        if parties:
+            cursor.execute(*address.select(
+                address.party, address.id,
+                where=address.party.in_(parties.values()) &
+                (address.active == True),  # noqa
+                order_by=[address.party, address.sequence, address.id]
+            ))
+            for party_id, address_id in cursor.fetchall():
+                addresses.setdefault(party_id, []).append(address_id)
+
+        references = list(set(row['provider_reference'] for _, row in rows))
+        cursor.execute(*profile.select(
+            profile.gateway, profile.provider_reference,
+            where=profile.provider_reference.in_(references) &
+            profile.gateway.in_(gateways.values() or [None])
+        ))
+        existing = set(cursor.fetchall())
+
+        to_create, skipped, errors = [], 0, []
+        for line, row in rows:
+            try:
+                values = cls._import_token_values(
+                    row, parties, addresses, gateways
+                )
+            except ValueError, exc:
+                errors.append((line, unicode(exc)))
+                continue
+            key = (values['gateway'], values['provider_reference'])
+            if key in existing:
+                skipped += 1
+                continue
+            existing.add(key)
+            to_create.append(values)
+
+        if to_create:
+            cls.create(to_create)
+        return len(to_create), skipped, errors
+
+    @classmethod
+    def _import_token_values(cls, row, parties, addresses, gateways):
+        """
+        Return the values to create a profile from a row of the file
+
+        :raises ValueError: If the row cannot be imported
+        """
+        party_id = parties.get(row['party'])
+        if party_id is None:
+            raise ValueError('Unknown party %s' % row['party'])
+        gateway_id = gateways.get(row['gateway'])
+        if gateway_id is None:
+            raise ValueError('Unknown gateway %s' % row['gateway'])
+        if not row['provider_reference']:
+            raise ValueError('Missing provider reference')
+
+        party_addresses = addresses.get(party_id, [])
+        if row['address']:
+            if not row['address'].isdigit() or \
+                    int(row['address']) not in party_addresses:
+                raise ValueError(
+                    'Unknown address %s for party %s' % (
+                        row['address'], row['party'])
+                )
+            address_id = int(row['address'])
+        elif party_addresses:
+            address_id = party_addresses[0]
+        else:
+            raise ValueError('Party %s has no address' % row['party'])
+
+        expiry_month, expiry_year = cls._import_expiry(row['expiry'])
+        return {
+            'party': party_id,
+            'address': address_id,
+            'gateway': gateway_id,
+            'provider_reference': row['provider_reference'],
+            'last_4_digits': row['last_4_digits'] or None,
+            'expiry_month': expiry_month,
+            'expiry_year': expiry_year,
+        }
+
+    @classmethod
+    def _import_expiry(cls, expiry):
+        """
+        Return the expiry month and year of an expiry like `MM/YY`
+
+        :raises ValueError: If the expiry is invalid
+        """
+        try:
+            expiry_month, expiry_year = expiry.split('/')
+        except ValueError:
+            raise ValueError('Invalid expiry %s' % expiry)
+        if len(expiry_year) == 2:
+            expiry_year = '20' + expiry_year
+        expiry_month = expiry_month.zfill(2)
+        if cls.compute_expiry_date(expiry_month, expiry_year) is None:
+            raise ValueError('Invalid expiry %s' % expiry)
+        return expiry_month, expiry_year
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Rate limiting of the calls to the providers
+
+    Acquirers limit the number of transactions per second they accept and
+    throttle the merchants going over it. Each gateway can limit the rate
+    of the calls made to its provider with a token bucket: the bucket holds
+    up to `rate_limit_burst` tokens, refilled at `rate_limit` tokens per
+    second, and every call takes one token, waiting for it if the bucket is
+    empty.
+
+    By default the bucket is kept in memory and shared by the threads of a
+    process. With `rate_limit_shared` the bucket is stored on the gateway
+    record and shared by all the processes using the database (PostgreSQL
+    only). Each call then costs a short database transaction.
+'''
+import threading
+import time
+
+from sql import For
+
+from trytond import backend
+from trytond.model import fields
+from trytond.pool import PoolMeta
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+
+__all__ = [
+    'TokenBucket', 'RateLimitTimeout', 'PaymentGatewayRateLimit',
+    'PaymentTransactionRateLimit',
+]
+__metaclass__ = PoolMeta
+
+RATE_LIMIT_STATES = {
+    'invisible': ~Eval('rate_limit', 0),
+}
+RATE_LIMIT_DEPENDS = ['rate_limit']
+
+
+class RateLimitTimeout(Exception):
+    "Raised when a token is not available within the timeout"
+
+
+def reserve(tokens, updated, now, rate, capacity, timeout=None):
+    """
+    Refill a bucket and take a token from it. The bucket may go below zero,
+    the token is then reserved and the caller must wait before using it.
+
+    :param tokens: The number of tokens in the bucket at `updated`
+    :param updated: The time at which the bucket was last updated
+    :param now: The current time
+    :param rate: The number of tokens added per second
+    :param capacity: The maximum number of tokens in the bucket
+    :param timeout: The maximum time to wait for the token
+    :return: A tuple of (tokens left, seconds to wait)
+    :raises RateLimitTimeout: If the wait would exceed the timeout
+    """
+    tokens = min(capacity, tokens + max(now - updated, 0) * rate) - 1
+    wait = -tokens / rate if tokens < 0 else 0
+    if timeout is not None and wait > timeout:
+        raise RateLimitTimeout(wait)
+    return tokens, wait
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket which also measures the time spent waiting
+    for tokens
+    """
+
+    def __init__(self, rate, capacity=1, clock=time.time, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = capacity
+        self.updated = clock()
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def take(self, timeout=None):
+        """
+        Take a token, waiting for it if needed
+
+        :param timeout: The maximum number of seconds to wait
+        :return: The number of seconds waited
+        :raises RateLimitTimeout: If the token is not available in time
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens, wait = reserve(
+                self.tokens, self.updated, now, self.rate, self.capacity,
+                timeout
+            )
+            self.updated = now
+        # Wait outside of the lock, the token is reserved
+        if wait:
+            self.sleep(wait)
+        self.record(wait)
+        return wait
+
+    def record(self, wait):
+        """
+        Record a call which waited `wait` seconds for its token
+        """
+        with self.lock:
+            self.calls += 1
+            if wait:
+                self.waits += 1
+                self.wait_time += wait
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+class PaymentGatewayRateLimit:
+    "Rate limit of the calls to the provider of the gateway"
+    __name__ = 'payment_gateway.gateway'
+
+    rate_limit = fields.Float(
+        'Rate Limit',
+        help='Maximum number of calls per second to the provider. '
+        'Leave empty for no limit.'
+    )
+    rate_limit_burst = fields.Integer(
+        'Rate Limit Burst', states=RATE_LIMIT_STATES,
+        depends=RATE_LIMIT_DEPENDS,
+        help='Number of calls which can be made at once'
+    )
+    rate_limit_timeout = fields.Integer(
+        'Rate Limit Timeout', states=RATE_LIMIT_STATES,
+        depends=RATE_LIMIT_DEPENDS,
+        help='Maximum number of seconds a call waits for its turn. '
+        'Leave empty to wait as long as needed.'
+    )
+    rate_limit_shared = fields.Boolean(
+        'Rate Limit Shared', states=RATE_LIMIT_STATES,
+        depends=RATE_LIMIT_DEPENDS,
+        help='Share the limit between all the processes (PostgreSQL only)'
+    )
+    rate_limit_tokens = fields.Float('Rate Limit Tokens', readonly=True)
+    rate_limit_updated = fields.Float('Rate Limit Updated', readonly=True)
+    rate_limit_calls = fields.Function(
+        fields.Integer(
+            'Rate Limited Calls', states=RATE_LIMIT_STATES,
+            depends=RATE_LIMIT_DEPENDS
+        ), 'get_rate_limit_metrics'
+    )
+    rate_limit_waits = fields.Function(
+        fields.Integer(
+            'Rate Limit Waits', states=RATE_LIMIT_STATES,
+            depends=RATE_LIMIT_DEPENDS,
+            help='Number of calls which waited for their turn in this process'
+        ), 'get_rate_limit_metrics'
+    )
+    rate_limit_wait_time = fields.Function(
+        fields.Float(
+            'Rate Limit Wait Time', states=RATE_LIMIT_STATES,
+            depends=RATE_LIMIT_DEPENDS,
+            help='Total number of seconds waited in this process'
+        ), 'get_rate_limit_metrics'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(PaymentGatewayRateLimit, cls).__setup__()
+        cls._error_messages.update({
+            'rate_limited': 'Too many calls to the gateway "%s", '
+                            'try again later.',
+        })
+
+    @staticmethod
+    def default_rate_limit_burst():
+        return 1
+
+    @staticmethod
+    def default_rate_limit_shared():
+        return False
+
+    @classmethod
+    def copy(cls, gateways, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default.update({
+            'rate_limit_tokens': None,
+            'rate_limit_updated': None,
+        })
+        return super(PaymentGatewayRateLimit, cls).copy(gateways, default)
+
+    @classmethod
+    def get_rate_limit_metrics(cls, gateways, names):
+        result = dict((name, {}) for name in names)
+        for gateway in gateways:
+            bucket = gateway.get_token_bucket()
+            for name in names:
+                result[name][gateway.id] = getattr(
+                    bucket, name[len('rate_limit_'):]
+                ) if bucket else None
+        return result
+
+    def get_token_bucket(self):
+        """
+        Return the token bucket of the gateway in this process or None if
+        the gateway has no rate limit
+        """
+        if not self.rate_limit:
+            return None
+        key = (Transaction().database.name, self.id)
+        bucket = _buckets.get(key)
+        if bucket is None:
+            with _buckets_lock:
+                bucket = _buckets.setdefault(
+                    key, TokenBucket(self.rate_limit)
+                )
+        # Follow the changes of the settings
+        bucket.rate = self.rate_limit
+        bucket.capacity = self.rate_limit_burst or 1
+        return bucket
+
+    def wait_rate_limit(self):
+        """
+        Wait for the turn of a call to the provider
+
+        :return: The number of seconds waited
+        """
+        bucket = self.get_token_bucket()
+        if bucket is None:
+            return 0
+        try:
+            if self.rate_limit_shared and backend.name() == 'postgresql':
+                wait = self._reserve_shared_token()
+                if wait:
+                    bucket.sleep(wait)
+                bucket.record(wait)
+                return wait
+            return bucket.take(self.rate_limit_timeout)
+        except RateLimitTimeout:
+            self.raise_user_error('rate_limited', (self.rec_name,))
+
+    def _reserve_shared_token(self):
+        """
+        Reserve a token from the bucket stored on the gateway in its own
+        database transaction, so the row is locked only while the bucket is
+        updated.
+        """
+        table = self.__table__()
+        now = time.time()
+
+        with Transaction().new_transaction() as transaction:
+            cursor = transaction.connection.cursor()
+            cursor.execute(*table.select(
+                table.rate_limit_tokens, table.rate_limit_updated,
+                where=table.id == self.id, for_=For('UPDATE')
+            ))
+            tokens, updated = cursor.fetchone()
+            capacity = self.rate_limit_burst or 1
+            tokens, wait = reserve(
+                capacity if tokens is None else tokens, updated or now, now,
+                self.rate_limit, capacity, self.rate_limit_timeout
+            )
+            cursor.execute(*table.update(
+                [table.rate_limit_tokens, table.rate_limit_updated],
+                [tokens, now],
+                where=table.id == self.id
+            ))
+        return wait
+
+
+class PaymentTransactionRateLimit:
+    """
+    Apply the rate limit of the gateway to the calls to the provider
+
+    It is registered after the circuit breaker so it wraps it: the waits for
+    a token are not counted in the duration of the calls and a call which
+    times out waiting is not recorded as a failure of the provider.
+    """
+    __name__ = 'payment_gateway.transaction'
+
+    def call_provider(self, method_name, *args, **kwargs):
+        self.gateway.wait_rate_limit()
+        return super(PaymentTransactionRateLimit, self).call_provider(
+            method_name, *args, **kwargs
+        )
+
+    @classmethod
+    def call_provider_many(cls, method_name, transactions, *args, **kwargs):
+        if transactions:
+            transactions[0].gateway.wait_rate_limit()
+        return super(PaymentTransactionRateLimit, cls).call_provider_many(
+            method_name, transactions, *args, **kwargs
+        )
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Reconciliation of the payments
+
+    The receivable line of a posted transaction stays open until it is
+    reconciled with the lines it pays, usually the receivable line of an
+    invoice. :meth:`reconcile_payments` does it in bulk: it reads the open
+    payment lines in chunks and, for each chunk, the open receivable lines
+    of the same accounts and parties with one query, then matches them:
+
+        * first with the lines whose moves have the origins of the
+          transactions of the payment line (the invoices paid for example),
+          when they add up to its amount. The line of a daily move shared
+          by several transactions pays all their origins at once,
+        * then with the line of one of these origins with the opposite
+          amount,
+        * then with the oldest line of the party with the opposite amount.
+
+    The lines of a chunk are locked, the ones locked by another worker are
+    skipped (PostgreSQL only). The matches of a chunk are reconciled with
+    one creation of reconciliations. The payment lines left unmatched are
+    returned so they can be reconciled by hand.
+'''
+import logging
+from decimal import Decimal
+from collections import defaultdict, deque
+
+from sql import Null
+from sql.operators import Not
+
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+from .claim import skip_locked
+
+__all__ = ['PaymentTransactionReconcile']
+__metaclass__ = PoolMeta
+
+logger = logging.getLogger(__name__)
+
+
+def _amount(value):
+    # SQLite computes the differences as float
+    return Decimal(str(value))
+
+
+class PaymentTransactionReconcile:
+    "Reconcile the receivable lines of the payments"
+    __name__ = 'payment_gateway.transaction'
+
+    @classmethod
+    def reconcile_payments(cls, chunk_size=1000, limit=None):
+        """
+        Cron entry point which reconciles the open payment lines with the
+        open receivable lines they pay
+
+        :param chunk_size: Number of payment lines matched per batch
+        :param limit: Maximum number of payment lines read per run
+        :return: A tuple of (number of reconciliations, ids of the payment
+                 lines left unmatched)
+        """
+        reconciled, leftovers = 0, []
+        last_id = 0
+        read = 0
+        while limit is None or read < limit:
+            size = chunk_size if limit is None else min(
+                chunk_size, limit - read)
+            payments = cls._get_payment_lines(last_id, size)
+            if not payments:
+                break
+            last_id = payments[-1]['id']
+            read += len(payments)
+            locked = cls._lock_lines([p['id'] for p in payments])
+            payments = [p for p in payments if p['id'] in locked]
+            if not payments:
+                continue
+            matches = cls._match_payment_lines(payments)
+            cls._reconcile_matches(matches)
+            reconciled += len(matches)
+            matched = set(payment for payment, _, _ in matches)
+            leftovers.extend(
+                p['id'] for p in payments if p['id'] not in matched
+            )
+        if leftovers:
+            logger.info(
+                '%d payment lines reconciled, %d left unmatched',
+                reconciled, len(leftovers)
+            )
+        return reconciled, leftovers
+
+    @classmethod
+    def _get_payment_lines(cls, last_id, limit):
+        """
+        Return the open receivable lines of the posted transactions with an
+        id greater than `last_id`, as dictionaries with the `id`,
+        `account`, `party`, `amount`, `date` and the set of the `origins` of
+        the transactions
+        """
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        Account = pool.get('account.account')
+        transaction = cls.__table__()
+        line = Line.__table__()
+        move = Move.__table__()
+        account = Account.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # The line of the transaction in a daily move, or its own move
+        condition = (line.id == transaction.move_line) | (
+            (transaction.move_line == Null) &
+            (line.move == transaction.move) &
+            (line.account == transaction.credit_account) &
+            (line.party == transaction.party)
+        )
+        cursor.execute(*transaction.join(
+            line, condition=condition
+        ).join(
+            move, condition=move.id == line.move
+        ).join(
+            account, condition=account.id == line.account
+        ).select(
+            line.id, line.account, line.party, line.debit - line.credit,
+            move.date, transaction.origin,
+            where=(transaction.state == 'posted') &
+            (line.reconciliation == Null) &
+            (account.reconcile == True) &  # noqa
+            (line.id > last_id),
+            order_by=[line.id],
+            limit=limit
+        ))
+        payments = []
+        for id_, account_id, party, amount, date, origin in cursor.fetchall():
+            # A line of a daily move may be shared by several transactions
+            if not payments or payments[-1]['id'] != id_:
+                payments.append({
+                    'id': id_,
+                    'account': account_id,
+                    'party': party,
+                    'amount': _amount(amount),
+                    'date': date,
+                    'origins': set(),
+                })
+            if origin:
+                payments[-1]['origins'].add(origin)
+        return payments
+
+    @classmethod
+    def _lock_lines(cls, ids):
+        """
+        Lock the open lines and return the ids of the ones which are not
+        locked by another transaction
+        """
+        Line = Pool().get('account.move.line')
+        line = Line.__table__()
+        cursor = Transaction().connection.cursor()
+        in_max = Transaction().database.IN_MAX
+
+        locked = set()
+        for i in xrange(0, len(ids), in_max):
+            cursor.execute(*skip_locked(line.select(
+                line.id,
+                where=line.id.in_(ids[i:i + in_max]) &
+                (line.reconciliation == Null)
+            )))
+            locked.update(id_ for id_, in cursor.fetchall())
+        return locked
+
+    @classmethod
+    def _get_open_lines(cls, payments):
+        """
+        Return the open receivable lines, which are not payment lines, of
+        the accounts and parties of the payments, oldest first
+        """
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        transaction = cls.__table__()
+        line = Line.__table__()
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+        in_max = Transaction().database.IN_MAX
+
+        parties = list(set(p['party'] for p in payments))
+        accounts = list(set(p['account'] for p in payments))
+        payment_moves = transaction.select(
+            transaction.move, where=transaction.move != Null
+        )
+        lines = []
+        for i in xrange(0, len(parties), in_max):
+            cursor.execute(*line.join(
+                move, condition=move.id == line.move
+            ).select(
+                line.id, line.account, line.party, line.debit - line.credit,
+                move.date, move.origin,
+                where=(line.reconciliation == Null) &
+                line.account.in_(accounts) &
+                line.party.in_(parties[i:i + in_max]) &
+                Not(line.move.in_(payment_moves)),
+                order_by=[line.maturity_date, move.date, line.id]
+            ))
+            lines.extend(cursor.fetchall())
+        locked = cls._lock_lines([row[0] for row in lines])
+        return [row for row in lines if row[0] in locked]
+
+    @classmethod
+    def _match_payment_lines(cls, payments):
+        """
+        Match the payment lines with the open lines they pay
+
+        :return: A list of (payment line id, open line ids, date)
+        """
+        by_origin = defaultdict(list)
+        by_amount = defaultdict(deque)
+        for id_, account, party, amount, date, origin in (
+                cls._get_open_lines(payments)):
+            amount = _amount(amount)
+            if origin:
+                by_origin[(account, party, origin)].append(
+                    (id_, amount, date))
+            by_amount[(account, party, amount)].append((id_, date))
+
+        used = set()
+
+        def pop(candidates):
+            while candidates:
+                id_, date = candidates.popleft()
+                if id_ not in used:
+                    used.add(id_)
+                    return [id_], date
+
+        matches = []
+        for payment in payments:
+            match = cls._match_origins(payment, by_origin, used)
+            if match is None:
+                match = pop(by_amount[(
+                    payment['account'], payment['party'], -payment['amount'])])
+            if match is not None:
+                ids, date = match
+                matches.append((payment['id'], ids, max(date, payment['date'])))
+        return matches
+
+    @classmethod
+    def _match_origins(cls, payment, by_origin, used):
+        """
+        Return the open lines of the origins of the payment which it pays
+        and their last date, all of them or one with the opposite amount,
+        or None
+        """
+        key = (payment['account'], payment['party'])
+        lines = [
+            line for origin in sorted(payment['origins'])
+            for line in by_origin[key + (origin,)] if line[0] not in used
+        ]
+        if not lines:
+            return None
+        if sum(amount for _, amount, _ in lines) != -payment['amount']:
+            lines = [
+                line for line in lines if line[1] == -payment['amount']
+            ][:1]
+            if not lines:
+                return None
+        used.update(id_ for id_, _, _ in lines)
+        return [id_ for id_, _, _ in lines], max(d for _, _, d in lines)
+
+    @classmethod
+    def _reconcile_matches(cls, matches):
+        Reconciliation = Pool().get('account.move.reconciliation')
+
+        if matches:
+            Reconciliation.create([{
+                'lines': [('add', [payment] + lines)],
+                'date': date,
+            } for payment, lines, date in matches])
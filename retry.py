@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Automatic retry of failed charges
+
+    Soft declines (insufficient funds, issuer unavailable, ...) often
+    succeed when the charge is tried again later. A gateway can be
+    configured to retry its failed charges automatically: every time a
+    charge fails, the next attempt is scheduled according to the retry
+    policy of the gateway until the maximum number of attempts is reached.
+
+    The `process_retries` cron claims the due retries in batches (see
+    `claim.py`) and calls `retry_<provider>` on each of them. Only the
+    gateways whose provider implements that method are retried.
+'''
+from datetime import datetime, timedelta
+
+from trytond import backend
+from trytond.exceptions import UserError
+from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval
+
+__all__ = ['PaymentGatewayRetry', 'PaymentTransactionRetry']
+__metaclass__ = PoolMeta
+
+RETRY_STATES = {
+    'invisible': ~Eval('retry_max_attempts', 0),
+}
+RETRY_DEPENDS = ['retry_max_attempts']
+
+
+class PaymentGatewayRetry:
+    "Retry policy of the gateway"
+    __name__ = 'payment_gateway.gateway'
+
+    retry_max_attempts = fields.Integer(
+        'Retry Attempts',
+        help='Number of times a failed charge is retried automatically'
+    )
+    retry_interval = fields.Integer(
+        'Retry Interval', states=RETRY_STATES, depends=RETRY_DEPENDS,
+        help='Minutes before the first retry of a failed charge'
+    )
+    retry_backoff = fields.Selection([
+        ('fixed', 'Fixed'),
+        ('exponential', 'Exponential'),
+    ], 'Retry Backoff', states=RETRY_STATES, depends=RETRY_DEPENDS,
+        help='Exponential doubles the interval after each attempt'
+    )
+
+    @staticmethod
+    def default_retry_max_attempts():
+        return 0
+
+    @staticmethod
+    def default_retry_interval():
+        return 60
+
+    @staticmethod
+    def default_retry_backoff():
+        return 'exponential'
+
+    def get_retry_delay(self, attempts):
+        """
+        Return the delay before retrying a charge which already had
+        `attempts` automatic retries, or None if it must not be retried.
+        """
+        if attempts >= (self.retry_max_attempts or 0):
+            return None
+        minutes = self.retry_interval or 0
+        if self.retry_backoff == 'exponential':
+            minutes *= 2 ** attempts
+        return timedelta(minutes=minutes)
+
+
+class PaymentTransactionRetry:
+    "Automatic retry of failed charges"
+    __name__ = 'payment_gateway.transaction'
+
+    retry_attempts = fields.Integer(
+        'Retry Attempts', readonly=True,
+        help='Number of automatic retries'
+    )
+    next_retry = fields.DateTime('Next Retry', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(PaymentTransactionRetry, cls).__setup__()
+        # Needed by the retry button as well
+        cls._transitions |= set((
+            ('failed', 'in-progress'),
+        ))
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(PaymentTransactionRetry, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        table.index_action(['state', 'next_retry'], 'add')
+
+    @staticmethod
+    def default_retry_attempts():
+        return 0
+
+    @classmethod
+    def write(cls, *args):
+        super(PaymentTransactionRetry, cls).write(*args)
+
+        actions = iter(args)
+        failed = []
+        for transactions, values in zip(actions, actions):
+            if values.get('state') == 'failed':
+                failed.extend(transactions)
+        if failed:
+            cls.schedule_retry(failed)
+
+    @classmethod
+    def copy(cls, records, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default.update({
+            'retry_attempts': 0,
+            'next_retry': None,
+        })
+        return super(PaymentTransactionRetry, cls).copy(records, default)
+
+    @classmethod
+    def schedule_retry(cls, transactions):
+        """
+        Schedule the next automatic retry of failed charges according to
+        the retry policy of their gateway
+        """
+        now = datetime.utcnow()
+        to_write = {}
+        for transaction in transactions:
+            if transaction.type != 'charge' or not hasattr(
+                    transaction, 'retry_%s' % transaction.gateway.provider):
+                continue
+            delay = transaction.gateway.get_retry_delay(
+                transaction.retry_attempts or 0
+            )
+            next_retry = now + delay if delay is not None else None
+            if next_retry != transaction.next_retry:
+                to_write.setdefault(next_retry, []).append(transaction)
+
+        args = []
+        for next_retry, retry_transactions in to_write.iteritems():
+            args.extend((retry_transactions, {'next_retry': next_retry}))
+        if args:
+            super(PaymentTransactionRetry, cls).write(*args)
+
+    @classmethod
+    def claim_retries(cls, limit):
+        """
+        Claim up to `limit` failed charges whose retry is due and count the
+        attempt
+        """
+        transactions = cls.claim(
+            'failed', limit,
+            where=lambda t: t.next_retry <= datetime.utcnow(),
+            order_by=lambda t: [t.next_retry, t.id]
+        )
+
+        # Dequeue them and count the attempt
+        by_attempts = {}
+        for transaction in transactions:
+            by_attempts.setdefault(
+                (transaction.retry_attempts or 0) + 1, []
+            ).append(transaction)
+        args = []
+        for attempts, attempts_transactions in by_attempts.iteritems():
+            args.extend((attempts_transactions, {
+                'next_retry': None,
+                'retry_attempts': attempts,
+            }))
+        if args:
+            cls.write(*args)
+        return transactions
+
+    @classmethod
+    def process_retries(cls, chunk_size=100, limit=1000):
+        """
+        Cron entry point which retries the failed charges that are due.
+
+        Each batch is claimed and retried in the same database transaction,
+        so a batch is either fully processed or left in the queue.
+
+        :param chunk_size: Number of transactions claimed per batch
+        :param limit: Maximum number of transactions retried per run
+        :return: The number of transactions retried
+        """
+        retried = 0
+        while retried < limit:
+            transactions = cls.claim_retries(min(chunk_size, limit - retried))
+            if not transactions:
+                break
+            cls.retry_failed(transactions)
+            cls.release(transactions)
+            retried += len(transactions)
+        return retried
+
+    @classmethod
+    def retry_failed(cls, transactions):
+        """
+        Retry failed charges with their provider.
+
+        Unlike the `retry` button, a user error raised by the provider is
+        logged on the transaction, which fails again and is rescheduled,
+        instead of aborting the whole batch.
+        """
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+
+        transactions = [
+            t for t in transactions
+            if hasattr(t, 'retry_%s' % t.gateway.provider)
+        ]
+        if not transactions:
+            return
+        # The provider sets the final state, failed again included
+        cls.write(transactions, {'state': 'in-progress'})
+        for transaction in transactions:
+            provider = transaction.gateway.provider
+            try:
+                transaction.call_provider('retry_%s' % provider)
+            except UserError, exc:
+                TransactionLog.create([{
+                    'transaction': transaction.id,
+                    'log': 'Retry failed\n%s' % unicode(exc),
+                }])
+                cls.write([transaction], {'state': 'failed'})
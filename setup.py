@@ -87,6 +87,7 @@ setup(
         'trytond.modules.%s' % MODULE: info.get('xml', []) +
         info.get('translation', []) +
         ['tryton.cfg', 'locale/*.po', 'tests/*.rst', '*.odt'] +
+        ['data/*.csv'] +
         ['view/*.xml'],
     },
     classifiers=[
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Daily summary of the transactions
+
+    The dashboards sum the amounts of the transactions by gateway,
+    currency, state and date. Instead of aggregating the whole transaction
+    table, they read :class:`TransactionSummary`, which holds the number and
+    the total amount of the transactions of each (company, gateway,
+    currency, type, state, date).
+
+    The summary is kept up to date by the creation, the writes (which
+    include the workflow transitions) and the deletion of the transactions:
+    each of them adds the differences to the rows of the summary in one
+    statement per row. :meth:`TransactionSummary.rebuild` computes the rows
+    of a range of dates again from the transactions, for example after
+    changing the transactions with SQL.
+'''
+from collections import defaultdict
+from decimal import Decimal
+
+from sql import Literal
+from sql.aggregate import Count, Sum
+
+from trytond import backend
+from trytond.model import ModelSQL, ModelView, fields, Unique
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+
+__all__ = [
+    'TransactionSummary', 'PaymentTransactionSummary',
+    'RebuildTransactionSummaryStart', 'RebuildTransactionSummary',
+]
+__metaclass__ = PoolMeta
+
+# The fields of the transactions the summary is grouped by
+SUMMARY_KEY = ['company', 'gateway', 'currency', 'type', 'state', 'date']
+
+
+class TransactionSummary(ModelSQL, ModelView):
+    "Daily Summary of the Payment Gateway Transactions"
+    __name__ = 'payment_gateway.transaction.summary'
+
+    company = fields.Many2One(
+        'company.company', 'Company', required=True, readonly=True
+    )
+    gateway = fields.Many2One(
+        'payment_gateway.gateway', 'Gateway', required=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    currency = fields.Many2One(
+        'currency.currency', 'Currency', required=True, readonly=True
+    )
+    type = fields.Char('Type', required=True, readonly=True)
+    state = fields.Char('State', required=True, readonly=True)
+    date = fields.Date('Date', required=True, readonly=True)
+    count = fields.Integer('Count', required=True, readonly=True)
+    amount = fields.Numeric('Amount', required=True, readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(TransactionSummary, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('key_uniq', Unique(
+                t, t.company, t.gateway, t.currency, t.type, t.state,
+                t.date), 'The summary has one row per key.'),
+        ]
+        cls._order.insert(0, ('date', 'DESC'))
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        created = not TableHandler.table_exist(cls._table)
+
+        super(TransactionSummary, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        table.index_action(['gateway', 'date'], 'add')
+        table.index_action(['date'], 'add')
+
+        if created:
+            cls.rebuild()
+
+    @classmethod
+    def add(cls, deltas):
+        """
+        Add the differences to the summary
+
+        :param deltas: A dictionary of the (count, amount) to add by key,
+                       the values of :data:`SUMMARY_KEY`
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        columns = [getattr(table, name) for name in SUMMARY_KEY]
+
+        for key, (count, amount) in sorted(deltas.iteritems()):
+            if not count and not amount:
+                continue
+            if backend.name() == 'postgresql':
+                query, params = tuple(table.insert(
+                    columns + [table.count, table.amount],
+                    [list(key) + [count, amount]]
+                ))
+                cursor.execute(query + (
+                    ' ON CONFLICT (%s) DO UPDATE SET '
+                    '"count" = "%s"."count" + EXCLUDED."count", '
+                    '"amount" = "%s"."amount" + EXCLUDED."amount"' % (
+                        ', '.join('"%s"' % n for n in SUMMARY_KEY),
+                        cls._table, cls._table)), params)
+                continue
+            condition = Literal(True)
+            for column, value in zip(columns, key):
+                condition &= column == value
+            cursor.execute(*table.update(
+                [table.count, table.amount],
+                [table.count + count, table.amount + amount],
+                where=condition
+            ))
+            if not cursor.rowcount:
+                cursor.execute(*table.insert(
+                    columns + [table.count, table.amount],
+                    [list(key) + [count, amount]]
+                ))
+
+    @classmethod
+    def rebuild(cls, start_date=None, end_date=None):
+        """
+        Compute again the summary of the transactions between the dates
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+        table = cls.__table__()
+        transaction = PaymentTransaction.__table__()
+        cursor = Transaction().connection.cursor()
+
+        condition = Literal(True)
+        transaction_condition = Literal(True)
+        if start_date:
+            condition &= table.date >= start_date
+            transaction_condition &= transaction.date >= start_date
+        if end_date:
+            condition &= table.date <= end_date
+            transaction_condition &= transaction.date <= end_date
+
+        cursor.execute(*table.delete(where=condition))
+        key = [getattr(transaction, name) for name in SUMMARY_KEY]
+        cursor.execute(*table.insert(
+            [getattr(table, name) for name in SUMMARY_KEY] +
+            [table.count, table.amount],
+            transaction.select(
+                *(key + [Count(Literal(1)), Sum(transaction.amount)]),
+                where=transaction_condition,
+                group_by=key
+            )
+        ))
+
+    @classmethod
+    def get_totals(cls, start_date=None, end_date=None, period='day',
+                   **domain):
+        """
+        Return the totals of the transactions between the dates
+
+        :param period: `day` or `month`
+        :param domain: Values of the fields of :data:`SUMMARY_KEY` to filter
+                       on, like `gateway=1` or `state='posted'`
+        :return: A list of dictionaries with the fields of
+                 :data:`SUMMARY_KEY` (the first day of the month for the
+                 monthly totals), the `count` and the `amount`
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        condition = Literal(True)
+        if start_date:
+            condition &= table.date >= start_date
+        if end_date:
+            condition &= table.date <= end_date
+        for name, value in domain.iteritems():
+            assert name in SUMMARY_KEY, name
+            condition &= getattr(table, name) == value
+
+        cursor.execute(*table.select(
+            *([getattr(table, name) for name in SUMMARY_KEY] +
+                [table.count, table.amount]),
+            where=condition & (table.count != 0),
+            order_by=[table.date]
+        ))
+        totals = defaultdict(lambda: [0, Decimal(0)])
+        for row in cursor.fetchall():
+            key = row[:len(SUMMARY_KEY)]
+            if period == 'month':
+                key = key[:-1] + (key[-1].replace(day=1),)
+            totals[key][0] += row[-2]
+            totals[key][1] += Decimal(str(row[-1]))
+        result = []
+        for key, (count, amount) in sorted(
+                totals.iteritems(), key=lambda t: t[0][-1]):
+            values = dict(zip(SUMMARY_KEY, key))
+            values.update({
+                'count': count,
+                'amount': amount,
+            })
+            result.append(values)
+        return result
+
+
+class PaymentTransactionSummary:
+    "Keep the daily summary of the transactions up to date"
+    __name__ = 'payment_gateway.transaction'
+
+    @classmethod
+    def _get_summary_deltas(cls, ids, sign, deltas):
+        """
+        Add the count and amount of the transactions, read from the
+        database, to the deltas with `sign`
+        """
+        for values in cls.read(ids, SUMMARY_KEY + ['amount']):
+            key = tuple(values[name] for name in SUMMARY_KEY)
+            deltas[key][0] += sign
+            deltas[key][1] += sign * values['amount']
+
+    @staticmethod
+    def _new_summary_deltas():
+        return defaultdict(lambda: [0, Decimal(0)])
+
+    @classmethod
+    def create(cls, vlist):
+        TransactionSummary = Pool().get('payment_gateway.transaction.summary')
+
+        transactions = super(PaymentTransactionSummary, cls).create(vlist)
+        deltas = cls._new_summary_deltas()
+        cls._get_summary_deltas(map(int, transactions), 1, deltas)
+        TransactionSummary.add(deltas)
+        return transactions
+
+    @classmethod
+    def write(cls, *args):
+        TransactionSummary = Pool().get('payment_gateway.transaction.summary')
+
+        fields = set(SUMMARY_KEY + ['amount'])
+        ids = set()
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if fields.intersection(values):
+                ids.update(map(int, records))
+        ids = list(ids)
+
+        deltas = cls._new_summary_deltas()
+        if ids:
+            cls._get_summary_deltas(ids, -1, deltas)
+        super(PaymentTransactionSummary, cls).write(*args)
+        if ids:
+            cls._get_summary_deltas(ids, 1, deltas)
+            TransactionSummary.add(deltas)
+
+    @classmethod
+    def delete(cls, transactions):
+        TransactionSummary = Pool().get('payment_gateway.transaction.summary')
+
+        deltas = cls._new_summary_deltas()
+        cls._get_summary_deltas(map(int, transactions), -1, deltas)
+        super(PaymentTransactionSummary, cls).delete(transactions)
+        TransactionSummary.add(deltas)
+
+
+class RebuildTransactionSummaryStart(ModelView):
+    "Rebuild Transaction Summary"
+    __name__ = 'payment_gateway.transaction.summary.rebuild.start'
+
+    start_date = fields.Date(
+        'Start Date', help='Leave empty to start from the first transaction'
+    )
+    end_date = fields.Date(
+        'End Date', help='Leave empty to end with the last transaction'
+    )
+
+
+class RebuildTransactionSummary(Wizard):
+    "Rebuild Transaction Summary"
+    __name__ = 'payment_gateway.transaction.summary.rebuild'
+
+    start = StateView(
+        'payment_gateway.transaction.summary.rebuild.start',
+        'payment_gateway.transaction_summary_rebuild_start_view_form',
+        [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Rebuild', 'rebuild', 'tryton-ok', default=True),
+        ]
+    )
+    rebuild = StateTransition()
+
+    def transition_rebuild(self):
+        TransactionSummary = Pool().get('payment_gateway.transaction.summary')
+
+        TransactionSummary.rebuild(self.start.start_date, self.start.end_date)
+        return 'end'
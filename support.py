@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Search of the transactions for the customer support
+
+    The support finds a transaction of a customer with what the customer
+    knows: the last four digits of the card, the amount, about when it was
+    paid, the name of the party and some words of the description.
+    :meth:`search_support` combines the criteria given in one search, each of
+    them served by an index:
+
+        * (last_four_digits, date) and (amount, date) for the card and the
+          amount with a range of dates,
+        * a trigram index on the description on PostgreSQL, when the
+          `pg_trgm` extension is installed, for the matches of any part of
+          it.
+
+    The name of the party is searched through the parties, with their
+    record rules, using the indexes of the party module. The wildcards
+    typed by the user are matched literally.
+'''
+import logging
+
+from sql.operators import ILike
+
+from trytond import backend
+from trytond.pool import PoolMeta
+from trytond.rpc import RPC
+from trytond.transaction import Transaction
+
+__all__ = ['PaymentTransactionSupport']
+__metaclass__ = PoolMeta
+
+logger = logging.getLogger(__name__)
+
+
+def escape_like(value):
+    """
+    Return the value with the wildcards of LIKE escaped by a backslash
+    """
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace(
+        '_', '\\_')
+
+
+class ILikeEscape(ILike):
+    "ILIKE with the backslash as escape character on every backend"
+    __slots__ = ()
+
+    @property
+    def _operands(self):
+        return super(ILikeEscape, self)._operands + ('\\',)
+
+    def __str__(self):
+        left, right, escape = self._operands
+        return '(%s %s %s ESCAPE %s)' % (
+            self._format(left), self._operator, self._format(right),
+            self._format(escape))
+
+
+class PaymentTransactionSupport:
+    "Search the transactions for the customer support"
+    __name__ = 'payment_gateway.transaction'
+
+    @classmethod
+    def __setup__(cls):
+        super(PaymentTransactionSupport, cls).__setup__()
+        cls.__rpc__.update({
+            'search_support': RPC(result=lambda r: map(int, r)),
+        })
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(PaymentTransactionSupport, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        table.index_action(['last_four_digits', 'date'], 'add')
+        table.index_action(['amount', 'date'], 'add')
+        cls._register_trigram_index(cls._table, 'description')
+
+        # Migration: the index on the name of the parties belongs to the
+        # party module
+        if backend.name() == 'postgresql':
+            cursor = Transaction().connection.cursor()
+            cursor.execute(
+                'DROP INDEX IF EXISTS "party_party_name_trgm_index"'
+            )
+
+    @classmethod
+    def _register_trigram_index(cls, table, column):
+        """
+        Create the trigram index of the column of the table if the
+        `pg_trgm` extension is installed (PostgreSQL only)
+        """
+        if backend.name() != 'postgresql':
+            return
+        cursor = Transaction().connection.cursor()
+        cursor.execute(
+            "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+        )
+        if not cursor.fetchone():
+            logger.info(
+                'pg_trgm is not installed, the column %s of %s is searched '
+                'without index', column, table
+            )
+            return
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS "%s_%s_trgm_index" '
+            'ON "%s" USING gin ("%s" gin_trgm_ops)' % (
+                table, column, table, column)
+        )
+
+    @classmethod
+    def search_support(cls, last_four_digits=None, amount=None,
+                       start_date=None, end_date=None, party_name=None,
+                       description=None, limit=100):
+        """
+        Return the transactions matching all the criteria given, the most
+        recent first
+
+        :param last_four_digits: The last four digits of the card
+        :param amount: The exact amount
+        :param start_date: The first date of the transactions
+        :param end_date: The last date of the transactions
+        :param party_name: A part of the name of the party
+        :param description: A part of the description
+        :param limit: The maximum number of transactions returned
+        """
+        domain = cls._get_support_domain(
+            last_four_digits, amount, start_date, end_date, party_name,
+            description
+        )
+        if not domain:
+            return []
+        return cls.search(
+            domain, order=[('date', 'DESC'), ('id', 'DESC')], limit=limit
+        )
+
+    @classmethod
+    def _get_support_domain(cls, last_four_digits, amount, start_date,
+                            end_date, party_name, description):
+        domain = []
+        if last_four_digits:
+            domain.append(('last_four_digits', '=', last_four_digits))
+        if amount is not None:
+            domain.append(('amount', '=', amount))
+        if start_date:
+            domain.append(('date', '>=', start_date))
+        if end_date:
+            domain.append(('date', '<=', end_date))
+        if party_name:
+            # The backslash is the default escape character of PostgreSQL
+            domain.append((
+                'party.name', 'ilike', '%' + escape_like(party_name) + '%'
+            ))
+        if description:
+            table = cls.__table__()
+            domain.append(('id', 'in', table.select(
+                table.id,
+                where=ILikeEscape(
+                    table.description, '%' + escape_like(description) + '%')
+            )))
+        return domain
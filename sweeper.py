@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Sweeper of stale authorizations
+
+    Providers only hold the amount of an authorization for a few days. Once
+    the hold has expired the authorization cannot be settled anymore, but
+    the transaction stays `authorized`. The `sweep_authorizations` cron
+    cancels the authorizations older than the hold window of their gateway.
+
+    Providers offering a batch void API can implement the classmethod
+    `cancel_<provider>_many(transactions)` which returns the results of the
+    transactions (see :meth:`PaymentTransaction.call_provider_many`), the
+    cancelled ones in the `cancel` state. Otherwise `cancel_<provider>` is
+    called on each transaction.
+'''
+from datetime import timedelta
+
+from trytond import backend
+from trytond.exceptions import UserError
+from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['PaymentGatewaySweeper', 'PaymentTransactionSweeper']
+__metaclass__ = PoolMeta
+
+
+class PaymentGatewaySweeper:
+    "Authorization hold window of the gateway"
+    __name__ = 'payment_gateway.gateway'
+
+    authorization_hold = fields.Integer(
+        'Authorization Hold',
+        help='Number of days after which the authorizations which are not '
+        'settled are cancelled. Leave empty to keep them.'
+    )
+
+
+class PaymentTransactionSweeper:
+    "Cancel the stale authorizations"
+    __name__ = 'payment_gateway.transaction'
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(PaymentTransactionSweeper, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        table.index_action(['state', 'date'], 'add')
+
+    @classmethod
+    def sweep_authorizations(cls, chunk_size=100, limit=1000):
+        """
+        Cron entry point which cancels the authorizations older than the
+        hold window of their gateway.
+
+        :param chunk_size: Number of transactions cancelled per batch
+        :param limit: Maximum number of transactions processed per run
+        :return: The number of transactions processed
+        """
+        pool = Pool()
+        Gateway = pool.get('payment_gateway.gateway')
+        Date = pool.get('ir.date')
+
+        processed = 0
+        today = Date.today()
+        gateways = Gateway.search([('authorization_hold', '!=', None)])
+        for gateway in gateways:
+            expired = today - timedelta(days=gateway.authorization_hold)
+            while processed < limit:
+                transactions = cls.claim(
+                    'authorized', min(chunk_size, limit - processed),
+                    where=lambda t: (t.gateway == gateway.id) &
+                    (t.date < expired)
+                )
+                if not transactions:
+                    break
+                # The transactions not cancelled keep their claim, so they
+                # are tried again once their lease has expired
+                cls.release(cls.cancel_stale(gateway, transactions))
+                processed += len(transactions)
+        return processed
+
+    @classmethod
+    def cancel_stale(cls, gateway, transactions):
+        """
+        Cancel stale authorizations of the gateway with its provider and
+        mark the cancelled ones at once.
+
+        :return: The list of cancelled transactions
+        """
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+
+        provider = gateway.provider
+        method_name = 'cancel_%s_many' % provider
+        if hasattr(cls, method_name):
+            try:
+                results = cls.call_provider_many(method_name, transactions)
+            except UserError, exc:
+                cls._log_cancel_error(transactions, exc)
+                return []
+            cls.apply_provider_results('cancel', [
+                (t, (r, None)) for t, r in zip(transactions, results)
+            ])
+            cancelled = [t for t in transactions if t.state == 'cancel']
+        else:
+            cancelled = []
+            method_name = 'cancel_%s' % provider
+            for transaction in transactions:
+                if not hasattr(transaction, method_name):
+                    continue
+                try:
+                    transaction.call_provider(method_name)
+                except UserError, exc:
+                    cls._log_cancel_error([transaction], exc)
+                else:
+                    cancelled.append(transaction)
+
+        if cancelled:
+            # cancel_<provider> may already have saved the state
+            to_cancel = [t for t in cancelled if t.state != 'cancel']
+            if to_cancel:
+                cls.write(to_cancel, {'state': 'cancel'})
+            TransactionLog.create([{
+                'transaction': transaction.id,
+                'log': 'Authorization hold expired',
+            } for transaction in cancelled])
+        return cancelled
+
+    @classmethod
+    def _log_cancel_error(cls, transactions, exc):
+        TransactionLog = Pool().get('payment_gateway.transaction.log')
+
+        TransactionLog.create([{
+            'transaction': transaction.id,
+            'log': 'Cancellation of the expired authorization failed\n%s' % (
+                unicode(exc)),
+        } for transaction in transactions])
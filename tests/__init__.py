@@ -3,6 +3,12 @@ import unittest
 
 import trytond.tests.test_tryton
 from test_transaction import TestTransaction
+from test_card import TestCardData, TestMagstripe, TestCardValidation
+from test_resilience import TestCircuitBreaker, TestTokenBucket, \
+    TestGuardedCall
+from test_http_client import TestProviderClient
+from test_payout import TestPayoutMatching
+from test_uuids import TestTimeOrderedUUID
 
 
 def suite():
@@ -12,6 +18,15 @@ def suite():
     test_suite = trytond.tests.test_tryton.suite()
     test_suite.addTests([
         unittest.TestLoader().loadTestsFromTestCase(TestTransaction),
+        unittest.TestLoader().loadTestsFromTestCase(TestCardData),
+        unittest.TestLoader().loadTestsFromTestCase(TestMagstripe),
+        unittest.TestLoader().loadTestsFromTestCase(TestCardValidation),
+        unittest.TestLoader().loadTestsFromTestCase(TestCircuitBreaker),
+        unittest.TestLoader().loadTestsFromTestCase(TestTokenBucket),
+        unittest.TestLoader().loadTestsFromTestCase(TestGuardedCall),
+        unittest.TestLoader().loadTestsFromTestCase(TestProviderClient),
+        unittest.TestLoader().loadTestsFromTestCase(TestPayoutMatching),
+        unittest.TestLoader().loadTestsFromTestCase(TestTimeOrderedUUID),
     ])
     return test_suite
 
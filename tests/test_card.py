@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from trytond.modules.payment_gateway import magstripe, card_validation
+from trytond.modules.payment_gateway.card_data import CardData, \
+    CardDataStore
+
+TRACK1 = '%B4111111111111111^DOE/JOHN^1811101000000000?'
+TRACK2 = ';4111111111111111=18111010000000000000?'
+
+
+class TestCardData(unittest.TestCase):
+    """
+    Test the in-process card data holder
+    """
+
+    def test_card_data_clear(self):
+        """
+        Test that clearing a card forgets the sensitive information only
+        """
+        card = CardData(
+            owner='John Doe', number='4111111111111111',
+            expiry_month='11', expiry_year='2018', csc='353',
+        )
+        self.assertEqual(card.last_4_digits, '1111')
+        self.assertFalse('4111111111111111' in repr(card))
+
+        card.clear()
+        self.assertEqual(card.number, None)
+        self.assertEqual(card.csc, None)
+        self.assertEqual(card.owner, 'John Doe')
+
+        with self.assertRaises(AttributeError):
+            card.cvv = '353'
+        with self.assertRaises(TypeError):
+            CardData(cvv='353')
+
+    def test_card_data_store_eviction(self):
+        """
+        Test that the store evicts expired and overflowing entries
+        """
+        store = CardDataStore(ttl=60, max_entries=2)
+        cards = [CardData(number=str(i) * 16) for i in range(3)]
+        for i, card in enumerate(cards):
+            store.put(i, card)
+
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.get(0), None)
+        self.assertEqual(cards[0].number, None)
+        self.assertTrue(store.pop(1) is cards[1])
+        self.assertEqual(store.get(1), None)
+
+        expired = CardDataStore(ttl=0)
+        expired.put('key', CardData(number='4111111111111111'))
+        self.assertEqual(expired.get('key'), None)
+
+
+class TestMagstripe(unittest.TestCase):
+    """
+    Test the magnetic stripe parser
+    """
+
+    def test_parse_tracks(self):
+        """
+        Test parsing track 1 and track 2 with and without sentinels
+        """
+        for data in (
+                TRACK1 + '6' + TRACK2 + '5',
+                TRACK1 + TRACK2,
+                TRACK1[1:-1],
+                TRACK2,
+                TRACK2[1:-1],
+                u' %s\n' % TRACK1):
+            swipe = magstripe.parse(data)
+            self.assertEqual(swipe.pan, '4111111111111111')
+            self.assertEqual(swipe.expiry_month, '11')
+            self.assertEqual(swipe.expiry_year, '2018')
+
+        swipe = magstripe.parse(TRACK1 + TRACK2)
+        self.assertEqual(swipe.tracks, (1, 2))
+        self.assertEqual(swipe.name, 'DOE/JOHN')
+        self.assertEqual(swipe.service_code, '101')
+        self.assertEqual(magstripe.parse(TRACK2).name, None)
+
+    def test_parse_invalid(self):
+        """
+        Test that invalid swipes are rejected
+        """
+        for data in (
+                None, '', 'garbage',
+                TRACK1 + '7',  # Wrong LRC
+                TRACK2 + '4',  # Wrong LRC
+                TRACK1.replace('1111^', '1112^'),  # Luhn
+                TRACK1.replace('%B', '%A'),  # Format code
+                TRACK2.replace('=1811', '=1813'),  # Expiry month
+                TRACK1 + TRACK2.replace('41111111', '55555555')):
+            with self.assertRaises(magstripe.MagstripeError):
+                magstripe.parse(data)
+
+    def test_parse_many(self):
+        """
+        Test the batch API
+        """
+        result = magstripe.parse_many([TRACK1, 'garbage', TRACK2])
+        self.assertEqual(len(result), 3)
+        self.assertEqual(result[1], None)
+        self.assertEqual(
+            [swipe.tracks for swipe in (result[0], result[2])], [(1,), (2,)]
+        )
+        with self.assertRaises(magstripe.MagstripeError):
+            magstripe.parse_many([TRACK1, 'garbage'], raise_errors=True)
+
+
+class TestCardValidation(unittest.TestCase):
+    """
+    Test the local card number validation
+    """
+
+    def test_validate(self):
+        """
+        Test the scheme detection and validation of card numbers
+        """
+        for number, scheme in (
+                ('4111111111111111', 'visa'),
+                ('4111 1111 1111 1111', 'visa'),
+                ('5555-5555-5555-4444', 'mastercard'),
+                ('2223000048400011', 'mastercard'),
+                ('378282246310005', 'amex'),
+                ('6011111111111117', 'discover'),
+                ('6221260000000000', 'discover'),
+                ('6200000000000005', 'unionpay'),
+                ('3530111333300000', 'jcb'),
+                ('30569309025904', 'diners'),
+                ('9111111111111110', None)):
+            self.assertEqual(card_validation.validate(number), scheme)
+
+        for number, error in (
+                ('4111x11111111111', 'card_number_not_digits'),
+                (u'\u0664111111111111111', 'card_number_not_digits'),
+                ('', 'card_number_not_digits'),
+                ('411111111111111', 'card_number_length'),
+                ('37828224631000', 'card_number_length'),
+                ('4111111111111112', 'card_number_luhn')):
+            self.assertEqual(card_validation.check(number)[1], error)
+            with self.assertRaises(card_validation.CardValidationError):
+                card_validation.validate(number)
+
+    def test_bin_table(self):
+        """
+        Test the longest prefix lookup and the batch mode
+        """
+        table = card_validation.BinTable([
+            ('short', '4', '4', [16]),
+            ('long', '4000', '4099', [13]),
+        ])
+        self.assertEqual(table.lookup('4111111111111111')[0], 'short')
+        self.assertEqual(table.lookup('4012888888881881')[0], 'long')
+        self.assertEqual(table.lookup('5111111111111111'), None)
+        with self.assertRaises(ValueError):
+            table.add_range('invalid', '51', '5', [16])
+
+        self.assertEqual(
+            card_validation.validate_many(
+                ['4111111111111111', '4012888888881881', '4111111111111112'],
+                table=table,
+            ), [
+                ('short', None),
+                ('long', 'card_number_length'),
+                ('short', 'card_number_luhn'),
+            ]
+        )
+
+
+def suite():
+    "Define suite"
+    test_suite = unittest.TestSuite()
+    for test_case in (TestCardData, TestMagstripe, TestCardValidation):
+        test_suite.addTests(
+            unittest.TestLoader().loadTestsFromTestCase(test_case)
+        )
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
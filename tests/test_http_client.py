@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import socket
+import httplib
+import unittest
+
+from trytond.modules.payment_gateway.http_client import ProviderClient
+from trytond.modules.payment_gateway.dummy_server import DummyProviderServer
+
+
+class TestProviderClient(unittest.TestCase):
+    """
+    Test the pooled HTTP client against the stand-in server
+    """
+
+    def setUp(self):
+        self.server = DummyProviderServer()
+        self.server.start()
+        self.client = ProviderClient(self.server.url, timeout=5, backoff=0)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_keep_alive(self):
+        for _ in range(5):
+            response = self.client.request('POST', '/capture', body='{}')
+            self.assertEqual(response.status, 200)
+            self.assertEqual(json.loads(response.body), {
+                'status': 'succeeded', 'path': '/capture',
+            })
+        self.assertEqual(self.server.counters['connections'], 1)
+        self.assertEqual(self.client.pool.created, 1)
+
+    def test_retry_idempotent(self):
+        response = self.client.request('GET', '/unavailable')
+        self.assertEqual(response.status, 503)
+        # Sent once and retried twice
+        self.assertEqual(self.server.counters['requests'], 3)
+
+        # A charge is never sent twice
+        response = self.client.request('POST', '/unavailable')
+        self.assertEqual(response.status, 503)
+        self.assertEqual(self.server.counters['requests'], 4)
+
+    def test_server_closed_connection(self):
+        self.client.request('GET', '/status')
+        # The server drops the idle connection
+        for connection in self.client.pool.idle:
+            connection.sock.shutdown(socket.SHUT_RDWR)
+        response = self.client.request('POST', '/capture')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(self.server.counters['connections'], 2)
+
+    def test_server_closed_idle_connection(self):
+        self.client.request('GET', '/status')
+        # The server closes the kept alive connection while it is idle
+        for connection in list(self.server.connections):
+            connection.shutdown(socket.SHUT_RDWR)
+        time.sleep(0.1)
+        # The charge is sent on a new connection instead of the closed one
+        response = self.client.request('POST', '/capture')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(self.server.counters['requests'], 2)
+        self.assertEqual(self.server.counters['connections'], 2)
+        self.assertEqual(self.client.pool.created, 2)
+
+    def test_dropped_after_send(self):
+        # The server received the request, a charge is not sent again
+        self.client.request('GET', '/status')
+        with self.assertRaises(httplib.BadStatusLine):
+            self.client.request('POST', '/dropped')
+        self.assertEqual(self.server.counters['requests'], 2)
+
+        # An idempotent request is retried
+        with self.assertRaises(httplib.BadStatusLine):
+            self.client.request('GET', '/dropped')
+        self.assertEqual(self.server.counters['requests'], 5)
+
+
+def suite():
+    "Define suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestProviderClient)
+    )
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import random
+import unittest
+
+from trytond.modules.payment_gateway.payout import find_day_run, \
+    find_subset_sum
+
+
+class TestPayoutMatching(unittest.TestCase):
+    """
+    Test the search of the transactions covered by a payout
+    """
+
+    def test_day_run(self):
+        days = [('d1', 100), ('d2', 250), ('d3', 50), ('d4', 395)]
+        self.assertEqual(find_day_run(days, 300, 300), ['d2', 'd3'])
+        # The nearest total within the tolerance
+        self.assertEqual(find_day_run(days, 390, 420), ['d4'])
+        self.assertIsNone(find_day_run(days, 10, 20))
+
+    def test_subset_sum(self):
+        amounts = [500, 320, -120, 75, 1000]
+        subset = find_subset_sum(amounts, 455, 455)
+        self.assertEqual(sum(amounts[i] for i in subset), 455)
+        self.assertEqual(len(set(subset)), len(subset))
+        self.assertIsNone(find_subset_sum(amounts, 1, 2))
+
+    def test_subset_sum_tolerance(self):
+        amounts = [1000, 2000, 4000]
+        subset = find_subset_sum(amounts, 2990, 3010)
+        self.assertEqual(sorted(amounts[i] for i in subset), [1000, 2000])
+
+    def test_subset_sum_many(self):
+        generator = random.Random(42)
+        amounts = [generator.randint(100, 5000) for _ in xrange(400)]
+        chosen = generator.sample(xrange(len(amounts)), 30)
+        target = sum(amounts[i] for i in chosen)
+        subset = find_subset_sum(amounts, target, target)
+        self.assertEqual(sum(amounts[i] for i in subset), target)
+
+    def test_subset_sum_max_bits(self):
+        self.assertIsNone(find_subset_sum(
+            [10 ** 6] * 10, 10 ** 6, 10 ** 6, max_bits=10 ** 6
+        ))
+
+
+def suite():
+    "Define suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestPayoutMatching)
+    )
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
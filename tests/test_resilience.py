@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from trytond.modules.payment_gateway.async_provider import guarded_call
+from trytond.modules.payment_gateway.circuit_breaker import CircuitBreaker, \
+    CircuitOpen
+from trytond.modules.payment_gateway.rate_limit import TokenBucket, \
+    RateLimitTimeout
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """
+    Test the circuit breaker
+    """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(
+            error_rate=50, min_calls=4, window=60, open_duration=30,
+            slow_call=2, clock=self.clock
+        )
+
+    def test_open_on_error_rate(self):
+        for success in (True, False, True):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record(success)
+        # Not enough calls yet
+        self.assertEqual(self.breaker.state, 'closed')
+
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.retry_at, 1030.0)
+
+    def test_slow_calls(self):
+        for _ in range(4):
+            self.breaker.record(True, duration=3)
+        self.assertEqual(self.breaker.state, 'open')
+
+    def test_window(self):
+        self.breaker.record(False)
+        self.breaker.record(False)
+        self.clock.now += 120
+        self.breaker.record(True)
+        self.breaker.record(True)
+        self.breaker.record(False)
+        # The old failures left the window
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_half_open(self):
+        for _ in range(4):
+            self.breaker.record(False)
+        self.clock.now += 31
+        self.assertEqual(self.breaker.state, 'half_open')
+
+        # Only one trial call at a time
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, 'open')
+
+        self.clock.now += 31
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(True)
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertTrue(self.breaker.allow())
+
+
+class TestTokenBucket(unittest.TestCase):
+    """
+    Test the token bucket of the rate limiter
+    """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.bucket = TokenBucket(
+            2, capacity=2, clock=self.clock, sleep=self.clock.sleep
+        )
+
+    def test_burst(self):
+        self.assertEqual(self.bucket.take(), 0)
+        self.assertEqual(self.bucket.take(), 0)
+        # The bucket is empty, a token comes every half second
+        self.assertEqual(self.bucket.take(), 0.5)
+        self.assertEqual(self.clock.now, 1000.5)
+        self.assertEqual(self.bucket.calls, 3)
+        self.assertEqual(self.bucket.waits, 1)
+        self.assertEqual(self.bucket.wait_time, 0.5)
+
+    def test_refill(self):
+        self.bucket.take()
+        self.bucket.take()
+        self.clock.now += 10
+        # No more than the capacity is refilled
+        self.assertEqual(self.bucket.take(), 0)
+        self.assertEqual(self.bucket.take(), 0)
+        self.assertEqual(self.bucket.take(), 0.5)
+
+    def test_timeout(self):
+        self.bucket.take()
+        self.bucket.take()
+        self.assertRaises(RateLimitTimeout, self.bucket.take, 0.1)
+        # The token was not reserved
+        self.assertEqual(self.bucket.take(0.5), 0.5)
+
+
+class TestGuardedCall(unittest.TestCase):
+    """
+    Test the guard of the concurrent provider calls
+    """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(
+            error_rate=50, min_calls=1, open_duration=30, clock=self.clock
+        )
+        self.bucket = TokenBucket(
+            1, capacity=1, clock=self.clock, sleep=self.clock.sleep
+        )
+
+    def test_rate_limit_before_trial(self):
+        self.breaker.record(False)
+        self.clock.now += 31
+        self.bucket.take()
+        call = guarded_call(
+            lambda request: 'done', breaker=self.breaker,
+            wait=lambda request: self.bucket.take(0.1)
+        )
+        # The call timed out waiting without taking the trial call
+        self.assertRaises(RateLimitTimeout, call, {})
+        self.assertEqual(self.breaker.state, 'half_open')
+
+        self.clock.now += 1
+        self.assertEqual(call({}), 'done')
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_circuit_open(self):
+        self.breaker.record(False)
+        call = guarded_call(lambda request: 'done', breaker=self.breaker)
+        self.assertRaises(CircuitOpen, call, {})
+
+
+def suite():
+    "Define suite"
+    test_suite = unittest.TestSuite()
+    for test_case in (TestCircuitBreaker, TestTokenBucket, TestGuardedCall):
+        test_suite.addTests(
+            unittest.TestLoader().loadTestsFromTestCase(test_case)
+        )
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
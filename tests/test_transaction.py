@@ -1,14 +1,23 @@
 # -*- coding: utf-8 -*-
+import os
+import re
+import csv
+import json
+import time
 import unittest
 import datetime
+import tempfile
 from dateutil.relativedelta import relativedelta
 
 from trytond.tests.test_tryton import (
     USER, CONTEXT, POOL, ModuleTestCase, with_transaction
 )
 import trytond.tests.test_tryton
+from trytond import backend
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
+from trytond.modules.payment_gateway.dummy_server import \
+    DummyProviderServer
 
 
 class TestTransaction(ModuleTestCase):
@@ -568,6 +577,1735 @@ class TestTransaction(ModuleTestCase):
             self.assertTrue(
                 "Deleted account move" in transaction.logs[0].log)
 
+    @with_transaction()
+    def test_0270_use_card_wizard_keeps_card_out_of_session(self):
+        """
+        Test that the card used in the use card wizard is passed to the
+        provider but never saved in the wizard session
+        """
+        UseCardWizard = POOL.get(
+            'payment_gateway.transaction.use_card', type='wizard'
+        )
+        Session = POOL.get('ir.session.wizard')
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+            }])
+            transaction, = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+                'amount': 400,
+            }])
+
+            session_id, _, _ = UseCardWizard.create()
+            with Transaction().set_context(active_id=transaction.id):
+                UseCardWizard.execute(session_id, {
+                    'card_info': {
+                        'owner': self.party.name,
+                        'number': '4111111111111111',
+                        'expiry_month': '11',
+                        'expiry_year': '2018',
+                        'csc': '353',
+                    },
+                }, 'capture')
+
+            self.assertEqual(transaction.state, 'posted')
+            session = Session(session_id)
+            self.assertFalse('4111111111111111' in session.data)
+            self.assertFalse('353' in session.data)
+
+    @with_transaction()
+    def test_0275_use_card_wizard_rejects_invalid_card(self):
+        """
+        Test that an invalid card number never reaches the provider
+        """
+        UseCardWizard = POOL.get(
+            'payment_gateway.transaction.use_card', type='wizard'
+        )
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+            }])
+            transaction, = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+                'amount': 400,
+            }])
+
+            session_id, _, _ = UseCardWizard.create()
+            with Transaction().set_context(active_id=transaction.id):
+                with self.assertRaises(UserError):
+                    UseCardWizard.execute(session_id, {
+                        'card_info': {
+                            'owner': self.party.name,
+                            'number': '4111111111111112',
+                            'expiry_month': '11',
+                            'expiry_year': '2018',
+                            'csc': '353',
+                        },
+                    }, 'authorize')
+
+            self.assertEqual(transaction.state, 'draft')
+
+    @with_transaction()
+    def test_0280_use_card_view_swipe_data(self):
+        """
+        Test that swiping a card fills in the card information
+        """
+        UseCardView = POOL.get('payment_gateway.transaction.use_card.view')
+
+        view = UseCardView(owner='Test party')
+        view.swipe_data = ';4111111111111111=18111010000000000000?'
+        view.on_change_swipe_data()
+        self.assertEqual(view.owner, 'Test party')
+        self.assertEqual(view.number, '4111111111111111')
+        self.assertEqual(view.expiry_month, '11')
+        self.assertEqual(view.expiry_year, '2018')
+
+        view.swipe_data = '%B4111111111111111^DOE/JOHN^1811101000000000?'
+        view.on_change_swipe_data()
+        self.assertEqual(view.owner, 'DOE/JOHN')
+
+        view.swipe_data = 'garbage'
+        view.on_change_swipe_data()
+        self.assertEqual(view.number, '')
+
+    @with_transaction()
+    def test_0290_payment_profile_expiry_date(self):
+        """
+        Test the expiry date of payment profiles and streaming the
+        expiring ones
+        """
+        PaymentProfile = POOL.get('party.payment_profile')
+        self.setup_defaults()
+
+        with Transaction().set_context(use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+            }])
+        profiles = PaymentProfile.create([{
+            'party': self.party.id,
+            'address': self.party.addresses[0].id,
+            'gateway': gateway.id,
+            'provider_reference': str(month),
+            'last_4_digits': '1111',
+            'expiry_month': '%02d' % month,
+            'expiry_year': '2018',
+        } for month in range(1, 13)])
+
+        self.assertEqual(
+            profiles[1].expiry_date, datetime.date(2018, 2, 28)
+        )
+        self.assertEqual(
+            profiles[11].expiry_date, datetime.date(2018, 12, 31)
+        )
+
+        PaymentProfile.write([profiles[0]], {'expiry_year': '2020'})
+        self.assertEqual(
+            profiles[0].expiry_date, datetime.date(2020, 1, 31)
+        )
+
+        chunks = list(PaymentProfile.search_expiring(
+            datetime.date(2018, 7, 1), gateway=gateway, chunk_size=2
+        ))
+        self.assertEqual(map(len, chunks), [2, 2, 1])
+        # The pages follow the expiry dates
+        self.assertEqual(
+            [p.expiry_month for chunk in chunks for p in chunk],
+            ['02', '03', '04', '05', '06']
+        )
+        self.assertEqual(
+            len(list(PaymentProfile.search_expiring(
+                datetime.date(2018, 7, 1), after=datetime.date(2018, 5, 1)
+            ))[0]), 2
+        )
+
+    @with_transaction()
+    def test_0300_payment_profile_add_reuses_same_card(self):
+        """
+        Test that adding the same card twice does not duplicate the profile
+        """
+        AddPaymentProfileWizard = POOL.get(
+            'party.party.payment_profile.add', type='wizard'
+        )
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+            }])
+
+            for csc, expiry_year in (
+                    ('353', '2018'), ('354', '2018'), ('355', '2019')):
+                profile_wiz = AddPaymentProfileWizard(
+                    AddPaymentProfileWizard.create()[0]
+                )
+                profile_wiz.card_info.party = self.party.id
+                profile_wiz.card_info.address = self.party.addresses[0].id
+                profile_wiz.card_info.gateway = gateway
+                profile_wiz.card_info.owner = self.party.name
+                profile_wiz.card_info.number = '4111111111111111'
+                profile_wiz.card_info.expiry_month = '11'
+                profile_wiz.card_info.expiry_year = expiry_year
+                profile_wiz.card_info.csc = csc
+                profile_wiz.transition_add()
+
+            self.assertEqual(
+                sorted(p.provider_reference for p in
+                       self.Party(self.party.id).payment_profiles),
+                ['354', '355']
+            )
+
+    @with_transaction()
+    def test_0310_payment_profile_merge_duplicates(self):
+        """
+        Test merging the existing duplicate payment profiles
+        """
+        PaymentProfile = POOL.get('party.payment_profile')
+        self.setup_defaults()
+
+        gateway, = self.PaymentGateway.create([{
+            'name': 'Test Gateway',
+            'journal': self.cash_journal.id,
+            'provider': 'self',
+            'method': 'manual',
+        }])
+        profiles = PaymentProfile.create([{
+            'party': self.party.id,
+            'address': self.party.addresses[0].id,
+            'gateway': gateway.id,
+            'provider_reference': reference,
+            'last_4_digits': last_4_digits,
+            'expiry_month': '11',
+            'expiry_year': '2018',
+        } for reference, last_4_digits in (
+            ('a', '1111'), ('b', '1111'), ('c', '1111'), ('d', '4242'),
+        )])
+
+        with Transaction().set_context(company=self.company.id):
+            transactions = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+                'payment_profile': profile.id,
+                'amount': 400,
+            } for profile in profiles])
+
+        self.assertEqual(PaymentProfile.merge_duplicates(), 2)
+        self.assertEqual(PaymentProfile.merge_duplicates(), 0)
+
+        self.assertEqual(
+            sorted(p.provider_reference for p in PaymentProfile.search([])),
+            ['c', 'd']
+        )
+        self.assertEqual([
+            self.PaymentGatewayTransaction(t.id).payment_profile
+            .provider_reference for t in transactions
+        ], ['c', 'c', 'c', 'd'])
+
+    @with_transaction()
+    def test_0320_payment_profile_import_tokens(self):
+        """
+        Test the bulk import of payment profiles from a token file
+        """
+        PaymentProfile = POOL.get('party.payment_profile')
+        self.setup_defaults()
+
+        gateway, = self.PaymentGateway.create([{
+            'name': 'Test Gateway',
+            'journal': self.cash_journal.id,
+            'provider': 'self',
+            'method': 'manual',
+        }])
+        address = self.party.addresses[0]
+
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        checkpoint_path = path + '.checkpoint'
+        with os.fdopen(fd, 'w') as token_file:
+            token_file.write(
+                'party,address,gateway,provider_reference,last_4_digits,'
+                'expiry\n'
+                '%(party)s,,Test Gateway,tok_1,1111,11/18\n'
+                '%(party)s,%(address)s,Test Gateway,tok_2,4242,01/2019\n'
+                'unknown,,Test Gateway,tok_3,1111,11/18\n'
+                '%(party)s,,Unknown Gateway,tok_4,1111,11/18\n'
+                '%(party)s,,Test Gateway,tok_5,1111,13/18\n'
+                '%(party)s,,Test Gateway,tok_1,1111,11/18\n'
+                '%(party)s,,Test Gateway,tok_6,5555,12/20\n' % {
+                    'party': self.party.code, 'address': address.id,
+                }
+            )
+        errors_path = path + '.errors'
+        try:
+            result = PaymentProfile.import_tokens(
+                path, checkpoint_path=checkpoint_path, chunk_size=2,
+                commit=False, errors_path=errors_path
+            )
+            self.assertEqual(result['created'], 3)
+            self.assertEqual(result['skipped'], 1)
+            self.assertEqual(result['errors'], 3)
+            with open(errors_path) as errors_file:
+                self.assertEqual(
+                    [row[0] for row in csv.reader(errors_file)],
+                    ['4', '5', '6']
+                )
+            with open(checkpoint_path) as checkpoint_file:
+                self.assertEqual(json.load(checkpoint_file)['errors'], 3)
+
+            profiles = PaymentProfile.search(
+                [], order=[('provider_reference', 'ASC')]
+            )
+            self.assertEqual(
+                [p.provider_reference for p in profiles],
+                ['tok_1', 'tok_2', 'tok_6']
+            )
+            self.assertEqual(profiles[0].address, address)
+            self.assertEqual(
+                profiles[1].expiry_date, datetime.date(2019, 1, 31)
+            )
+
+            # Resuming from the checkpoint has nothing left to import
+            result = PaymentProfile.import_tokens(
+                path, checkpoint_path=checkpoint_path, commit=False
+            )
+            self.assertEqual(result['created'], 3)
+            self.assertEqual(PaymentProfile.search([], count=True), 3)
+        finally:
+            for file_path in (path, checkpoint_path, errors_path):
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+
+    @with_transaction()
+    def test_0330_poll_in_progress(self):
+        """
+        Test polling the status of in-progress transactions with backoff
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+            }])
+            transactions = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+                'amount': 400,
+            } for _ in range(3)])
+            self.PaymentGatewayTransaction.write(
+                transactions, {'state': 'in-progress'}
+            )
+            self.assertTrue(all(t.next_poll for t in transactions))
+
+            with Transaction().set_context(dummy_succeed=False):
+                self.assertEqual(
+                    self.PaymentGatewayTransaction.poll_in_progress(
+                        chunk_size=2
+                    ), 3
+                )
+                # Nothing is due until the backoff has elapsed
+                self.assertEqual(
+                    self.PaymentGatewayTransaction.poll_in_progress(), 0
+                )
+            for transaction in transactions:
+                self.assertEqual(transaction.state, 'in-progress')
+                self.assertEqual(transaction.poll_attempts, 1)
+                self.assertTrue(
+                    transaction.next_poll > datetime.datetime.utcnow()
+                )
+
+            # The provider saves the state again, the backoff grows
+            self.PaymentGatewayTransaction.write(
+                transactions[2:], {'next_poll': datetime.datetime(2000, 1, 1)}
+            )
+            with Transaction().set_context(dummy_succeed=False):
+                self.assertEqual(
+                    self.PaymentGatewayTransaction.poll_in_progress(), 1
+                )
+            self.assertEqual(transactions[2].poll_attempts, 2)
+            self.assertTrue(
+                transactions[2].next_poll >
+                datetime.datetime.utcnow() + datetime.timedelta(seconds=90)
+            )
+
+            self.PaymentGatewayTransaction.write(
+                transactions[:1], {'next_poll': datetime.datetime(2000, 1, 1)}
+            )
+            self.assertEqual(
+                self.PaymentGatewayTransaction.poll_in_progress(), 1
+            )
+            self.assertEqual(transactions[0].state, 'posted')
+            self.assertEqual(transactions[1].state, 'in-progress')
+
+            # Moving back to in-progress restarts the backoff
+            self.PaymentGatewayTransaction.write(
+                transactions[1:2], {'state': 'failed'}
+            )
+            self.PaymentGatewayTransaction.write(
+                transactions[1:2], {'state': 'in-progress'}
+            )
+            self.assertEqual(transactions[1].poll_attempts, 0)
+            self.assertTrue(
+                transactions[1].next_poll <= datetime.datetime.utcnow()
+            )
+
+    @with_transaction()
+    def test_0340_retry_failed(self):
+        """
+        Test the automatic retry of failed charges
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+                'retry_max_attempts': 2,
+                'retry_interval': 10,
+                'retry_backoff': 'exponential',
+            }])
+            transactions = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+                'amount': 400,
+            } for _ in range(2)])
+            self.PaymentGatewayTransaction.write(
+                transactions, {'state': 'in-progress'}
+            )
+            self.PaymentGatewayTransaction.write(
+                transactions, {'state': 'failed'}
+            )
+            for transaction in transactions:
+                self.assertTrue(
+                    transaction.next_retry > datetime.datetime.utcnow()
+                )
+            # Nothing is due yet
+            self.assertEqual(
+                self.PaymentGatewayTransaction.process_retries(), 0
+            )
+
+            past = datetime.datetime(2000, 1, 1)
+            self.PaymentGatewayTransaction.write(
+                transactions, {'next_retry': past}
+            )
+            with Transaction().set_context(dummy_succeed=False):
+                self.assertEqual(
+                    self.PaymentGatewayTransaction.process_retries(
+                        chunk_size=1
+                    ), 2
+                )
+            for transaction in transactions:
+                self.assertEqual(transaction.state, 'failed')
+                self.assertEqual(transaction.retry_attempts, 1)
+                # The interval is doubled after the first retry
+                self.assertTrue(
+                    transaction.next_retry > datetime.datetime.utcnow() +
+                    datetime.timedelta(minutes=15)
+                )
+
+            self.PaymentGatewayTransaction.write(
+                transactions, {'next_retry': past}
+            )
+            with Transaction().set_context(dummy_succeed=False):
+                self.PaymentGatewayTransaction.process_retries(limit=1)
+            self.PaymentGatewayTransaction.process_retries()
+
+            # The last attempt is not rescheduled
+            self.assertEqual(transactions[0].state, 'failed')
+            self.assertEqual(transactions[0].retry_attempts, 2)
+            self.assertIsNone(transactions[0].next_retry)
+            self.assertEqual(transactions[1].state, 'posted')
+            self.assertEqual(transactions[1].retry_attempts, 2)
+
+    @with_transaction()
+    def test_0350_claim(self):
+        """
+        Test claiming transactions by several workers
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Test Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'self',
+                'method': 'manual',
+            }])
+            transactions = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+                'amount': 400,
+                'state': 'completed',
+            } for _ in range(3)])
+
+            claimed_a = self.PaymentGatewayTransaction.claim(
+                'completed', 2, worker='a'
+            )
+            claimed_b = self.PaymentGatewayTransaction.claim(
+                'completed', 2, worker='b'
+            )
+            self.assertEqual(len(claimed_a), 2)
+            self.assertEqual(len(claimed_b), 1)
+            self.assertFalse(set(claimed_a) & set(claimed_b))
+            self.assertEqual(claimed_a[0].claimed_by, 'a')
+            self.assertEqual(
+                self.PaymentGatewayTransaction.claim('completed', 2), []
+            )
+
+            # The claim of a dead worker expires
+            self.PaymentGatewayTransaction.write(claimed_a[:1], {
+                'claim_expires': datetime.datetime(2000, 1, 1),
+            })
+            claimed_c = self.PaymentGatewayTransaction.claim(
+                'completed', 2, worker='c'
+            )
+            self.assertEqual(claimed_c, claimed_a[:1])
+
+            self.PaymentGatewayTransaction.release(transactions)
+            self.assertIsNone(transactions[0].claimed_by)
+
+            self.assertEqual(
+                self.PaymentGatewayTransaction.post_completed(chunk_size=2), 3
+            )
+            for transaction in transactions:
+                self.assertEqual(transaction.state, 'posted')
+                self.assertIsNone(transaction.claim_expires)
+
+    @with_transaction()
+    def test_0360_sweep_authorizations(self):
+        """
+        Test the cancellation of the authorizations whose hold expired
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+                'authorization_hold': 7,
+            }])
+            today = datetime.date.today()
+            transactions = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+                'amount': 400,
+                'state': 'authorized',
+                'date': today - datetime.timedelta(days=days),
+            } for days in (1, 10, 30)])
+
+            with Transaction().set_context(dummy_succeed=False):
+                self.assertEqual(
+                    self.PaymentGatewayTransaction.sweep_authorizations(), 2
+                )
+            self.assertEqual(
+                [t.state for t in transactions],
+                ['authorized', 'authorized', 'authorized']
+            )
+
+            # The failed ones are swept again once their claim expired
+            self.PaymentGatewayTransaction.release(transactions)
+            self.assertEqual(
+                self.PaymentGatewayTransaction.sweep_authorizations(
+                    chunk_size=1
+                ), 2
+            )
+            self.assertEqual(
+                [t.state for t in transactions],
+                ['authorized', 'cancel', 'cancel']
+            )
+            self.assertEqual(len(transactions[1].logs), 1)
+
+    @with_transaction()
+    def test_0370_circuit_breaker(self):
+        """
+        Test the circuit breaker of a gateway whose provider fails
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+                'breaker_error_rate': 50,
+                'breaker_min_calls': 2,
+                'breaker_open_duration': 60,
+                'breaker_mode': 'fail',
+            }])
+            self.assertEqual(gateway.breaker_state, 'closed')
+            transactions = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+                'amount': 400,
+            } for _ in range(4)])
+
+            with Transaction().set_context(dummy_error=True):
+                for transaction in transactions[:2]:
+                    with self.assertRaises(UserError):
+                        transaction.call_provider('capture_dummy')
+            self.assertEqual(gateway.breaker_state, 'open')
+
+            # The provider is not called anymore
+            with self.assertRaises(UserError) as context:
+                transactions[2].call_provider('capture_dummy')
+            self.assertIn('unavailable, try again', unicode(context.exception))
+            self.assertEqual(transactions[2].state, 'draft')
+
+            # In queue mode the charge waits for the retry worker
+            gateway.breaker_mode = 'queue'
+            gateway.save()
+            self.PaymentGatewayTransaction.capture(transactions[3:])
+            self.assertEqual(transactions[3].state, 'failed')
+            self.assertTrue(
+                transactions[3].next_retry > datetime.datetime.utcnow()
+            )
+
+    @with_transaction()
+    def test_0380_rate_limit(self):
+        """
+        Test the rate limit of the calls to the provider of a gateway
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+                'rate_limit': 0.01,
+                'rate_limit_burst': 1,
+                'rate_limit_timeout': 1,
+                'breaker_error_rate': 50,
+                'breaker_min_calls': 1,
+            }])
+            gateway.get_circuit_breaker().reset()
+            transactions = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+                'amount': 400,
+            } for _ in range(2)])
+
+            self.PaymentGatewayTransaction.capture(transactions[:1])
+            self.assertEqual(transactions[0].state, 'posted')
+            # The next token comes in 100 seconds
+            with self.assertRaises(UserError):
+                self.PaymentGatewayTransaction.capture(transactions[1:])
+            self.assertEqual(gateway.rate_limit_calls, 1)
+            self.assertEqual(gateway.rate_limit_waits, 0)
+            # Waiting for a token is not a failure of the provider
+            self.assertEqual(gateway.breaker_state, 'closed')
+
+    @with_transaction()
+    def test_0390_dummy_server(self):
+        """
+        Test the dummy provider going through the stand-in server
+        """
+        self.setup_defaults()
+
+        server = DummyProviderServer()
+        server.start()
+        self.addCleanup(server.stop)
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True,
+                dummy_server_url=server.url):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+            }])
+            transactions = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+                'amount': 400,
+            } for _ in range(3)])
+
+            self.PaymentGatewayTransaction.capture(transactions)
+            for transaction in transactions:
+                self.assertEqual(transaction.state, 'posted')
+            # The connection is reused
+            self.assertEqual(server.counters['requests'], 3)
+            self.assertEqual(server.counters['connections'], 1)
+
+    @with_transaction()
+    def test_0400_concurrent_capture(self):
+        """
+        Test capturing a batch with concurrent provider calls
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+                'concurrency': 4,
+            }])
+            transactions = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+                'amount': 400,
+            } for _ in range(8)])
+
+            with Transaction().set_context(dummy_latency=0.5):
+                start = time.time()
+                self.PaymentGatewayTransaction.capture(transactions[:4])
+                # The calls are made at once, not in 2 seconds
+                self.assertLess(time.time() - start, 1.5)
+            for transaction in transactions[:4]:
+                self.assertEqual(transaction.state, 'posted')
+
+            with Transaction().set_context(dummy_succeed=False):
+                self.PaymentGatewayTransaction.capture(transactions[4:6])
+            with Transaction().set_context(dummy_error=True):
+                self.PaymentGatewayTransaction.capture(transactions[6:])
+            for transaction in transactions[4:]:
+                self.assertEqual(transaction.state, 'failed')
+            self.assertEqual(len(transactions[4].logs), 0)
+            self.assertIn(
+                'The dummy provider is unavailable',
+                transactions[6].logs[0].log
+            )
+
+    @with_transaction()
+    def test_0410_batch_capture(self):
+        """
+        Test capturing a batch with the batch method of the provider
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+                'batch_size': 2,
+            }])
+            transactions = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+                'amount': 400,
+            } for _ in range(7)])
+
+            with Transaction().set_context(dummy_fail_every=2):
+                self.PaymentGatewayTransaction.capture(transactions[:5])
+            # The chunks of 2 fail on their second transaction
+            self.assertEqual(
+                [t.state for t in transactions[:5]],
+                ['posted', 'failed', 'posted', 'failed', 'posted']
+            )
+
+            with Transaction().set_context(dummy_error=True):
+                self.PaymentGatewayTransaction.capture(transactions[5:])
+            for transaction in transactions[5:]:
+                self.assertEqual(transaction.state, 'failed')
+                self.assertIn(
+                    'The dummy provider is unavailable',
+                    transaction.logs[0].log
+                )
+
+            # With the breaker open in queue mode, the batch waits for the
+            # retry worker
+            gateway.breaker_error_rate = 50
+            gateway.breaker_min_calls = 1
+            gateway.breaker_open_duration = 60
+            gateway.breaker_mode = 'queue'
+            gateway.save()
+            queued = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+                'amount': 400,
+            } for _ in range(3)])
+            breaker = gateway.get_circuit_breaker()
+            breaker.reset()
+            breaker.record(False)
+            self.PaymentGatewayTransaction.capture(queued)
+            for transaction in queued:
+                self.assertEqual(transaction.state, 'failed')
+                self.assertTrue(
+                    transaction.next_retry > datetime.datetime.utcnow()
+                )
+                self.assertIn('Queued', transaction.logs[0].log)
+            breaker.reset()
+
+    @with_transaction()
+    def test_0420_idempotency_key(self):
+        """
+        Test that a call already made to the provider is replayed
+        """
+        IdempotencyKey = POOL.get('payment_gateway.idempotency_key')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+            }])
+            transaction, declined, pending = \
+                self.PaymentGatewayTransaction.create([{
+                    'party': self.party.id,
+                    'credit_account': self.party.account_receivable.id,
+                    'address': self.party.addresses[0].id,
+                    'gateway': gateway.id,
+                    'amount': 400,
+                } for _ in range(3)])
+
+            self.PaymentGatewayTransaction.authorize([transaction])
+            self.assertEqual(transaction.state, 'authorized')
+            key, = IdempotencyKey.search([
+                ('transaction_uuid', '=', transaction.uuid),
+            ])
+            self.assertEqual(key.verb, 'authorize')
+            self.assertEqual(key.state, 'done')
+
+            # The state written after the call is lost, as if the Tryton
+            # transaction was rolled back
+            self.PaymentGatewayTransaction.write(
+                [transaction], {'state': 'draft'}
+            )
+            # The provider is not called again
+            with Transaction().set_context(dummy_error=True):
+                self.PaymentGatewayTransaction.authorize([transaction])
+            self.assertEqual(transaction.state, 'authorized')
+            self.assertIn('replayed', transaction.logs[0].log)
+            self.assertEqual(IdempotencyKey.search([
+                ('transaction_uuid', '=', transaction.uuid),
+            ], count=True), 1)
+
+            # A declined call is made again with a new key
+            with Transaction().set_context(dummy_succeed=False):
+                self.PaymentGatewayTransaction.authorize([declined])
+            self.assertEqual(declined.state, 'failed')
+            self.PaymentGatewayTransaction.write(
+                [declined], {'state': 'draft'}
+            )
+            self.PaymentGatewayTransaction.authorize([declined])
+            self.assertEqual(declined.state, 'authorized')
+            keys = IdempotencyKey.search([
+                ('transaction_uuid', '=', declined.uuid),
+            ], order=[('attempt', 'ASC')])
+            self.assertEqual([k.attempt for k in keys], [0, 1])
+            self.assertNotEqual(keys[0].key, keys[1].key)
+
+            # The provider leaves the new state to the workflow, the call
+            # is replayed all the same
+            with Transaction().set_context(dummy_keep_state=True):
+                self.PaymentGatewayTransaction.authorize([pending])
+            self.assertEqual(pending.state, 'in-progress')
+            self.PaymentGatewayTransaction.write(
+                [pending], {'state': 'draft'}
+            )
+            with Transaction().set_context(dummy_error=True):
+                self.PaymentGatewayTransaction.authorize([pending])
+            self.assertEqual(pending.state, 'in-progress')
+            self.assertIn('replayed', pending.logs[0].log)
+            self.assertEqual(IdempotencyKey.search([
+                ('transaction_uuid', '=', pending.uuid),
+            ], count=True), 1)
+
+    @with_transaction()
+    def test_0430_webhook_events(self):
+        """
+        Test receiving and applying the webhook events of a provider
+        """
+        WebhookEvent = POOL.get('payment_gateway.webhook_event')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+            }])
+            settled, cancelled = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+                'amount': 400,
+                'state': 'in-progress',
+                'provider_reference': reference,
+            } for reference in ('ch_1', 'ch_2')])
+
+            body = json.dumps([{
+                'id': 'evt_2',
+                'type': 'settled',
+                'provider_reference': 'ch_1',
+                'occurred': '2016-01-01T11:00:01+01:00',
+            }, {
+                'id': 'evt_1',
+                'type': 'authorized',
+                'provider_reference': 'ch_1',
+                'occurred': '2016-01-01T10:00:00.000000',
+            }, {
+                'id': 'evt_3',
+                'type': 'cancelled',
+                'provider_reference': 'ch_2',
+            }, {
+                'id': 'evt_4',
+                'type': 'failed',
+                'provider_reference': 'ch_2',
+            }, {
+                'id': 'evt_5',
+                'type': 'settled',
+                'provider_reference': 'ch_unknown',
+            }])
+            self.assertEqual(WebhookEvent.receive(gateway.id, body), 5)
+            # The events sent again are dropped
+            self.assertEqual(WebhookEvent.receive(gateway.id, body), 0)
+
+            self.assertEqual(WebhookEvent.process(), 5)
+            # Only the unmatched event is tried again
+            self.assertEqual(WebhookEvent.process(), 1)
+
+            # Applied in the order of the provider
+            self.assertEqual(settled.state, 'posted')
+            self.assertEqual(cancelled.state, 'cancel')
+            events = dict(
+                (e.event_id, e) for e in WebhookEvent.search([])
+            )
+            self.assertEqual(events['evt_1'].state, 'done')
+            self.assertEqual(events['evt_1'].transaction, settled)
+            self.assertEqual(events['evt_2'].state, 'done')
+            self.assertEqual(events['evt_3'].state, 'done')
+            self.assertEqual(events['evt_4'].state, 'ignored')
+            self.assertEqual(events['evt_5'].state, 'unmatched')
+
+            # The reference of the transaction is stored after the event
+            late, = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+                'amount': 400,
+                'state': 'in-progress',
+                'provider_reference': 'ch_unknown',
+            }])
+            self.assertEqual(WebhookEvent.process(), 1)
+            self.assertEqual(late.state, 'posted')
+            self.assertEqual(events['evt_5'].state, 'done')
+            self.assertEqual(events['evt_5'].transaction, late)
+
+    @with_transaction()
+    def test_0440_post_aggregated(self):
+        """
+        Test posting the transactions of a day in one move
+        """
+        Date = POOL.get('ir.date')
+        Account = POOL.get('account.account')
+        Move = POOL.get('account.move')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+                'posting_mode': 'daily',
+            }])
+            charges = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+                'amount': amount,
+            } for amount in (100, 200, 300)])
+            refund, = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+                'amount': 50,
+                'type': 'refund',
+                'state': 'completed',
+            }])
+
+            self.PaymentGatewayTransaction.capture(charges)
+            self.PaymentGatewayTransaction.post_completed()
+            for transaction in charges + [refund]:
+                self.assertEqual(transaction.state, 'completed')
+                self.assertIsNone(transaction.move)
+
+            # The day is not over
+            self.assertEqual(
+                self.PaymentGatewayTransaction.post_aggregated(commit=False), 0
+            )
+
+            # A day without fiscal year can not be posted
+            old, = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+                'amount': 10,
+                'state': 'completed',
+                'date': Date.today() - relativedelta(years=10),
+            }])
+            # A move on an inactive account fails once created
+            inactive_gateway, = self.PaymentGateway.copy([gateway])
+            inactive_account, = Account.copy([self.party.account_receivable])
+            inactive, = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': inactive_account.id,
+                'address': self.party.addresses[0].id,
+                'gateway': inactive_gateway.id,
+                'amount': 10,
+                'state': 'completed',
+            }])
+            Account.write([inactive_account], {'active': False})
+
+            tomorrow = Date.today() + datetime.timedelta(days=1)
+            self.assertEqual(
+                self.PaymentGatewayTransaction.post_aggregated(
+                    tomorrow, commit=False), 1
+            )
+            self.assertEqual(old.state, 'completed')
+            self.assertIn('Could not post the daily move', old.logs[0].log)
+            self.assertEqual(inactive.state, 'completed')
+            self.assertIsNone(inactive.move)
+            self.assertIn(
+                'Could not post the daily move', inactive.logs[0].log
+            )
+            self.assertEqual(Move.search([('state', '=', 'draft')]), [])
+            move = charges[0].move
+            self.assertEqual(move.state, 'posted')
+            self.assertEqual(len(move.lines), 2)
+            for transaction in charges + [refund]:
+                self.assertEqual(transaction.state, 'posted')
+                self.assertEqual(transaction.move, move)
+                self.assertEqual(transaction.move_line, charges[0].move_line)
+            line = charges[0].move_line
+            self.assertEqual(line.party, self.party)
+            self.assertEqual(line.credit, 550)
+            gateway_line, = [x for x in move.lines if x != line]
+            self.assertEqual(gateway_line.debit, 550)
+
+            # Nothing left to post
+            self.assertEqual(
+                self.PaymentGatewayTransaction.post_aggregated(
+                    tomorrow, commit=False), 0
+            )
+
+    @with_transaction()
+    def test_0450_reconcile_payments(self):
+        """
+        Test reconciling the payment lines with the lines they pay
+        """
+        Date = POOL.get('ir.date')
+        Period = POOL.get('account.period')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+            }])
+            values = {
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+            }
+            origin, = self.PaymentGatewayTransaction.create([
+                dict(values, amount=1)
+            ])
+            with_origin, without_origin, unmatched = \
+                self.PaymentGatewayTransaction.create([
+                    dict(values, amount=400, origin=str(origin)),
+                    dict(values, amount=400),
+                    dict(values, amount=999),
+                ])
+
+            # The lines to pay, the first one is the oldest
+            today = Date.today()
+            revenue = self._get_account_by_kind('revenue')
+            moves = self.AccountMove.create([{
+                'journal': self.cash_journal.id,
+                'period': Period.find(self.company.id, date=today),
+                'date': today,
+                'origin': move_origin,
+                'lines': [('create', [{
+                    'account': self.party.account_receivable.id,
+                    'party': self.party.id,
+                    'debit': 400,
+                    'maturity_date': maturity_date,
+                }, {
+                    'account': revenue.id,
+                    'credit': 400,
+                }])],
+            } for move_origin, maturity_date in (
+                (None, today - datetime.timedelta(days=1)),
+                (str(origin), today),
+            )])
+            open_line, origin_line = [
+                [x for x in m.lines if x.party][0] for m in moves
+            ]
+
+            self.PaymentGatewayTransaction.capture(
+                [with_origin, without_origin, unmatched]
+            )
+            reconciled, leftovers = \
+                self.PaymentGatewayTransaction.reconcile_payments(chunk_size=2)
+            self.assertEqual(reconciled, 2)
+
+            def payment_line(transaction):
+                return [
+                    x for x in transaction.move.lines
+                    if x.account == self.party.account_receivable
+                ][0]
+
+            self.assertEqual(leftovers, [payment_line(unmatched).id])
+            self.assertEqual(
+                payment_line(with_origin).reconciliation,
+                origin_line.reconciliation
+            )
+            self.assertEqual(
+                payment_line(without_origin).reconciliation,
+                open_line.reconciliation
+            )
+            self.assertIsNotNone(open_line.reconciliation)
+
+            # Only the leftovers are read again
+            self.assertEqual(
+                self.PaymentGatewayTransaction.reconcile_payments(),
+                (0, leftovers)
+            )
+
+    @with_transaction()
+    def test_0460_payout_matching(self):
+        """
+        Test matching the payouts of a gateway with its transactions
+        """
+        Date = POOL.get('ir.date')
+        Payout = POOL.get('payment_gateway.payout')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+            }])
+            today = Date.today()
+            yesterday = today - datetime.timedelta(days=1)
+            values = {
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+            }
+            charges = self.PaymentGatewayTransaction.create([
+                dict(values, amount=100, date=yesterday),
+                dict(values, amount=200, date=yesterday),
+                dict(values, amount=300, date=today),
+            ])
+            refund, = self.PaymentGatewayTransaction.create([
+                dict(
+                    values, amount=50, date=today, type='refund',
+                    state='completed'),
+            ])
+            self.PaymentGatewayTransaction.capture(charges)
+
+            first, second, unmatched = Payout.create([{
+                'gateway': gateway.id,
+                'date': today,
+                'amount': amount,
+                'fee_tolerance': tolerance,
+                'start_date': yesterday,
+                'end_date': today,
+            } for amount, tolerance in ((200, 0), (345, 10), (1, 0))])
+
+            # No run of days matches, a subset does
+            Payout.match([first])
+            self.assertEqual(first.state, 'matched')
+            self.assertEqual(first.transactions, (charges[1],))
+            self.assertEqual(first.fee, 0)
+
+            # The remaining transactions of both days, less a fee of 5
+            Payout.match([second])
+            self.assertEqual(
+                set(second.transactions),
+                set([charges[0], charges[2], refund])
+            )
+            self.assertEqual(second.gross_amount, 350)
+            self.assertEqual(second.fee, 5)
+
+            with self.assertRaises(UserError):
+                Payout.match([unmatched])
+            self.assertEqual(Payout.match_payouts(), [])
+
+            Payout.draft([first])
+            self.assertEqual(first.transactions, ())
+            self.assertEqual(charges[1].payout, None)
+
+    @with_transaction()
+    def test_0470_transaction_summary(self):
+        """
+        Test the daily summary of the transactions
+        """
+        Date = POOL.get('ir.date')
+        TransactionSummary = POOL.get('payment_gateway.transaction.summary')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+            }])
+            today = Date.today()
+            last_month = today.replace(day=1) - datetime.timedelta(days=1)
+            values = {
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+            }
+            first, second, old = self.PaymentGatewayTransaction.create([
+                dict(values, amount=100, date=today),
+                dict(values, amount=50, date=today),
+                dict(values, amount=30, date=last_month),
+            ])
+
+            def totals(**kwargs):
+                return sorted(
+                    (t['date'], t['state'], t['count'], t['amount'])
+                    for t in TransactionSummary.get_totals(
+                        gateway=gateway.id, **kwargs)
+                )
+
+            self.assertEqual(totals(), [
+                (last_month, 'draft', 1, 30),
+                (today, 'draft', 2, 150),
+            ])
+
+            # The transitions move the transactions between the states
+            self.PaymentGatewayTransaction.capture([first])
+            self.PaymentGatewayTransaction.write([second], {'amount': 60})
+            self.assertEqual(totals(start_date=today), [
+                (today, 'draft', 1, 60),
+                (today, 'posted', 1, 100),
+            ])
+
+            self.PaymentGatewayTransaction.delete([second])
+            self.assertEqual(totals(start_date=today), [
+                (today, 'posted', 1, 100),
+            ])
+            self.assertEqual(totals(period='month', state='draft'), [
+                (last_month.replace(day=1), 'draft', 1, 30),
+            ])
+
+            # The rebuild gives the same summary
+            expected = totals()
+            TransactionSummary.delete(TransactionSummary.search([]))
+            self.assertEqual(totals(), [])
+            TransactionSummary.rebuild()
+            self.assertEqual(totals(), expected)
+            TransactionSummary.rebuild(start_date=today)
+            self.assertEqual(totals(), expected)
+
+    @with_transaction()
+    def test_0480_time_ordered_uuid(self):
+        """
+        Test the time ordered uuids of the transactions
+        """
+        from trytond.config import config
+
+        self.setup_defaults()
+
+        if not config.has_section('payment_gateway'):
+            config.add_section('payment_gateway')
+        config.set('payment_gateway', 'uuid', 'uuid7')
+        try:
+            with Transaction().set_context(
+                    company=self.company.id, use_dummy=True):
+                gateway, = self.PaymentGateway.create([{
+                    'name': 'Dummy Gateway',
+                    'journal': self.cash_journal.id,
+                    'provider': 'dummy',
+                    'method': 'credit_card',
+                }])
+                transactions = self.PaymentGatewayTransaction.create([{
+                    'party': self.party.id,
+                    'credit_account': self.party.account_receivable.id,
+                    'address': self.party.addresses[0].id,
+                    'gateway': gateway.id,
+                    'amount': amount,
+                } for amount in xrange(1, 51)])
+        finally:
+            config.remove_option('payment_gateway', 'uuid')
+
+        uuids = [t.uuid for t in transactions]
+        self.assertTrue(all(u[14] == '7' for u in uuids))
+        self.assertEqual(uuids, sorted(uuids))
+        self.assertEqual(len(set(uuids)), len(uuids))
+
+    @with_transaction()
+    def test_0490_search_support(self):
+        """
+        Test the search of the transactions for the customer support
+        """
+        Date = POOL.get('ir.date')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+            }])
+            today = Date.today()
+            yesterday = today - datetime.timedelta(days=1)
+            other_party, = self.Party.create([{
+                'name': 'Other party',
+                'addresses': [('create', [{'name': 'Other Party'}])],
+                'account_receivable': self.party.account_receivable.id,
+            }])
+            values = {
+                'credit_account': self.party.account_receivable.id,
+                'gateway': gateway.id,
+            }
+            first, second, third = self.PaymentGatewayTransaction.create([
+                dict(
+                    values, party=self.party.id,
+                    address=self.party.addresses[0].id, amount=100,
+                    date=yesterday, last_four_digits='4242',
+                    description='Order SO-1234'),
+                dict(
+                    values, party=self.party.id,
+                    address=self.party.addresses[0].id, amount=100,
+                    date=today, last_four_digits='1111',
+                    description='Order SO-1235'),
+                dict(
+                    values, party=other_party.id,
+                    address=other_party.addresses[0].id, amount=50,
+                    date=today, last_four_digits='4242'),
+            ])
+            search = self.PaymentGatewayTransaction.search_support
+
+            self.assertEqual(search(last_four_digits='4242'), [third, first])
+            self.assertEqual(search(amount=100), [second, first])
+            self.assertEqual(
+                search(last_four_digits='4242', start_date=today), [third]
+            )
+            self.assertEqual(
+                search(amount=100, end_date=yesterday), [first]
+            )
+            self.assertEqual(
+                search(party_name='est part'), [second, first]
+            )
+            self.assertEqual(search(description='so-1235'), [second])
+            # The wildcards are matched literally
+            self.assertEqual(search(description='so_1235'), [])
+            self.assertEqual(search(party_name='%'), [])
+            self.assertEqual(search(amount=100, limit=1), [second])
+            self.assertEqual(search(), [])
+
+    @with_transaction()
+    def test_0500_search_rec_name_plan(self):
+        """
+        Test the search by rec_name reads the transactions with indexes
+        """
+        # Without data: SQLite commits before the EXPLAIN statements
+        cursor = Transaction().connection.cursor()
+
+        def plan(clause):
+            sql, params = tuple(self.PaymentGatewayTransaction.search(
+                [('rec_name',) + clause], query=True
+            ))
+            if backend.name() == 'postgresql':
+                # The tables are empty, only a missing index gives a scan
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute('EXPLAIN ' + sql, params)
+                return [r[0] for r in cursor.fetchall()], [
+                    'Seq Scan on payment_gateway_transaction'
+                ]
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            aliases = re.findall(
+                r'"payment_gateway_transaction" AS "(\w+)"', sql
+            )
+            return [r[-1] for r in cursor.fetchall()], [
+                'SCAN %s' % a for a in
+                ['TABLE payment_gateway_transaction'] + aliases
+            ]
+
+        for clause in (
+                ('ilike', '%Test party%'),
+                ('=', '9f5d8bbe-8c6a-4d5c-b6b5-0f7d4b0e8b1a'),
+                ('ilike', 'ch_1234')):
+            lines, scans = plan(clause)
+            text = '\n'.join(lines)
+            self.assertIn('payment_gateway_transaction_party_index', text)
+            for scan in scans:
+                self.assertFalse([
+                    line for line in lines
+                    if re.search(r'\b%s\b' % re.escape(scan), line)
+                ], text)
+        lines, _ = plan(('=', 'ch_1234'))
+        text = '\n'.join(lines)
+        self.assertIn('payment_gateway_transaction_uuid_index', text)
+        self.assertIn(
+            'payment_gateway_transaction_provider_reference_index', text
+        )
+
+    @with_transaction()
+    def test_0510_archive_transactions(self):
+        """
+        Test moving the old transactions to the archive
+        """
+        Date = POOL.get('ir.date')
+        TransactionLog = POOL.get('payment_gateway.transaction.log')
+        TransactionSummary = POOL.get('payment_gateway.transaction.summary')
+        WebhookEvent = POOL.get('payment_gateway.webhook_event')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+            }])
+            posted, cancelled, draft, notified = \
+                self.PaymentGatewayTransaction.create([{
+                    'party': self.party.id,
+                    'credit_account': self.party.account_receivable.id,
+                    'address': self.party.addresses[0].id,
+                    'gateway': gateway.id,
+                    'amount': amount,
+                } for amount in (100, 50, 10, 5)])
+            self.PaymentGatewayTransaction.capture([posted])
+            self.PaymentGatewayTransaction.write(
+                [cancelled, notified], {'state': 'cancel'}
+            )
+            # The event keeps its transaction in the table
+            event, = WebhookEvent.create([{
+                'gateway': gateway.id,
+                'event_id': 'evt_1',
+                'type': 'cancelled',
+                'transaction': notified.id,
+                'state': 'done',
+            }])
+            self.assertEqual(posted.state, 'posted')
+            logs = TransactionLog.create([{
+                'transaction': posted.id,
+                'log': 'Settled',
+            }])
+
+            def totals():
+                return sorted(
+                    (t['state'], t['count'], t['amount'])
+                    for t in TransactionSummary.get_totals(
+                        gateway=gateway.id)
+                )
+            expected = totals()
+
+            # Nothing is archived without a date or a configuration
+            self.assertEqual(
+                self.PaymentGatewayTransaction.archive_transactions(
+                    commit=False), 0
+            )
+            tomorrow = Date.today() + datetime.timedelta(days=1)
+            self.assertEqual(
+                self.PaymentGatewayTransaction.archive_transactions(
+                    date=tomorrow, chunk_size=1, commit=False), 2
+            )
+
+            self.assertEqual(self.PaymentGatewayTransaction.search([
+                ('gateway', '=', gateway.id),
+            ], order=[('amount', 'DESC')]), [draft, notified])
+            self.assertEqual(event.transaction, notified)
+            self.assertFalse(
+                TransactionLog.search([('transaction', '=', posted.id)])
+            )
+            with Transaction().set_context(archived_transactions=True):
+                self.assertEqual(
+                    self.PaymentGatewayTransaction.search([
+                        ('gateway', '=', gateway.id),
+                    ], order=[('amount', 'DESC')]),
+                    [posted, cancelled, draft, notified]
+                )
+                archived = self.PaymentGatewayTransaction(posted.id)
+                self.assertEqual(archived.state, 'posted')
+                self.assertEqual(len(archived.logs), len(logs))
+                with self.assertRaises(UserError):
+                    self.PaymentGatewayTransaction.write(
+                        [archived], {'description': 'Archived'}
+                    )
+
+                # The live transactions are still modified
+                self.PaymentGatewayTransaction.write(
+                    [draft], {'description': 'Live'}
+                )
+                log, = TransactionLog.create([{
+                    'transaction': draft.id,
+                    'log': 'Live',
+                }])
+                TransactionLog.delete([log])
+            self.assertEqual(draft.description, 'Live')
+
+            # The summary keeps the archived transactions
+            self.assertEqual(totals(), expected)
+            TransactionSummary.rebuild()
+            self.assertEqual(totals(), expected)
+
+    @with_transaction()
+    def test_0520_concurrent_circuit_open(self):
+        """
+        Test the concurrent calls refused by the circuit breaker
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+                'concurrency': 4,
+                'breaker_error_rate': 50,
+                'breaker_min_calls': 1,
+                'breaker_open_duration': 60,
+                'breaker_mode': 'fail',
+            }])
+            transactions = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+                'amount': 400,
+            } for _ in range(3)])
+            breaker = gateway.get_circuit_breaker()
+            breaker.reset()
+            breaker.record(False)
+
+            # The batch fails like a synchronous call
+            with self.assertRaises(UserError):
+                self.PaymentGatewayTransaction.capture(transactions[:1])
+            self.assertEqual(transactions[0].state, 'draft')
+
+            # In queue mode the charges wait for the retry worker
+            gateway.breaker_mode = 'queue'
+            gateway.save()
+            self.PaymentGatewayTransaction.capture(transactions[1:])
+            for transaction in transactions[1:]:
+                self.assertEqual(transaction.state, 'failed')
+                self.assertTrue(
+                    transaction.next_retry > datetime.datetime.utcnow()
+                )
+            breaker.reset()
+
+    @with_transaction()
+    def test_0530_idempotency_key_many(self):
+        """
+        Test the idempotency keys of the batch and concurrent calls
+        """
+        IdempotencyKey = POOL.get('payment_gateway.idempotency_key')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            batch_gateway, async_gateway = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+                'batch_size': 2,
+            }, {
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+                'concurrency': 2,
+            }])
+            transactions = self.PaymentGatewayTransaction.create([{
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+                'amount': 400,
+            } for gateway in (batch_gateway, async_gateway) for _ in range(2)])
+
+            self.PaymentGatewayTransaction.authorize(transactions)
+            for transaction in transactions:
+                self.assertEqual(transaction.state, 'authorized')
+                key, = IdempotencyKey.search([
+                    ('transaction_uuid', '=', transaction.uuid),
+                ])
+                self.assertEqual(key.state, 'done')
+
+            # The states are lost as if the Tryton transaction was rolled
+            # back, the provider is not called again
+            self.PaymentGatewayTransaction.write(
+                transactions, {'state': 'draft'}
+            )
+            with Transaction().set_context(dummy_error=True):
+                self.PaymentGatewayTransaction.authorize(transactions)
+            for transaction in transactions:
+                self.assertEqual(transaction.state, 'authorized')
+                self.assertIn('replayed', transaction.logs[0].log)
+
+    @with_transaction()
+    def test_0540_reconcile_daily_payments(self):
+        """
+        Test reconciling the line of a daily move with the lines of the
+        origins of its transactions
+        """
+        Date = POOL.get('ir.date')
+        Period = POOL.get('account.period')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(
+                company=self.company.id, use_dummy=True):
+            gateway, = self.PaymentGateway.create([{
+                'name': 'Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+                'posting_mode': 'daily',
+            }])
+            values = {
+                'party': self.party.id,
+                'credit_account': self.party.account_receivable.id,
+                'address': self.party.addresses[0].id,
+                'gateway': gateway.id,
+            }
+            origins = self.PaymentGatewayTransaction.create([
+                dict(values, amount=1) for _ in range(2)
+            ])
+            yesterday = Date.today() - datetime.timedelta(days=1)
+            transactions = self.PaymentGatewayTransaction.create([
+                dict(
+                    values, amount=amount, origin=str(origin),
+                    date=yesterday)
+                for amount, origin in zip((100, 200), origins)
+            ])
+
+            revenue = self._get_account_by_kind('revenue')
+            moves = self.AccountMove.create([{
+                'journal': self.cash_journal.id,
+                'period': Period.find(self.company.id, date=yesterday),
+                'date': yesterday,
+                'origin': str(origin),
+                'lines': [('create', [{
+                    'account': self.party.account_receivable.id,
+                    'party': self.party.id,
+                    'debit': amount,
+                    'maturity_date': yesterday,
+                }, {
+                    'account': revenue.id,
+                    'credit': amount,
+                }])],
+            } for amount, origin in zip((100, 200), origins)])
+            self.AccountMove.post(moves)
+
+            self.PaymentGatewayTransaction.capture(transactions)
+            self.assertEqual(
+                self.PaymentGatewayTransaction.post_aggregated(
+                    commit=False), 1
+            )
+            reconciled, leftovers = \
+                self.PaymentGatewayTransaction.reconcile_payments()
+            self.assertEqual((reconciled, leftovers), (1, []))
+
+            # One reconciliation of the daily line and the two invoices
+            reconciliation = transactions[0].move_line.reconciliation
+            self.assertIsNotNone(reconciliation)
+            self.assertEqual(len(reconciliation.lines), 3)
+            for move in moves:
+                line, = [x for x in move.lines if x.party]
+                self.assertEqual(line.reconciliation, reconciliation)
+
 
 def suite():
     "Define suite"
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import time
+import unittest
+
+from trytond.modules.payment_gateway.uuids import uuid7, generate_uuid
+
+
+class TestTimeOrderedUUID(unittest.TestCase):
+    """
+    Test the time ordered uuids
+    """
+
+    def test_layout(self):
+        before = int(time.time() * 1000)
+        value = uuid7()
+        after = int(time.time() * 1000)
+        self.assertEqual(value.version, 7)
+        self.assertEqual(value.variant, 'specified in RFC 4122')
+        self.assertTrue(before <= value.int >> 80 <= after + 1)
+
+    def test_ordered(self):
+        # Many uuids per millisecond use the counter
+        values = [str(uuid7()) for _ in xrange(10000)]
+        self.assertEqual(values, sorted(values))
+        self.assertEqual(len(set(values)), len(values))
+
+    def test_generate_uuid(self):
+        self.assertEqual(len(generate_uuid()), 36)
+        self.assertIsInstance(generate_uuid('uuid7'), unicode)
+        self.assertEqual(generate_uuid('uuid7')[14], '7')
+        self.assertRaises(KeyError, generate_uuid, 'uuid1')
+
+
+def suite():
+    "Define suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestTimeOrderedUUID)
+    )
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
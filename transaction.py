@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
-import re
-from uuid import uuid4
+import calendar
 from decimal import Decimal
-from datetime import datetime
+from datetime import datetime, date as datetime_date
 
 import yaml
 from babel import numbers, dates
+from dateutil.relativedelta import relativedelta
+from sql import Union
+from sql.aggregate import Max
+from sql.conditionals import Case
+from trytond import backend
+from trytond.config import config
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, If, Bool
 from trytond.wizard import Wizard, StateView, StateTransition, \
@@ -14,11 +19,16 @@ from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 from trytond.model import ModelSQL, ModelView, Workflow, fields
 
+from . import magstripe, card_validation
+from .card_data import CardData, card_data_store
+from .uuids import generate_uuid
+
 
 __all__ = [
     'PaymentGateway', 'PaymentTransaction',
     'TransactionLog', 'PaymentProfile', 'AddPaymentProfileView',
-    'AddPaymentProfile', 'BaseCreditCardViewMixin', 'Party',
+    'AddPaymentProfile', 'BaseCreditCardViewMixin',
+    'BaseCreditCardWizardMixin', 'Party',
     'TransactionUseCardView', 'TransactionUseCard', 'PaymentGatewayResUser',
     'User', 'AccountMove', 'CreateRefund'
 ]
@@ -109,7 +119,7 @@ class PaymentTransaction(Workflow, ModelSQL, ModelView):
     '''Gateway Transaction'''
     __name__ = 'payment_gateway.transaction'
 
-    uuid = fields.Char('UUID', required=True, readonly=True)
+    uuid = fields.Char('UUID', required=True, readonly=True, select=True)
     description = fields.Char(
         'Description', states=READONLY_IF_NOT_DRAFT,
         depends=['state']
@@ -128,7 +138,7 @@ class PaymentTransaction(Workflow, ModelSQL, ModelView):
         depends=['state']
     )
     provider_reference = fields.Char(
-        'Provider Reference', readonly=True, states={
+        'Provider Reference', readonly=True, select=True, states={
             'invisible': Eval('state') == 'draft'
         }, depends=['state']
     )
@@ -147,7 +157,7 @@ class PaymentTransaction(Workflow, ModelSQL, ModelView):
     )
     party = fields.Many2One(
         'party.party', 'Party', required=True, ondelete='RESTRICT',
-        depends=['state'], states=READONLY_IF_NOT_DRAFT,
+        depends=['state'], states=READONLY_IF_NOT_DRAFT, select=True,
     )
     payment_profile = fields.Many2One(
         'party.payment_profile', 'Payment Profile',
@@ -219,11 +229,44 @@ class PaymentTransaction(Workflow, ModelSQL, ModelView):
 
     @classmethod
     def search_rec_name(cls, name, clause):
-        return [
-            'OR',
-            [('uuid',) + tuple(clause[1:])],
-            [('party',) + tuple(clause[1:])],
-        ]
+        _, operator, value = clause[:3]
+        if (operator not in ('=', 'like', 'ilike') or
+                not isinstance(value, basestring)):
+            bool_op = 'AND' if operator.startswith(('!', 'not ')) else 'OR'
+            return [
+                bool_op,
+                [('uuid',) + tuple(clause[1:])],
+                [('party',) + tuple(clause[1:])],
+            ]
+        return [('id', 'in', cls._search_rec_name_query(operator, value))]
+
+    @classmethod
+    def _search_rec_name_query(cls, operator, value):
+        """
+        Return the query of the ids of the transactions with the value as
+        uuid or provider reference, or whose party matches the value
+
+        Each part of the union is served by its own index instead of an OR
+        across the join to the party.
+        """
+        Party = Pool().get('party.party')
+        table = cls.__table__()
+
+        queries = [table.select(
+            table.id, where=table.party.in_(Party.search(
+                [('rec_name', operator, value)], query=True
+            ))
+        )]
+        term = value if operator == '=' else value.strip('%')
+        if term and '%' not in term:
+            queries.insert(0, table.select(
+                table.id, where=table.provider_reference == term
+            ))
+            queries.insert(0, table.select(
+                table.id, where=table.uuid == (
+                    term.lower() if operator == 'ilike' else term)
+            ))
+        return Union(*queries)
 
     @staticmethod
     def default_type():
@@ -382,7 +425,9 @@ class PaymentTransaction(Workflow, ModelSQL, ModelView):
 
     @staticmethod
     def default_uuid():
-        return unicode(uuid4())
+        return generate_uuid(
+            config.get('payment_gateway', 'uuid', default='uuid4')
+        )
 
     @staticmethod
     def default_date():
@@ -404,12 +449,22 @@ class PaymentTransaction(Workflow, ModelSQL, ModelView):
     def default_state():
         return 'draft'
 
+    @classmethod
+    def create(cls, vlist):
+        vlist = [x.copy() for x in vlist]
+        for values in vlist:
+            # The default values are computed once per call, every
+            # transaction needs its own uuid
+            if not values.get('uuid'):
+                values['uuid'] = cls.default_uuid()
+        return super(PaymentTransaction, cls).create(vlist)
+
     @classmethod
     def copy(cls, records, default=None):
         if default is None:
             default = {}
         default.update({
-            'uuid': cls.default_uuid(),
+            'uuid': None,
             'provider_reference': None,
             'move': None,
             'logs': None,
@@ -489,7 +544,7 @@ class PaymentTransaction(Workflow, ModelSQL, ModelView):
                     'feature_not_available',
                     ('cancellation', transaction.gateway.provider),
                 )
-            getattr(transaction, method_name)()
+            transaction.call_provider(method_name)
 
     @classmethod
     @ModelView.button
@@ -502,7 +557,7 @@ class PaymentTransaction(Workflow, ModelSQL, ModelView):
                     'feature_not_available',
                     ('authorization', transaction.gateway.provider),
                 )
-            getattr(transaction, method_name)()
+            transaction.call_provider(method_name)
 
     @classmethod
     @ModelView.button
@@ -530,7 +585,7 @@ class PaymentTransaction(Workflow, ModelSQL, ModelView):
                     'feature_not_available',
                     ('retry', transaction.gateway.provider)
                 )
-            getattr(transaction, method_name)()
+            transaction.call_provider(method_name)
 
     @classmethod
     @ModelView.button
@@ -543,7 +598,7 @@ class PaymentTransaction(Workflow, ModelSQL, ModelView):
                     'feature_not_available',
                     ('settle', transaction.gateway.provider)
                 )
-            getattr(transaction, method_name)()
+            transaction.call_provider(method_name)
 
     @classmethod
     @ModelView.button
@@ -556,7 +611,7 @@ class PaymentTransaction(Workflow, ModelSQL, ModelView):
                     'feature_not_available',
                     ('capture', transaction.gateway.provider)
                 )
-            getattr(transaction, method_name)()
+            transaction.call_provider(method_name)
 
     @classmethod
     @ModelView.button
@@ -586,7 +641,7 @@ class PaymentTransaction(Workflow, ModelSQL, ModelView):
                     'feature_not_available',
                     ('refund', transaction.gateway.provider)
                 )
-            getattr(transaction, method_name)()
+            transaction.call_provider(method_name)
 
     @classmethod
     @ModelView.button
@@ -602,7 +657,83 @@ class PaymentTransaction(Workflow, ModelSQL, ModelView):
                     'feature_not_available',
                     ('update status', transaction.gateway.provider)
                 )
-            getattr(transaction, method_name)()
+            transaction.call_provider(method_name)
+
+    def call_provider(self, method_name, *args, **kwargs):
+        """
+        Call the method `method_name` of the provider on the transaction.
+
+        Every call made to the provider goes through this method, so
+        downstream modules can override it to wrap them.
+        """
+        return getattr(self, method_name)(*args, **kwargs)
+
+    @classmethod
+    def call_provider_many(cls, method_name, transactions, *args, **kwargs):
+        """
+        Call the classmethod `method_name` of the provider, like
+        `update_<provider>_many`, on the transactions of a gateway.
+
+        The `<verb>_<provider>_many` methods return one result per
+        transaction, in the same order: a dictionary with the new `state` of
+        the transaction and optionally its `provider_reference` and a `log`.
+        They do not write the transactions, the results are written back by
+        :meth:`apply_provider_results`. An exception fails the whole call.
+        """
+        results = getattr(cls, method_name)(transactions, *args, **kwargs)
+        if len(results) != len(transactions):
+            raise ValueError(
+                '%s returned %d results for %d transactions' % (
+                    method_name, len(results), len(transactions))
+            )
+        return results
+
+    @classmethod
+    def apply_provider_results(cls, verb, results):
+        """
+        Write back the results of the provider calls, in one write and one
+        log creation, and post the completed transactions
+
+        :param results: A list of (transaction, (result, exception)) where
+                        the result is a dictionary like the ones returned
+                        by the `<verb>_<provider>_many` methods
+        """
+        to_write, logs = [], []
+        for transaction, (result, exception) in results:
+            if exception is not None:
+                result = {
+                    'state': 'failed',
+                    'log': '%s failed\n%s' % (
+                        verb.capitalize(), unicode(exception)),
+                }
+            values = transaction._get_provider_result_values(result)
+            if values:
+                to_write.extend(([transaction], values))
+            if result.get('log'):
+                logs.append({
+                    'transaction': transaction.id,
+                    'log': result['log'],
+                })
+        if to_write:
+            cls.write(*to_write)
+        if logs:
+            TransactionLog.create(logs)
+
+        for transaction, _ in results:
+            if transaction.state == 'completed':
+                transaction.safe_post()
+
+    def _get_provider_result_values(self, result):
+        """
+        Return the values to write on the transaction for the result of
+        the provider
+        """
+        values = {}
+        if result['state'] != self.state:
+            values['state'] = result['state']
+        if result.get('provider_reference'):
+            values['provider_reference'] = result['provider_reference']
+        return values
 
     def safe_post(self):
         """
@@ -861,35 +992,114 @@ class BaseCreditCardViewMixin(object):
         if party_id:
             return Party(party_id).name
 
-    track1_re = re.compile(
-        r'^%(?P<FC>\w)(?P<PAN>\d+)\^(?P<NAME>.{2,26})\^(?P<YY>\d{2})'
-        '(?P<MM>\d{2})(?P<SC>\d{0,3}|\^)(?P<DD>.*)\?$'
-    )
-
-    @fields.depends('swipe_data')
+    @fields.depends('swipe_data', 'owner')
     def on_change_swipe_data(self):
         """
         Try to parse the track1 and track2 data into Credit card information
         """
         try:
-            track1, track2 = self.swipe_data.split(';')
-        except ValueError:
+            swipe = magstripe.parse(self.swipe_data)
+        except magstripe.MagstripeError:
             self.owner = ''
             self.number = ''
             self.expiry_month = ''
             self.expiry_year = ''
         else:
-            match = self.track1_re.match(track1)
-            if match:
-                # Track1 matched, extract info and send
-                assert match.group('FC').upper() == 'B', 'Unknown card Format Code'  # noqa
+            # Track 2 does not carry the name of the card holder
+            if swipe.name:
+                self.owner = swipe.name
+            self.number = swipe.pan
+            self.expiry_month = swipe.expiry_month
+            self.expiry_year = swipe.expiry_year
+
+
+class BaseCreditCardWizardMixin(object):
+    """
+    A Reusable Mixin class for wizards which collect credit card information
+    in a `card_info` state using a view based on `BaseCreditCardViewMixin`.
+
+    Tryton saves the values of wizard views in the session table after every
+    step. This mixin moves the confidential card information out of the view
+    into an in-process :class:`~card_data.CardData` before the session is
+    saved, so it never hits the database.
+    """
 
-                self.owner = match.group('NAME')
-                self.number = match.group('PAN')
-                self.expiry_month = match.group('MM')
-                self.expiry_year = '20' + match.group('YY')
+    @classmethod
+    def __setup__(cls):
+        super(BaseCreditCardWizardMixin, cls).__setup__()
+        cls._error_messages.update(card_validation.ERRORS)
 
-            # TODO: Match track 2
+    @classmethod
+    def _card_data_key(cls, session_id):
+        return (Transaction().database.name, session_id)
+
+    def _scrub_card_info(self):
+        for name in CardData.sensitive_fields:
+            setattr(self.card_info, name, None)
+
+    def stash_card_data(self):
+        """
+        Move the card information entered in the view to the in-process
+        store, from where `get_card_data` finds it in later steps.
+        """
+        card_info = self.card_info
+        if any(
+            getattr(card_info, name, None)
+            for name in CardData.sensitive_fields
+        ):
+            card_data_store.put(
+                self._card_data_key(self._session_id),
+                CardData.from_view(card_info)
+            )
+        self._scrub_card_info()
+
+    def get_card_data(self):
+        """
+        Return the card information entered in the wizard as an instance of
+        :class:`~card_data.CardData`. The values submitted in the current
+        step take precedence over the ones stashed by a previous step.
+        """
+        if any(
+            getattr(self.card_info, name, None)
+            for name in CardData.sensitive_fields
+        ):
+            return CardData.from_view(self.card_info)
+        return card_data_store.get(self._card_data_key(self._session_id)) \
+            or CardData.from_view(self.card_info)
+
+    def check_card_data(self, card_data):
+        """
+        Validate the card number locally, so that a malformed card is
+        rejected before it reaches the provider.
+
+        :param card_data: Instance of :class:`~card_data.CardData`
+        """
+        if not card_data.number:
+            # The provider may only need the swipe data
+            return
+        scheme, error = card_validation.check(card_data.number)
+        if error:
+            self.raise_user_error(error)
+
+    def clear_card_data(self):
+        """
+        Forget the card information both from the view and the store
+        """
+        card_data = card_data_store.pop(self._card_data_key(self._session_id))
+        if card_data is not None:
+            card_data.clear()
+        self._scrub_card_info()
+
+    def _save(self):
+        self.stash_card_data()
+        super(BaseCreditCardWizardMixin, self)._save()
+
+    @classmethod
+    def delete(cls, session_id):
+        card_data = card_data_store.pop(cls._card_data_key(session_id))
+        if card_data is not None:
+            card_data.clear()
+        return super(BaseCreditCardWizardMixin, cls).delete(session_id)
 
 
 class Party:
@@ -970,6 +1180,10 @@ class PaymentProfile(ModelSQL, ModelView):
     expiry_year = fields.Char(
         'Expiry Year', required=True, size=4, readonly=True
     )
+    expiry_date = fields.Date(
+        'Expiry Date', readonly=True, select=True,
+        help='Last day of the month in which the card expires'
+    )
     active = fields.Boolean('Active', select=True)
 
     @staticmethod
@@ -981,6 +1195,229 @@ class PaymentProfile(ModelSQL, ModelView):
         super(PaymentProfile, cls).__setup__()
         cls._order.insert(0, ('sequence', 'ASC'))
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+        sql_table = cls.__table__()
+
+        super(PaymentProfile, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        table.index_action(['gateway', 'expiry_date'], 'add')
+        table.index_action(
+            ['party', 'gateway', 'last_4_digits', 'expiry_date'], 'add'
+        )
+
+        # Migration from 4.0.2.7: fill the expiry date from month and year
+        # with one update per distinct month and year
+        cursor.execute(*sql_table.select(
+            sql_table.expiry_month, sql_table.expiry_year,
+            where=sql_table.expiry_date == None,  # noqa
+            group_by=[sql_table.expiry_month, sql_table.expiry_year]
+        ))
+        for month, year in cursor.fetchall():
+            cursor.execute(*sql_table.update(
+                [sql_table.expiry_date],
+                [cls.compute_expiry_date(month, year)],
+                where=(sql_table.expiry_month == month) &
+                (sql_table.expiry_year == year) &
+                (sql_table.expiry_date == None)  # noqa
+            ))
+
+    @staticmethod
+    def compute_expiry_date(month, year):
+        """
+        Return the last day of the month in which a card expires
+
+        :param month: Expiry month as a string like '01'
+        :param year: Expiry year as a string of 2 or 4 digits
+        :return: A date or None if the month or year is invalid
+        """
+        try:
+            month, year = int(month), int(year)
+            if year < 100:
+                year += 2000
+            return datetime_date(
+                year, month, calendar.monthrange(year, month)[1]
+            )
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [x.copy() for x in vlist]
+        for values in vlist:
+            if 'expiry_date' not in values:
+                values['expiry_date'] = cls.compute_expiry_date(
+                    values.get('expiry_month'), values.get('expiry_year')
+                )
+        return super(PaymentProfile, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        super(PaymentProfile, cls).write(*args)
+
+        actions = iter(args)
+        to_update = []
+        for profiles, values in zip(actions, actions):
+            if 'expiry_month' in values or 'expiry_year' in values:
+                to_update.extend(profiles)
+        if to_update:
+            cls._update_expiry_date(to_update)
+
+    @classmethod
+    def _update_expiry_date(cls, profiles):
+        to_write = {}
+        for profile in profiles:
+            expiry_date = cls.compute_expiry_date(
+                profile.expiry_month, profile.expiry_year
+            )
+            to_write.setdefault(expiry_date, []).append(profile)
+        super(PaymentProfile, cls).write(*sum(
+            [[p, {'expiry_date': d}] for d, p in to_write.iteritems()], []
+        ))
+
+    @classmethod
+    def find_duplicate(cls, party, gateway, last_4_digits, expiry_month,
+                       expiry_year):
+        """
+        Return the most recent active profile of the party which stores the
+        same card on the gateway, or None.
+        """
+        expiry_date = cls.compute_expiry_date(expiry_month, expiry_year)
+        if not last_4_digits or not expiry_date:
+            return None
+        profiles = cls.search([
+            ('party', '=', party),
+            ('gateway', '=', gateway),
+            ('last_4_digits', '=', last_4_digits),
+            ('expiry_date', '=', expiry_date),
+        ], order=[('id', 'DESC')], limit=1)
+        return profiles[0] if profiles else None
+
+    @classmethod
+    def merge_duplicates(cls):
+        """
+        Cron entry point which merges the active profiles of a party storing
+        the same card on the same gateway.
+
+        The most recent profile of each set of duplicates is kept. The
+        transactions using the others are repointed to it and the others
+        are deactivated, with one update of each table per chunk of
+        duplicates.
+
+        :return: The number of profiles deactivated
+        """
+        pool = Pool()
+        GatewayTransaction = pool.get('payment_gateway.transaction')
+        profile = cls.__table__()
+        newer = cls.__table__()
+        gateway_transaction = GatewayTransaction.__table__()
+        cursor = Transaction().connection.cursor()
+        in_max = Transaction().database.IN_MAX
+
+        cursor.execute(*profile.join(newer, condition=(
+            (newer.party == profile.party) &
+            (newer.gateway == profile.gateway) &
+            (newer.last_4_digits == profile.last_4_digits) &
+            (newer.expiry_date == profile.expiry_date) &
+            (newer.id > profile.id) &
+            (newer.active == True)  # noqa
+        )).select(
+            profile.id, Max(newer.id),
+            where=profile.active == True,  # noqa
+            group_by=[profile.id]
+        ))
+
+        mapping = cursor.fetchall()
+        for i in xrange(0, len(mapping), in_max):
+            duplicates = mapping[i:i + in_max]
+            ids = [duplicate for duplicate, _ in duplicates]
+            cursor.execute(*gateway_transaction.update(
+                [gateway_transaction.payment_profile],
+                [Case(*[
+                    (gateway_transaction.payment_profile == duplicate, kept)
+                    for duplicate, kept in duplicates
+                ])],
+                where=gateway_transaction.payment_profile.in_(ids)
+            ))
+            cursor.execute(*profile.update(
+                [profile.active], [False], where=profile.id.in_(ids)
+            ))
+        return len(mapping)
+
+    @classmethod
+    def search_expiring(cls, before, after=None, gateway=None,
+                        chunk_size=1000):
+        """
+        Stream the active profiles expiring before a date in chunks.
+
+        The profiles are read in keyset pages ordered by (expiry_date, id),
+        so that memory use stays bounded and each page continues the range
+        scan on the (gateway, expiry_date) index where the previous one
+        stopped, however many profiles there are.
+
+        :param before: Profiles expiring strictly before this date
+        :param after: Optional, profiles expiring on or after this date
+        :param gateway: Optional, limit to the profiles of this gateway
+        :param chunk_size: Number of profiles in each chunk
+        :return: A generator of lists of profiles
+        """
+        domain = [('expiry_date', '<', before)]
+        if after is not None:
+            domain.append(('expiry_date', '>=', after))
+        if gateway is not None:
+            domain.append(('gateway', '=', gateway.id))
+
+        last = None
+        while True:
+            keyset = []
+            if last is not None:
+                keyset = [[
+                    'OR',
+                    ('expiry_date', '>', last.expiry_date),
+                    [
+                        ('expiry_date', '=', last.expiry_date),
+                        ('id', '>', last.id),
+                    ],
+                ]]
+            profiles = cls.search(
+                domain + keyset,
+                order=[('expiry_date', 'ASC'), ('id', 'ASC')],
+                limit=chunk_size
+            )
+            if not profiles:
+                break
+            yield profiles
+            last = profiles[-1]
+
+    @classmethod
+    def process_expiring_profiles(cls, months=1):
+        """
+        Cron entry point which passes the profiles that are expired or
+        expire within the next `months` to the provider specific handler.
+
+        To handle them, a downstream module implements the classmethod
+        `process_expiring_<provider>(profiles)` on this model, for example
+        to refresh the cards with an account updater service or to notify
+        the customers. It is called once per chunk of profiles. Gateways of
+        providers without a handler are skipped.
+        """
+        pool = Pool()
+        Gateway = pool.get('payment_gateway.gateway')
+        Date = pool.get('ir.date')
+
+        before = Date.today() + relativedelta(day=1, months=months + 1)
+        for gateway in Gateway.search([]):
+            method = getattr(
+                cls, 'process_expiring_%s' % gateway.provider, None
+            )
+            if method is None:
+                continue
+            for profiles in cls.search_expiring(before, gateway=gateway):
+                method(profiles)
+
     def get_rec_name(self, name=None):
         if self.last_4_digits:
             return ' '.join([self.gateway.name, 'xxxx', self.last_4_digits])
@@ -1012,7 +1449,7 @@ class AddPaymentProfileView(BaseCreditCardViewMixin, ModelView):
     )
 
 
-class AddPaymentProfile(Wizard):
+class AddPaymentProfile(BaseCreditCardWizardMixin, Wizard):
     """
     Add a payment profile
     """
@@ -1057,28 +1494,42 @@ class AddPaymentProfile(Wizard):
         called by the method which implement the API and wants to create the
         profile with provider_reference.
 
+        If an active profile of the party already stores the same card on
+        the gateway, that profile is updated instead of creating a duplicate.
+
         :param provider_reference: Value for the provider_reference field.
         :return: Active record of the created profile
         """
         Profile = Pool().get('party.payment_profile')
 
-        profile = Profile(
-            name=self.card_info.owner,
+        card_data = self.get_card_data()
+        values = dict(
+            name=card_data.owner,
             party=self.card_info.party.id,
             address=self.card_info.address.id,
             gateway=self.card_info.gateway.id,
-            last_4_digits=self.card_info.number[-4:],
-            expiry_month=self.card_info.expiry_month,
-            expiry_year=self.card_info.expiry_year,
+            last_4_digits=card_data.last_4_digits,
+            expiry_month=card_data.expiry_month,
+            expiry_year=card_data.expiry_year,
             provider_reference=provider_reference,
             **kwargs
         )
+
+        # Reuse the profile if the same card is already stored for the party
+        profile = Profile.find_duplicate(
+            values['party'], values['gateway'], values['last_4_digits'],
+            values['expiry_month'], values['expiry_year']
+        )
+        if profile:
+            for name, value in values.iteritems():
+                setattr(profile, name, value)
+        else:
+            profile = Profile(**values)
         profile.save()
 
         # Wizard session data is stored in database
         # Make sure credit card info does not hit the database
-        self.card_info.number = None
-        self.card_info.csc = None
+        self.clear_card_data()
         return profile
 
     def transition_add(self):
@@ -1100,6 +1551,8 @@ class AddPaymentProfile(Wizard):
         If return_profile is set to True in the context, then the created
         profile is returned.
         """
+        self.check_card_data(self.get_card_data())
+
         method_name = 'transition_add_%s' % self.card_info.gateway.provider
         if Transaction().context.get('return_profile'):
             return getattr(self, method_name)()
@@ -1115,7 +1568,7 @@ class TransactionUseCardView(BaseCreditCardViewMixin, ModelView):
     __name__ = 'payment_gateway.transaction.use_card.view'
 
 
-class TransactionUseCard(Wizard):
+class TransactionUseCard(BaseCreditCardWizardMixin, Wizard):
     """
     Transaction using Credit Card wizard
     """
@@ -1146,8 +1599,10 @@ class TransactionUseCard(Wizard):
             Transaction().context.get('active_id')
         )
 
-        getattr(transaction, 'capture_%s' % transaction.gateway.provider)(
-            self.card_info
+        card_data = self.get_card_data()
+        self.check_card_data(card_data)
+        transaction.call_provider(
+            'capture_%s' % transaction.gateway.provider, card_data
         )
 
         self.clear_cc_info()
@@ -1164,8 +1619,10 @@ class TransactionUseCard(Wizard):
             Transaction().context.get('active_id')
         )
 
-        getattr(transaction, 'authorize_%s' % transaction.gateway.provider)(
-            self.card_info
+        card_data = self.get_card_data()
+        self.check_card_data(card_data)
+        transaction.call_provider(
+            'authorize_%s' % transaction.gateway.provider, card_data
         )
 
         self.clear_cc_info()
@@ -1176,8 +1633,7 @@ class TransactionUseCard(Wizard):
         Tryton stores Wizard session data while it's execution
         We need to make sure credit card info does not hit the database
         """
-        self.card_info.number = None
-        self.card_info.csc = None
+        self.clear_card_data()
 
 
 class User:
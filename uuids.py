@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Generators of the uuid of the transactions
+
+    The uuids are random (version 4) by default. Random keys are inserted
+    all over the index of the uuid, which splits its pages and needs the
+    whole index in cache at a high rate of inserts. The time ordered uuids
+    (the layout of the version 7 of RFC 9562) start with the time in
+    milliseconds, so the new keys are appended at the end of the index like
+    the ids.
+
+    The generator is chosen in the configuration of the server::
+
+        [payment_gateway]
+        uuid = uuid7
+'''
+import os
+import time
+import threading
+from uuid import UUID, uuid4
+
+__all__ = ['uuid7', 'UUID_GENERATORS', 'generate_uuid']
+
+_lock = threading.Lock()
+_last = [0, 0]
+
+
+def uuid7():
+    """
+    Return a time ordered uuid
+
+    The first 48 bits are the unix time in milliseconds and the 12 bits of
+    `rand_a` are a counter, randomly seeded every millisecond, so the uuids
+    generated by a process are strictly increasing.
+    """
+    random = int(os.urandom(10).encode('hex'), 16)
+    with _lock:
+        timestamp = int(time.time() * 1000)
+        if timestamp > _last[0]:
+            counter = random >> 69
+        else:
+            # Same millisecond or clock going back: increment the counter
+            # and borrow the next millisecond on overflow
+            timestamp = _last[0]
+            counter = _last[1] + 1
+            if counter > 0xfff:
+                timestamp += 1
+                counter = 0
+        _last[:] = [timestamp, counter]
+    value = (
+        timestamp << 80 | 0x7 << 76 | counter << 64 |
+        0x2 << 62 | random & (1 << 62) - 1
+    )
+    return UUID(int=value)
+
+
+UUID_GENERATORS = {
+    'uuid4': uuid4,
+    'uuid7': uuid7,
+}
+
+
+def generate_uuid(kind='uuid4'):
+    """
+    Return a new uuid as unicode with the generator `kind`
+    """
+    return unicode(UUID_GENERATORS[kind]())
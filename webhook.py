@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Webhook events of the providers
+
+    Providers push events (a capture settled, an authorization cancelled,
+    a chargeback, ...) instead of being polled. The events received for a
+    gateway are stored as they come in :class:`WebhookEvent` and applied
+    later, in batches, by :meth:`WebhookEvent.process`:
+
+        * an event is stored once per gateway and event id, the events a
+          provider sends again are dropped,
+        * the transactions of a batch of events are found with one query
+          per gateway on their `provider_reference`,
+        * the events of a transaction are applied in the order in which the
+          provider emitted them, and the new states and logs are written in
+          one call per batch,
+        * the events which match no transaction yet, because the provider
+          sent them before its reference was stored on the transaction, are
+          kept as `unmatched` and tried again by the next runs for
+          :data:`UNMATCHED_RETRY`.
+
+    The `receive` RPC takes the body of the request of the provider. The
+    gateway turns it into events with its `parse_webhook_<provider>`
+    method, which returns a list of dictionaries:
+
+    .. code-block:: python
+
+        def parse_webhook_acme(self, body):
+            ...
+            return [{
+                'id': 'evt_123',
+                'type': 'settled',
+                'provider_reference': 'ch_456',
+                'occurred': datetime(...),
+                'payload': body,
+            }]
+
+    The `type` is one of :data:`EVENT_STATES`, the other events are only
+    logged on their transaction.
+'''
+import json
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from dateutil import parser, tz
+
+from trytond import backend
+from trytond.model import ModelSQL, ModelView, fields, Unique
+from trytond.pool import Pool, PoolMeta
+from trytond.rpc import RPC
+from trytond.transaction import Transaction
+
+from .claim import skip_locked
+
+__all__ = ['WebhookEvent', 'PaymentGatewayWebhook']
+__metaclass__ = PoolMeta
+
+# The state in which a transaction is put by the type of event
+EVENT_STATES = {
+    'authorized': 'authorized',
+    'settled': 'completed',
+    'failed': 'failed',
+    'cancelled': 'cancel',
+}
+# How long the unmatched events are tried again after their reception
+UNMATCHED_RETRY = timedelta(days=1)
+
+
+class WebhookEvent(ModelSQL, ModelView):
+    "Webhook Event of a Payment Gateway"
+    __name__ = 'payment_gateway.webhook_event'
+
+    gateway = fields.Many2One(
+        'payment_gateway.gateway', 'Gateway', required=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    event_id = fields.Char('Event ID', required=True, readonly=True)
+    type = fields.Char('Type', required=True, readonly=True)
+    provider_reference = fields.Char(
+        'Provider Reference', readonly=True, select=True
+    )
+    occurred = fields.DateTime('Occurred', readonly=True)
+    received = fields.DateTime('Received', required=True, readonly=True)
+    payload = fields.Text('Payload', readonly=True)
+    transaction = fields.Many2One(
+        'payment_gateway.transaction', 'Transaction', readonly=True,
+        select=True
+    )
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('ignored', 'Ignored'),
+        ('unmatched', 'Unmatched'),
+    ], 'State', required=True, readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(WebhookEvent, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('gateway_event_uniq', Unique(t, t.gateway, t.event_id),
+                'An event is received once per gateway.'),
+        ]
+        cls._order.insert(0, ('received', 'DESC'))
+        cls.__rpc__.update({
+            'receive': RPC(readonly=False),
+        })
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(WebhookEvent, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        table.index_action(['state', 'id'], 'add')
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_received():
+        return datetime.utcnow()
+
+    @classmethod
+    def receive(cls, gateway_id, body):
+        """
+        RPC entry point which stores the events of a request of the provider
+
+        :return: The number of new events
+        """
+        Gateway = Pool().get('payment_gateway.gateway')
+
+        gateway = Gateway(gateway_id)
+        return len(cls.ingest(gateway, gateway.parse_webhook(body)))
+
+    @classmethod
+    def ingest(cls, gateway, events):
+        """
+        Store the events of the gateway which were not received yet
+
+        :param events: A list of dictionaries with the `id`, `type`,
+                       `provider_reference`, `occurred` and `payload`
+        :return: The list of the created events
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # Keep the order of the provider
+        by_id = OrderedDict()
+        for event in events:
+            by_id.setdefault(event['id'], event)
+        if not by_id:
+            return []
+
+        known = set()
+        ids = list(by_id)
+        in_max = Transaction().database.IN_MAX
+        for i in xrange(0, len(ids), in_max):
+            cursor.execute(*table.select(
+                table.event_id,
+                where=(table.gateway == gateway.id) &
+                table.event_id.in_(ids[i:i + in_max])
+            ))
+            known.update(event_id for event_id, in cursor.fetchall())
+
+        return cls.create([{
+            'gateway': gateway.id,
+            'event_id': event_id,
+            'type': event['type'],
+            'provider_reference': event.get('provider_reference'),
+            'occurred': event.get('occurred'),
+            'payload': event.get('payload'),
+        } for event_id, event in by_id.iteritems() if event_id not in known])
+
+    @classmethod
+    def process(cls, chunk_size=500, limit=10000):
+        """
+        Cron entry point which applies the pending events and the unmatched
+        events received less than :data:`UNMATCHED_RETRY` ago
+
+        :param chunk_size: Number of events applied per batch
+        :param limit: Maximum number of events processed per run
+        :return: The number of events processed
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        retry_since = datetime.utcnow() - UNMATCHED_RETRY
+        processed, last_id = 0, 0
+        while processed < limit:
+            # The unmatched events stay unmatched, go past them
+            query = table.select(
+                table.id,
+                where=(table.id > last_id) & (
+                    (table.state == 'pending') |
+                    ((table.state == 'unmatched') &
+                        (table.received >= retry_since))),
+                order_by=[table.id], limit=min(chunk_size, limit - processed)
+            )
+            cursor.execute(*skip_locked(query))
+            events = cls.browse([id_ for id_, in cursor.fetchall()])
+            if not events:
+                break
+            cls.apply(events)
+            processed += len(events)
+            last_id = events[-1].id
+        return processed
+
+    @classmethod
+    def resolve(cls, events):
+        """
+        Return a dictionary of the transaction of each event, found with
+        one query per gateway
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+        by_gateway = {}
+        for event in events:
+            if event.transaction:
+                continue
+            if event.provider_reference:
+                by_gateway.setdefault(event.gateway.id, set()).add(
+                    event.provider_reference
+                )
+
+        transactions = {}
+        in_max = Transaction().database.IN_MAX
+        for gateway_id, references in by_gateway.iteritems():
+            references = list(references)
+            for i in xrange(0, len(references), in_max):
+                for transaction in PaymentTransaction.search([
+                    ('gateway', '=', gateway_id),
+                    ('provider_reference', 'in', references[i:i + in_max]),
+                ]):
+                    transactions[
+                        (gateway_id, transaction.provider_reference)
+                    ] = transaction
+
+        return dict(
+            (event, event.transaction or transactions.get(
+                (event.gateway.id, event.provider_reference)))
+            for event in events
+        )
+
+    @classmethod
+    def apply(cls, events):
+        """
+        Apply the events to their transactions with one write of the
+        transactions, one creation of the logs and one write of the events
+        """
+        pool = Pool()
+        PaymentTransaction = pool.get('payment_gateway.transaction')
+        TransactionLog = pool.get('payment_gateway.transaction.log')
+
+        transactions = cls.resolve(events)
+        by_transaction = {}
+        unmatched = []
+        for event in events:
+            transaction = transactions[event]
+            if transaction is None:
+                unmatched.append(event)
+            else:
+                by_transaction.setdefault(transaction, []).append(event)
+
+        states, logs, to_write = {}, [], []
+        for transaction, transaction_events in by_transaction.iteritems():
+            state = cls.apply_transaction_events(
+                transaction, transaction_events, logs, to_write
+            )
+            if state != transaction.state:
+                states.setdefault(state, []).append(transaction)
+
+        unmatched = [e for e in unmatched if e.state != 'unmatched']
+        if unmatched:
+            to_write.extend((unmatched, {'state': 'unmatched'}))
+        if to_write:
+            cls.write(*to_write)
+        if states:
+            PaymentTransaction.write(*sum((
+                (state_transactions, {'state': state})
+                for state, state_transactions in states.iteritems()
+            ), ()))
+        if logs:
+            TransactionLog.create(logs)
+
+        for transaction in states.get('completed', []):
+            transaction.safe_post()
+
+    @classmethod
+    def apply_transaction_events(cls, transaction, events, logs, to_write):
+        """
+        Follow the events of a transaction in the order of the provider,
+        the events which lead to a transition the workflow does not allow
+        are ignored
+
+        :param logs: The list to which the logs to create are added
+        :param to_write: The list to which the writes of the events are added
+        :return: The state of the transaction after the events
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+        state = transaction.state
+        for event in sorted(
+                events, key=lambda e: (e.occurred or e.received, e.id)):
+            new_state = EVENT_STATES.get(event.type, state)
+            if (new_state == state or
+                    (state, new_state) in PaymentTransaction._transitions):
+                state = new_state
+                event_state = 'done'
+                log = 'Webhook event %s (%s)' % (event.event_id, event.type)
+            else:
+                event_state = 'ignored'
+                log = 'Webhook event %s (%s) ignored in state %s' % (
+                    event.event_id, event.type, state)
+            logs.append({
+                'transaction': transaction.id,
+                'log': log,
+            })
+            to_write.extend(([event], {
+                'state': event_state,
+                'transaction': transaction.id,
+            }))
+        return state
+
+
+class PaymentGatewayWebhook:
+    "Parse the webhook requests of the provider"
+    __name__ = 'payment_gateway.gateway'
+
+    @classmethod
+    def __setup__(cls):
+        super(PaymentGatewayWebhook, cls).__setup__()
+        cls._error_messages.update({
+            'webhook_not_available': 'The provider "%s" of the gateway '
+                                     'does not send webhook events.',
+        })
+
+    def parse_webhook(self, body):
+        """
+        Return the events of a webhook request of the provider
+        """
+        method_name = 'parse_webhook_%s' % self.provider
+        if not hasattr(self, method_name):
+            self.raise_user_error('webhook_not_available', (self.provider,))
+        return getattr(self, method_name)(body)
+
+    @staticmethod
+    def parse_webhook_json(body):
+        """
+        Return the events of a JSON list of events using the keys of
+        :meth:`WebhookEvent.ingest`, which providers can reuse. The
+        `occurred` time can be in any ISO 8601 format, it is converted to
+        UTC.
+        """
+        events = []
+        for event in json.loads(body):
+            event.setdefault('payload', json.dumps(event))
+            if event.get('occurred'):
+                occurred = parser.parse(event['occurred'])
+                if occurred.tzinfo is not None:
+                    occurred = occurred.astimezone(tz.tzutc()).replace(
+                        tzinfo=None)
+                event['occurred'] = occurred
+            events.append(event)
+        return events